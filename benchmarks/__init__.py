@@ -0,0 +1 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
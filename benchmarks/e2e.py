@@ -0,0 +1,225 @@
+"""End-to-end benchmark of HTTPDownloadHandler through local SOCKS servers.
+
+Every scenario starts a stand-in SOCKS server and origin in this process,
+downloads ``--requests`` URLs through them with ``--concurrency`` requests
+in flight and reports throughput, latency percentiles, tunnels opened per
+request and CPU time per request as JSON. The CPU time is the whole
+process's, so it includes the stand-in servers; compare it between
+revisions, not against real deployments.
+
+    python -m benchmarks.e2e --schemes socks5,socks5h --origins https \\
+        --concurrency 32 --requests 2000 --output results.json
+
+Handler settings can be set with ``--set NAME=VALUE``, e.g.
+``--set SOCKS_PIPELINE_HANDSHAKE=1``. Tunnels are kept alive as usual, so
+the injected handshake faults only hit new ones; ``--set
+SOCKS_POOL_MAXSIZE=0`` opens a tunnel for every request.
+
+To compare the asyncio connector with the default one, run under the
+asyncio reactor: ``--reactor asyncio --set SOCKS_CONNECTOR=asyncio``.
+"""
+
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+import argparse
+from collections import Counter
+import itertools
+import json
+import platform
+import sys
+import time
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+
+from benchmarks.servers import FaultPlan, listen_origin, listen_socks
+
+
+SCHEMES = ('socks4', 'socks4a', 'socks5', 'socks5h')
+CREDENTIALS = ('bench', 'secret')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def scenarios(options):
+    """Return the scenario dicts selected by the command line options."""
+    auths = {'none': (False,), 'login': (True,), 'both': (False, True)}[options.auth]
+    for scheme, origin, auth in itertools.product(options.schemes, options.origins, auths):
+        if auth and not scheme.startswith('socks5'):
+            # SOCKS4 has no authentication
+            continue
+        yield {
+            'scheme': scheme,
+            'origin': origin,
+            'auth': auth,
+            'requests': options.requests,
+            'concurrency': options.concurrency,
+            'latency': options.latency,
+            'fragment': options.fragment,
+            'failure_rate': options.failure_rate,
+            'drop_rate': options.drop_rate,
+            'body_size': options.body_size,
+            'settings': dict(options.settings),
+        }
+
+
+@defer.inlineCallbacks
+def run_scenario(scenario, seed=None):
+    from twisted.internet import reactor
+    from scrapy.http import Request
+    from scrapy.spiders import Spider
+    from scrapy.utils.test import get_crawler
+    from scrapy_socks.handlers import HTTPDownloadHandler
+
+    faults = FaultPlan(scenario['latency'], scenario['fragment'], scenario['failure_rate'],
+                       scenario['drop_rate'], seed=seed)
+    socks, socks_port = listen_socks(reactor, CREDENTIALS if scenario['auth'] else None, faults)
+    origin_port = listen_origin(reactor, tls=scenario['origin'] == 'https', body_size=scenario['body_size'])
+
+    settings = {'CONCURRENT_REQUESTS_PER_DOMAIN': scenario['concurrency'], 'LOG_ENABLED': False}
+    settings.update(scenario['settings'])
+    crawler = get_crawler(Spider, settings)
+    handler = HTTPDownloadHandler(crawler.settings, crawler)
+    spider = Spider('benchmark')
+
+    proxy = '%s://%s127.0.0.1:%d' % (scenario['scheme'], '%s:%s@' % CREDENTIALS if scenario['auth'] else '',
+                                     socks_port.getHost().port)
+    url = '%s://localhost:%d/' % (scenario['origin'], origin_port.getHost().port)
+    latencies = []
+    errors = Counter()
+    pending = iter(range(scenario['requests']))
+
+    @defer.inlineCallbacks
+    def worker():
+        for i in pending:
+            request = Request('%s%d' % (url, i), meta={'proxy': proxy, 'download_timeout': 30})
+            start = time.perf_counter()
+            try:
+                yield handler.download_request(request, spider)
+            except Exception as e:
+                errors[type(e).__name__] += 1
+            else:
+                latencies.append(time.perf_counter() - start)
+
+    cpu, wall = time.process_time(), time.perf_counter()
+    yield defer.DeferredList([worker() for _ in range(scenario['concurrency'])])
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+
+    yield handler.close()
+    yield socks_port.stopListening()
+    yield origin_port.stopListening()
+    # Let the closed connections go away before the next scenario
+    yield task.deferLater(reactor, 0.1, lambda: None)
+
+    done = len(latencies)
+    defer.returnValue({
+        'scenario': scenario,
+        'completed': done,
+        'errors': dict(errors),
+        'duration_s': round(wall, 4),
+        'requests_per_s': round(done / wall, 2) if wall else None,
+        'latency_ms': {'p50': _ms(percentile(latencies, 50)), 'p90': _ms(percentile(latencies, 90)),
+                       'p99': _ms(percentile(latencies, 99)), 'max': _ms(max(latencies) if latencies else None)},
+        'tunnels_per_request': round(socks.connections / float(scenario['requests']), 4),
+        'cpu_ms_per_request': round(cpu * 1000 / scenario['requests'], 4),
+        'injected': {'failed': socks.failed, 'dropped': socks.dropped},
+        'stats': {k: v for k, v in crawler.stats.get_stats().items() if k.startswith('socks/')},
+    })
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def environment():
+    import scrapy
+    import twisted
+    from twisted.internet import reactor
+    return {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'twisted': twisted.__version__,
+        'scrapy': scrapy.__version__,
+        'platform': platform.platform(),
+        'reactor': '%s.%s' % (type(reactor).__module__, type(reactor).__name__),
+    }
+
+
+@defer.inlineCallbacks
+def run(options):
+    results = []
+    for scenario in scenarios(options):
+        for _ in range(options.warmup_rounds):
+            yield run_scenario(dict(scenario, requests=min(scenario['requests'], 100)), options.seed)
+        result = yield run_scenario(scenario, options.seed)
+        results.append(result)
+        sys.stderr.write('%(scheme)s %(origin)s auth=%(auth)s: ' % scenario +
+                         '%(requests_per_s)s req/s, p50 %(p50)s ms, p99 %(p99)s ms\n' % dict(
+                             result, **result['latency_ms']))
+    output = json.dumps({'environment': environment(), 'results': results}, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    csv = lambda value: [v for v in value.split(',') if v]
+    parser.add_argument('--schemes', type=csv, default=list(SCHEMES),
+                        help='comma separated proxy schemes (default: all)')
+    parser.add_argument('--origins', type=csv, default=['http', 'https'], help='http, https or both')
+    parser.add_argument('--auth', choices=('none', 'login', 'both'), default='both',
+                        help='SOCKS5 username/password authentication')
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0, help='seconds every handshake reply is held back')
+    parser.add_argument('--fragment', type=int, default=0, help='write handshake replies N bytes at a time')
+    parser.add_argument('--failure-rate', type=float, default=0, help='share of CONNECTs answered with a failure')
+    parser.add_argument('--drop-rate', type=float, default=0, help='share of CONNECTs answered by closing')
+    parser.add_argument('--body-size', type=int, default=1024)
+    parser.add_argument('--set', dest='settings', action='append', default=[],
+                        type=lambda value: tuple(value.split('=', 1)), metavar='NAME=VALUE',
+                        help='handler setting, may be repeated')
+    parser.add_argument('--reactor', choices=('default', 'asyncio'), default='default',
+                        help='asyncio installs AsyncioSelectorReactor, needed by SOCKS_CONNECTOR=asyncio')
+    parser.add_argument('--warmup-rounds', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=None, help='seed for the injected failures')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    options = parser.parse_args(argv)
+    unknown = set(options.schemes) - set(SCHEMES)
+    if unknown:
+        parser.error('unknown schemes: %s' % ', '.join(sorted(unknown)))
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    if options.reactor == 'asyncio':
+        from scrapy.utils.reactor import install_reactor
+        install_reactor('twisted.internet.asyncioreactor.AsyncioSelectorReactor')
+    from twisted.internet import reactor
+    failures = []
+
+    def stop(result):
+        if isinstance(result, Failure):
+            failures.append(result)
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: run(options).addBoth(stop))
+    reactor.run()
+    if failures:
+        failures[0].raiseException()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+"""Microbenchmarks of what a single tunnel costs the client.
+
+Drives the SOCKS client protocols through complete handshakes against
+in-memory transports and canned server replies, so nothing but the
+protocol code is measured. Reports, per case:
+
+* ``per_s`` -- operations per second of CPU time on one core (best round)
+* ``cpu_us`` -- CPU microseconds per operation
+* ``retained_bytes`` -- memory still held per operation while the
+  protocols, transports and relayed protocols are kept alive, as a live
+  tunnel would
+* ``peak_bytes`` -- peak extra memory during a single operation
+
+The ``idle_tunnel`` cases connect through SOCKSWrapper and keep only what
+the reactor would keep of an established, idle tunnel (its transport and
+connector), so their ``retained_bytes`` is the client's memory per open
+tunnel.
+
+Memory is measured with tracemalloc in separate runs from the timings.
+
+    python -m benchmarks.micro --rounds 5 --number 20000 --output micro.json
+"""
+
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+
+from twisted.internet import defer
+from twisted.internet.address import IPv4Address
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+from twisted.python.failure import Failure
+
+from benchmarks.e2e import environment
+from scrapy_socks.client_factory import SOCKSClientFactory
+from scrapy_socks.config import parse_proxy
+from scrapy_socks.endpoint import SOCKSWrapper
+from scrapy_socks.stats import HandshakeStats
+from scrapy_socks.handshake import encode_host
+from scrapy_socks.tls import TLSWrapClientEndpoint, TLSSessionCache
+
+
+DESTINATIONS = {
+    'hostname': 'www.example.com',
+    'ipv4': '93.184.216.34',
+    'ipv6': '2606:2800:220:1:248:1893:25c8:1946',
+}
+
+# version -> destinations it can carry without local resolution
+SUPPORTED = {
+    '4': ('ipv4',),
+    '4a': ('hostname', 'ipv4'),
+    '5h': ('hostname', 'ipv4', 'ipv6'),
+}
+
+SOCKS5_REPLY = b'\x05\x00\x00\x01\x7f\x00\x00\x01\x1f\x90'
+SOCKS4_REPLY = b'\x00\x5a\x00\x00\x00\x00\x00\x00'
+
+
+class FakeEndpoint(object):
+    """Stands in for the destination endpoint the SOCKS protocol reads its host and port from."""
+
+    def __init__(self, host, port):
+        self._host = host
+        self._port = port
+
+
+class ImmediateEndpoint(object):
+    """An endpoint whose connections are established at once, over a StringTransport."""
+
+    _host = 'proxy.invalid'
+    _port = 1080
+
+    def connect(self, factory):
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        return defer.succeed(protocol)
+
+
+class TunnelReactor(Clock):
+    """Connects at once over StringTransports, which keep their connector like a real TCP client does."""
+
+    def connectTCP(self, host, port, factory, timeout=30, bindAddress=None):
+        connector = Connector(factory)
+        protocol = factory.buildProtocol(IPv4Address('TCP', host, port))
+        transport = connector.transport = StringTransport()
+        transport.connector = connector
+        transport.protocol = protocol
+        protocol.makeConnection(transport)
+        self.transport = transport
+        return connector
+
+
+class Connector(object):
+    def __init__(self, factory):
+        self.factory = factory
+        self.transport = None
+
+
+class NullStats(object):
+    def inc_value(self, key, count=1, start=0):
+        pass
+
+    def set_value(self, key, value):
+        pass
+
+
+def proxy_config(version, auth):
+    scheme = {'4': 'socks4', '4a': 'socks4a', '5h': 'socks5h'}[version]
+    credentials = 'user:secret@' if auth else ''
+    return parse_proxy('%s://%sproxy.invalid:1080' % (scheme, credentials))
+
+
+def socks_factory(config, host, clock):
+    factory = SOCKSClientFactory(config)
+    factory.postHandshakeEndpoint = FakeEndpoint(host, 443)
+    factory.postHandshakeFactory = Factory.forProtocol(Protocol)
+    factory._timestamps = None
+    factory._timer = None
+    factory._reactor = clock
+    factory.handshakeTimeout = None
+    return factory
+
+
+def server_replies(config):
+    if config.version in ('4', '4a'):
+        return [SOCKS4_REPLY]
+    if config.auth_request:
+        return [b'\x05\x02', b'\x01\x00', SOCKS5_REPLY]
+    return [b'\x05\x00', SOCKS5_REPLY]
+
+
+def handshake_case(config, host, cold):
+    clock = Clock()
+    replies = server_replies(config)
+
+    def handshake():
+        if cold:
+            encode_host.cache_clear()
+        factory = socks_factory(config, host, clock)
+        factory.handshakeDone = d = defer.Deferred()
+        protocol = factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        for reply in replies:
+            protocol.dataReceived(reply)
+        assert d.called
+        return protocol, transport
+
+    return handshake
+
+
+def idle_tunnel_case(config, stats):
+    reactor = TunnelReactor()
+    replies = server_replies(config)
+    relayed = Factory.forProtocol(Protocol)
+    handshake_stats = HandshakeStats(NullStats()) if stats else None
+    destination = DESTINATIONS['hostname' if config.version != '4' else 'ipv4']
+
+    def tunnel():
+        endpoint = SOCKSWrapper(reactor, FakeEndpoint(destination, 443), config,
+                                stats=handshake_stats, transferStats=handshake_stats)
+        d = endpoint.connect(relayed)
+        transport = reactor.transport
+        for reply in replies:
+            transport.protocol.dataReceived(reply)
+        assert d.called and not isinstance(d.result, Failure)
+        return transport
+
+    return tunnel
+
+
+def build_protocol_case(config):
+    clock = Clock()
+    factory = socks_factory(config, DESTINATIONS['hostname'], clock)
+
+    def build():
+        factory.handshakeDone = defer.Deferred()
+        return factory.buildProtocol(None)
+
+    return build
+
+
+def tls_setup_case(session_cache):
+    from scrapy.core.downloader.contextfactory import ScrapyClientContextFactory
+    policy = ScrapyClientContextFactory()
+    factory = Factory.forProtocol(Protocol)
+    cache = TLSSessionCache() if session_cache else None
+
+    def setup():
+        # Up to the ClientHello being written
+        creator = policy.creatorForNetloc(b'www.example.com', 443)
+        endpoint = TLSWrapClientEndpoint(creator, ImmediateEndpoint(), sessionCache=cache,
+                                         netloc=(b'www.example.com', 443))
+        return endpoint.connect(factory)
+
+    return setup
+
+
+def cases(options):
+    for version, destinations in sorted(SUPPORTED.items()):
+        for auth in ((False, True) if version == '5h' else (False,)):
+            config = proxy_config(version, auth)
+            for destination in destinations:
+                yield ('handshake', {'version': version, 'auth': auth, 'destination': destination,
+                                     'host_cache': not options.cold},
+                       handshake_case(config, DESTINATIONS[destination], options.cold))
+    for version in ('4', '5h'):
+        for stats in (False, True):
+            yield ('idle_tunnel', {'version': version, 'stats': stats},
+                   idle_tunnel_case(proxy_config(version, False), stats))
+    for version in sorted(SUPPORTED):
+        yield 'build_protocol', {'version': version}, build_protocol_case(proxy_config(version, False))
+    for session_cache in (False, True):
+        yield 'tls_setup', {'session_cache': session_cache}, tls_setup_case(session_cache)
+
+
+def measure(operation, rounds, number):
+    # Warm up caches and lazily created state first
+    for _ in range(min(number, 100)):
+        operation()
+    best = None
+    for _ in range(rounds):
+        start = time.process_time()
+        for _ in range(number):
+            operation()
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        operation()
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+
+        keep = []
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        samples = min(number, 1000)
+        for _ in range(samples):
+            keep.append(operation())
+        retained = (tracemalloc.get_traced_memory()[0] - before) / float(samples)
+        del keep
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'per_s': round(number / best, 1) if best else None,
+        'cpu_us': round(best * 1e6 / number, 3),
+        'retained_bytes': round(retained, 1),
+        'peak_bytes': peak,
+    }
+
+
+def run(options):
+    results = []
+    for name, params, operation in cases(options):
+        result = dict(case=name, params=params, **measure(operation, options.rounds, options.number))
+        results.append(result)
+        sys.stderr.write('%-15s %-70s %10.1f/s %8.2f us %8.0f B retained\n' % (
+            name, json.dumps(params, sort_keys=True), result['per_s'], result['cpu_us'], result['retained_bytes']))
+    return {'environment': environment(), 'rounds': options.rounds, 'number': options.number,
+            'results': results}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=5, help='timing rounds, the best one is reported')
+    parser.add_argument('--number', type=int, default=10000, help='operations per round')
+    parser.add_argument('--cold', action='store_true',
+                        help='clear the destination encoding cache before every handshake')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    output = json.dumps(run(options), indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,326 @@
+"""In-process stand-ins for SOCKS proxies and HTTP(S) origins.
+
+They implement just enough of SOCKS4, SOCKS4a and SOCKS5 (no auth or
+username/password) to carry HTTP through a CONNECT, and can slow down,
+fragment or fail their handshake replies on purpose.
+"""
+
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from collections import deque
+import datetime
+import random
+import socket
+import struct
+
+from twisted.internet import protocol, ssl
+from twisted.web import resource, server
+
+
+class FaultPlan(object):
+    """How a SOCKSServerFactory misbehaves during handshakes.
+
+    :param latency: seconds every handshake reply is held back.
+    :param fragment: if set, replies are written this many bytes at a time,
+        one write per reactor iteration.
+    :param failure_rate: share of CONNECT requests answered with a failure reply.
+    :param drop_rate: share of handshakes whose connection is closed instead
+        of answering the CONNECT request.
+    """
+
+    def __init__(self, latency=0, fragment=0, failure_rate=0, drop_rate=0, seed=None):
+        self.latency = latency
+        self.fragment = fragment
+        self.failure_rate = failure_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+
+    def outcome(self):
+        roll = self.random.random()
+        if roll < self.drop_rate:
+            return 'drop'
+        if roll < self.drop_rate + self.failure_rate:
+            return 'fail'
+        return 'ok'
+
+
+class _Upstream(protocol.Protocol):
+    def __init__(self, downstream):
+        self.downstream = downstream
+
+    def connectionMade(self):
+        self.downstream.upstreamConnected(self)
+
+    def dataReceived(self, data):
+        self.downstream.transport.write(data)
+
+    def connectionLost(self, reason):
+        self.downstream.transport.loseConnection()
+
+
+class _UpstreamFactory(protocol.ClientFactory):
+    noisy = False
+
+    def __init__(self, downstream):
+        self.downstream = downstream
+
+    def buildProtocol(self, addr):
+        return _Upstream(self.downstream)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.downstream.upstreamFailed()
+
+
+class SOCKSServerProtocol(protocol.Protocol):
+    def connectionMade(self):
+        self.factory.connections += 1
+        self.buf = b''
+        self.state = 'greeting'
+        self.version = None
+        self.upstream = None
+        self._outbox = deque()
+        self._flushing = False
+
+    def dataReceived(self, data):
+        if self.state == 'relay':
+            self.upstream.transport.write(data)
+            return
+        self.buf += data
+        while self.state not in ('connecting', 'relay', 'closing', 'closed'):
+            if not getattr(self, 'read_' + self.state)():
+                return
+
+    def read_greeting(self):
+        if not self.buf:
+            return False
+        if self.buf[:1] == b'\x04':
+            self.version = 4
+            self.state = 'socks4_request'
+            return True
+        if len(self.buf) < 2 or len(self.buf) < 2 + self.buf[1]:
+            return False
+        self.version = 5
+        methods, self.buf = self.buf[2:2 + self.buf[1]], self.buf[2 + self.buf[1]:]
+        method = 0x02 if self.factory.credentials else 0x00
+        if method not in methods:
+            self.send(b'\x05\xff')
+            self.close()
+            return False
+        self.send(struct.pack('!BB', 5, method))
+        self.state = 'auth' if method == 0x02 else 'socks5_request'
+        return True
+
+    def read_auth(self):
+        if len(self.buf) < 2:
+            return False
+        ulen = self.buf[1]
+        if len(self.buf) < 3 + ulen:
+            return False
+        plen = self.buf[2 + ulen]
+        if len(self.buf) < 3 + ulen + plen:
+            return False
+        credentials = (self.buf[2:2 + ulen], self.buf[3 + ulen:3 + ulen + plen])
+        self.buf = self.buf[3 + ulen + plen:]
+        if credentials != self.factory.credentials:
+            self.send(b'\x01\x01')
+            self.close()
+            return False
+        self.send(b'\x01\x00')
+        self.state = 'socks5_request'
+        return True
+
+    def read_socks5_request(self):
+        if len(self.buf) < 5:
+            return False
+        atyp = self.buf[3]
+        if atyp == 0x01:
+            start, end = 4, 8
+        elif atyp == 0x04:
+            start, end = 4, 20
+        else:
+            start, end = 5, 5 + self.buf[4]
+        if len(self.buf) < end + 2:
+            return False
+        address = self.buf[start:end]
+        if atyp == 0x01:
+            host = socket.inet_ntop(socket.AF_INET, address)
+        elif atyp == 0x04:
+            host = socket.inet_ntop(socket.AF_INET6, address)
+        else:
+            host = address.decode('ascii')
+        port = struct.unpack('!H', self.buf[end:end + 2])[0]
+        self.buf = self.buf[end + 2:]
+        self.request(host, port)
+        return False
+
+    def read_socks4_request(self):
+        end = self.buf.find(b'\x00', 8)
+        if end < 0:
+            return False
+        port = struct.unpack('!H', self.buf[2:4])[0]
+        address, rest = self.buf[4:8], self.buf[end + 1:]
+        if address[:3] == b'\x00\x00\x00' and address[3]:
+            # SOCKS4a, the hostname follows the user id
+            name_end = rest.find(b'\x00')
+            if name_end < 0:
+                return False
+            host, self.buf = rest[:name_end].decode('ascii'), rest[name_end + 1:]
+        else:
+            host, self.buf = socket.inet_ntop(socket.AF_INET, address), rest
+        self.request(host, port)
+        return False
+
+    def request(self, host, port):
+        self.state = 'connecting'
+        outcome = self.factory.faults.outcome()
+        if outcome == 'drop':
+            self.factory.dropped += 1
+            self.close()
+        elif outcome == 'fail':
+            self.factory.failed += 1
+            self.reply(False)
+            self.close()
+        else:
+            self.factory.reactor.connectTCP(host, port, _UpstreamFactory(self), timeout=5)
+
+    def upstreamConnected(self, upstream):
+        if self.state in ('closing', 'closed'):
+            upstream.transport.loseConnection()
+            return
+        self.upstream = upstream
+        self.reply(True)
+        self.state = 'relay'
+        if self.buf:
+            # Pipelined after the request
+            upstream.transport.write(self.buf)
+            self.buf = b''
+
+    def upstreamFailed(self):
+        self.reply(False)
+        self.close()
+
+    def reply(self, ok):
+        if self.version == 4:
+            self.send(b'\x00' + (b'\x5a' if ok else b'\x5b') + b'\x00' * 6)
+        else:
+            self.send(b'\x05' + (b'\x00' if ok else b'\x01') + b'\x00\x01' + b'\x00' * 6)
+
+    def send(self, data):
+        size = self.factory.faults.fragment or len(data)
+        chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        # Only the first chunk of a reply is held back by the latency
+        self._outbox.append((self.factory.faults.latency, chunks[0]))
+        self._outbox.extend((0, chunk) for chunk in chunks[1:])
+        if not self._flushing:
+            self._flush()
+
+    def _flush(self):
+        if not self._outbox:
+            self._flushing = False
+            if self.state == 'closing':
+                self.state = 'closed'
+                self.transport.loseConnection()
+            return
+        self._flushing = True
+        delay, chunk = self._outbox[0]
+        if delay or self.factory.faults.fragment:
+            self.factory.reactor.callLater(delay, self._writeNext)
+        else:
+            self._writeNext()
+
+    def _writeNext(self):
+        _, chunk = self._outbox.popleft()
+        if self.transport.connected:
+            self.transport.write(chunk)
+        self._flush()
+
+    def close(self):
+        # After whatever replies are still queued
+        self.state = 'closing' if self._flushing else 'closed'
+        if not self._flushing:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.state = 'closed'
+        if self.upstream is not None:
+            self.upstream.transport.loseConnection()
+
+
+class SOCKSServerFactory(protocol.Factory):
+    """A SOCKS4/4a/5 server relaying CONNECT requests, with counters.
+
+    :param credentials: ``(username, password)`` the SOCKS5 clients must
+        authenticate with, or None for no authentication.
+    :param faults: A FaultPlan.
+    """
+    protocol = SOCKSServerProtocol
+    noisy = False
+
+    def __init__(self, credentials=None, faults=None, reactor=None):
+        self.credentials = tuple(c.encode() for c in credentials) if credentials else None
+        self.faults = faults or FaultPlan()
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.reset()
+
+    def reset(self):
+        self.connections = 0
+        self.failed = 0
+        self.dropped = 0
+
+
+class Origin(resource.Resource):
+    """Answers every GET with ``body_size`` bytes."""
+    isLeaf = True
+
+    def __init__(self, body_size=1024):
+        resource.Resource.__init__(self)
+        self.body = b'x' * body_size
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'application/octet-stream')
+        return self.body
+
+
+def self_signed_certificate(hostname='localhost'):
+    """Return a PrivateCertificate for ``hostname``, valid for a day."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+    now = datetime.datetime.utcnow()
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name).issuer_name(name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(hours=1))
+                   .not_valid_after(now + datetime.timedelta(days=1))
+                   .add_extension(x509.SubjectAlternativeName([x509.DNSName(hostname)]), critical=False)
+                   .sign(key, hashes.SHA256()))
+    pem = (key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                             serialization.NoEncryption()) +
+           certificate.public_bytes(serialization.Encoding.PEM))
+    return ssl.PrivateCertificate.loadPEM(pem)
+
+
+def listen_origin(reactor, tls=False, body_size=1024, interface='127.0.0.1'):
+    """Start an origin and return its listening port."""
+    site = server.Site(Origin(body_size))
+    site.noisy = False
+    if tls:
+        certificate = self_signed_certificate()
+        options = ssl.CertificateOptions(privateKey=certificate.privateKey.original,
+                                         certificate=certificate.original,
+                                         enableSessionTickets=True)
+        return reactor.listenSSL(0, site, options, interface=interface)
+    return reactor.listenTCP(0, site, interface=interface)
+
+
+def listen_socks(reactor, credentials=None, faults=None, interface='127.0.0.1'):
+    """Start a SOCKS server and return ``(factory, listening port)``."""
+    factory = SOCKSServerFactory(credentials, faults, reactor)
+    return factory, reactor.listenTCP(0, factory, interface=interface)
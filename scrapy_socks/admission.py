@@ -0,0 +1,149 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from collections import deque
+from twisted.internet import defer
+from twisted.web.client import HTTPConnectionPool
+
+
+class ProxySlots(object):
+    """Tunnels and handshakes in use on a single proxy, and the connects waiting for them."""
+    __slots__ = ('proxy_config', 'tunnels', 'handshakes', 'queue', 'max_depth')
+
+    def __init__(self, proxy_config):
+        # The config they were first taken with, for the stats labels
+        self.proxy_config = proxy_config
+        # Open tunnels, including those still in their handshake
+        self.tunnels = 0
+        self.handshakes = 0
+        # (deferred, enqueued at) in arrival order
+        self.queue = deque()
+        self.max_depth = 0
+
+
+class AdmissionControl(object):
+    """Per-proxy limits on open tunnels and on SOCKS handshakes in progress.
+
+    A connect is admitted right away if its proxy is below both limits and
+    nobody is queued for it yet, otherwise it waits in a FIFO queue until a
+    handshake finishes or a tunnel closes. A limit of 0 means unlimited.
+    Proxies are told apart by address: all the credentials of a proxy (see
+    StreamIsolation) share its limits. A proxy is forgotten once it has
+    nothing open and nobody waiting.
+
+    When a connect has to wait for a tunnel, ``evictIdle`` (if given) is
+    called with the proxy config so an idle pooled tunnel can be closed to
+    make room, instead of waiting for it to time out.
+
+    :param stats: A HandshakeStats receiving the queue depth and the time
+        spent waiting, per proxy.
+    """
+
+    def __init__(self, reactor, maxTunnels=0, maxHandshakes=0, stats=None, evictIdle=None):
+        self._reactor = reactor
+        self.maxTunnels = maxTunnels
+        self.maxHandshakes = maxHandshakes
+        self.stats = stats
+        self._evictIdle = evictIdle
+        # (host, port) -> ProxySlots
+        self._slots = {}
+
+    def slots(self, proxy_config):
+        slots = self._slots.get(proxy_config.address)
+        if slots is None:
+            slots = self._slots[proxy_config.address] = ProxySlots(proxy_config)
+        return slots
+
+    def depth(self, proxy_config):
+        """Return the number of connects waiting for the proxy of ``proxy_config``."""
+        slots = self._slots.get(proxy_config.address)
+        return len(slots.queue) if slots is not None else 0
+
+    def acquire(self, proxy_config):
+        """Return a deferred firing once a tunnel and a handshake slot are taken for ``proxy_config``.
+
+        Cancelling it while queued gives up the place in the queue. Once it
+        fired, ``handshakeFinished`` and ``tunnelClosed`` must be called.
+        """
+        slots = self.slots(proxy_config)
+        if not slots.queue and self._admissible(slots):
+            self._admit(slots, self._reactor.seconds())
+            return defer.succeed(None)
+
+        entry = []
+        d = defer.Deferred(lambda d: self._dequeue(slots, entry))
+        entry[:] = (d, self._reactor.seconds())
+        slots.queue.append(entry)
+        slots.max_depth = max(slots.max_depth, len(slots.queue))
+        self._recordDepth(slots)
+        if self._evictIdle is not None and self.maxTunnels and slots.tunnels >= self.maxTunnels:
+            self._evictIdle(proxy_config)
+        return d
+
+    def handshakeFinished(self, proxy_config):
+        slots = self._slots[proxy_config.address]
+        slots.handshakes -= 1
+        self._drain(slots)
+
+    def tunnelClosed(self, proxy_config):
+        slots = self._slots[proxy_config.address]
+        slots.tunnels -= 1
+        self._drain(slots)
+
+    def _admissible(self, slots):
+        return ((not self.maxTunnels or slots.tunnels < self.maxTunnels) and
+                (not self.maxHandshakes or slots.handshakes < self.maxHandshakes))
+
+    def _admit(self, slots, enqueued):
+        slots.tunnels += 1
+        slots.handshakes += 1
+        if self.stats is not None:
+            self.stats.record_wait(slots.proxy_config, self._reactor.seconds() - enqueued)
+
+    def _drain(self, slots):
+        # Admitting may run a connect that fails right away and re-enters
+        # here, so the queue is always updated before firing.
+        while slots.queue and self._admissible(slots):
+            d, enqueued = slots.queue.popleft()
+            self._admit(slots, enqueued)
+            self._recordDepth(slots)
+            d.callback(None)
+        self._forgetIdle(slots)
+
+    def _dequeue(self, slots, entry):
+        try:
+            slots.queue.remove(entry)
+        except ValueError:
+            return
+        self._recordDepth(slots)
+        self._forgetIdle(slots)
+
+    def _forgetIdle(self, slots):
+        if slots.tunnels or slots.handshakes or slots.queue:
+            return
+        address = slots.proxy_config.address
+        # A connect fired by _drain may already have replaced them
+        if self._slots.get(address) is slots:
+            del self._slots[address]
+
+    def _recordDepth(self, slots):
+        if self.stats is not None:
+            self.stats.record_queue(slots.proxy_config, len(slots.queue), slots.max_depth)
+
+
+class AdmissionConnectionPool(HTTPConnectionPool):
+    """Connection pool of a single proxy that doesn't keep tunnels idle while connects wait for one.
+
+    Otherwise connects queued on the tunnel limit could wait for the idle
+    timeout of connections they can't use.
+    """
+
+    def __init__(self, reactor, admission, proxy_config, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.admission = admission
+        self.proxy_config = proxy_config
+
+    def _putConnection(self, key, connection):
+        if self.admission.depth(self.proxy_config):
+            connection.transport.loseConnection()
+            return
+        HTTPConnectionPool._putConnection(self, key, connection)
@@ -13,22 +13,35 @@ from zope.interface import implementer
 import struct
 import socket
 import re
+from scrapy_socks.endpoint import SOCKSWrapper, RacingSOCKSWrapper
+from scrapy_socks.tls import TLSWrapClientEndpoint
 
 @implementer(IAgentEndpointFactory, IAgent)
 class ProxyAgent(object):
     _tlsWrapper = TLSWrapClientEndpoint
     endpointFactory = SOCKSWrapper
+    racingEndpointFactory = RacingSOCKSWrapper
 
     def __init__(self, reactor,
-                 proxy_scheme,
-                 proxy_host,
-                 proxy_port,
-                 proxy_username=None,
-                 proxy_password=None,
+                 proxy_config,
                  contextFactory=BrowserLikePolicyForHTTPS(),
                  connectTimeout=None,
                  bindAddress=None,
-                 pool=None):
+                 pool=None,
+                 pipeline=False,
+                 stats=None,
+                 timestamps=None,
+                 handshakeTimeout=None,
+                 tlsTimeout=None,
+                 raceConfigs=(),
+                 raceStagger=0.25,
+                 raceFanout=2,
+                 sessionCache=None,
+                 admission=None,
+                 resolver=None,
+                 transferStats=None,
+                 replyCache=None,
+                 pipelineRejections=None):
         if not IPolicyForHTTPS.providedBy(contextFactory):
             raise NotImplementedError('contextFactory must implement IPolicyForHTTPS')
         self._policyForHTTPS = contextFactory
@@ -36,11 +49,22 @@ class ProxyAgent(object):
         self._bindAddress = bindAddress
         self._connectTimeout = connectTimeout
         self.reactor = reactor
-        self.proxy_scheme = proxy_scheme
-        self.proxy_host = proxy_host
-        self.proxy_port = proxy_port
-        self.proxy_username = proxy_username
-        self.proxy_password = proxy_password
+        self.proxy_config = proxy_config
+        self._pipeline = pipeline
+        self._stats = stats
+        self._timestamps = timestamps
+        self._handshakeTimeout = handshakeTimeout
+        self._tlsTimeout = tlsTimeout
+        # Alternative proxies to race the handshake against, see RacingSOCKSWrapper
+        self._raceConfigs = raceConfigs
+        self._raceStagger = raceStagger
+        self._raceFanout = raceFanout
+        self._sessionCache = sessionCache
+        self._admission = admission
+        self._resolver = resolver
+        self._transferStats = transferStats
+        self._replyCache = replyCache
+        self._pipelineRejections = pipelineRejections
 
     def request(self, *a, **kw):
         return self._wrappedAgent.request(*a, **kw)
@@ -53,8 +77,24 @@ class ProxyAgent(object):
                                       port=uri.port,
                                       bindAddress=self._bindAddress,
                                       timeout=self._connectTimeout)
-        factory = self.endpointFactory(self.reactor, endpoint, self.proxy_config)
+        if self._raceConfigs:
+            timestamps = (lambda: {}) if self._timestamps is not None else (lambda: None)
+            endpoints = [self._socksEndpoint(endpoint, proxy_config, timestamps())
+                         for proxy_config in (self.proxy_config,) + tuple(self._raceConfigs)]
+            factory = self.racingEndpointFactory(self.reactor, endpoints, stagger=self._raceStagger,
+                                                 fanout=self._raceFanout, timestamps=self._timestamps)
+        else:
+            factory = self._socksEndpoint(endpoint, self.proxy_config, self._timestamps)
         if uri.scheme == b'https':
             tlsPolicy = self._policyForHTTPS.creatorForNetloc(uri.host, uri.port)
-            factory = self._tlsWrapper(tlsPolicy, factory)
+            factory = self._tlsWrapper(tlsPolicy, factory, reactor=self.reactor, timeout=self._tlsTimeout,
+                                       sessionCache=self._sessionCache, netloc=(uri.host, uri.port))
         return factory
+
+    def _socksEndpoint(self, endpoint, proxy_config, timestamps):
+        return self.endpointFactory(self.reactor, endpoint, proxy_config,
+                                    timestamps=timestamps, pipeline=self._pipeline, stats=self._stats,
+                                    connectTimeout=self._connectTimeout, handshakeTimeout=self._handshakeTimeout,
+                                    admission=self._admission, resolver=self._resolver,
+                                    transferStats=self._transferStats, replyCache=self._replyCache,
+                                    pipelineRejections=self._pipelineRejections)
@@ -0,0 +1,404 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+import asyncio
+import ssl
+
+from OpenSSL import crypto
+from twisted.internet import defer, error
+from twisted.internet.address import IPv4Address, IPv6Address
+from twisted.internet.interfaces import IStreamClientEndpoint, ITransport, IConsumer, IPushProducer, IReactorTime
+from twisted.python.failure import Failure
+from twisted.web.client import SchemeNotSupported
+from zope.interface import implementer
+
+from scrapy_socks.agent import ProxyAgent
+from scrapy_socks.exceptions import SOCKSError, SOCKSTimeoutError, SOCKSProxyLookupError, SOCKSReplyError
+from scrapy_socks.handshake import ReceiveBuffer, encode_host, read_socks5_method_reply, read_socks5_auth_reply, \
+    read_socks5_reply, read_socks4_reply, socks5_connect_request, socks4_connect_request, ATYP_IPV4, ATYP_DOMAINNAME
+from scrapy_socks.protocol import SOCKSv5ClientProtocol, SOCKSv4ClientProtocol
+
+
+TLS_VERSIONS = {
+    'TLSv1.0': ssl.TLSVersion.TLSv1,
+    'TLSv1.1': ssl.TLSVersion.TLSv1_1,
+    'TLSv1.2': ssl.TLSVersion.TLSv1_2,
+}
+
+
+def ssl_context_from_settings(settings):
+    """Return an ``ssl.SSLContext`` matching Scrapy's default client TLS settings.
+
+    Like ScrapyClientContextFactory it doesn't verify certificates, and
+    honours DOWNLOADER_CLIENT_TLS_METHOD and DOWNLOADER_CLIENT_TLS_CIPHERS.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    method = settings.get('DOWNLOADER_CLIENT_TLS_METHOD', 'TLS')
+    if method in TLS_VERSIONS:
+        context.minimum_version = context.maximum_version = TLS_VERSIONS[method]
+    elif method != 'TLS':
+        raise ValueError('DOWNLOADER_CLIENT_TLS_METHOD %r is not supported by the asyncio connector' % method)
+    ciphers = settings.get('DOWNLOADER_CLIENT_TLS_CIPHERS')
+    if ciphers and ciphers != 'DEFAULT':
+        context.set_ciphers(ciphers)
+    context.set_alpn_protocols(['http/1.1'])
+    return context
+
+
+@implementer(ITransport, IConsumer, IPushProducer)
+class AsyncioTransport(asyncio.Protocol):
+    """Presents an asyncio transport to a Twisted protocol.
+
+    It is the asyncio protocol of the tunnel, and the Twisted transport of
+    the relayed protocol: data, flow control and disconnects are passed
+    across both ways.
+    """
+
+    def __init__(self, writer, closed=None, meter=None):
+        # The StreamWriter closes the socket when garbage collected, so it must live as long as the tunnel
+        self._writer = writer
+        self._meter = meter
+        self.transport = None
+        self.protocol = None
+        self.connected = False
+        self.disconnecting = False
+        self.producer = None
+        self._closed = closed
+
+    # asyncio side
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connected = True
+
+    def data_received(self, data):
+        if self._meter is not None:
+            self._meter.received(len(data))
+        self.protocol.dataReceived(data)
+
+    def eof_received(self):
+        # Close, Twisted protocols don't expect half-closed connections
+        return False
+
+    def connection_lost(self, exc):
+        self.connected = False
+        if self._meter is not None:
+            self._meter.flush()
+        if exc is None:
+            reason = Failure(error.ConnectionDone())
+        else:
+            reason = Failure(error.ConnectionLost(str(exc)))
+        try:
+            self.protocol.connectionLost(reason)
+        finally:
+            if self._closed is not None:
+                self._closed(reason)
+
+    def pause_writing(self):
+        if self.producer is not None:
+            self.producer.pauseProducing()
+
+    def resume_writing(self):
+        if self.producer is not None:
+            self.producer.resumeProducing()
+
+    # Twisted side
+
+    def makeConnection(self, protocol):
+        self.protocol = protocol
+        protocol.makeConnection(self)
+
+    def write(self, data):
+        if not self.disconnecting:
+            if self._meter is not None:
+                self._meter.sent(len(data))
+            self.transport.write(data)
+
+    def writeSequence(self, data):
+        self.write(b''.join(data))
+
+    def loseConnection(self):
+        self.disconnecting = True
+        self.transport.close()
+
+    def abortConnection(self):
+        self.disconnecting = True
+        self.transport.abort()
+
+    def getPeer(self):
+        return self._address('peername')
+
+    def getHost(self):
+        return self._address('sockname')
+
+    def _address(self, name):
+        address = self.transport.get_extra_info(name)
+        if address is None:
+            return None
+        if ':' in address[0]:
+            return IPv6Address('TCP', address[0], address[1])
+        return IPv4Address('TCP', address[0], address[1])
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def pauseProducing(self):
+        self.transport.pause_reading()
+
+    def resumeProducing(self):
+        self.transport.resume_reading()
+
+    def stopProducing(self):
+        self.abortConnection()
+
+
+class AsyncioTLSTransport(AsyncioTransport):
+    def getPeerCertificate(self):
+        # For Scrapy's response.certificate
+        der = self.transport.get_extra_info('ssl_object').getpeercert(binary_form=True)
+        return crypto.load_certificate(crypto.FILETYPE_ASN1, der) if der else None
+
+
+@implementer(IStreamClientEndpoint)
+class AsyncioSOCKSEndpoint(object):
+    """Tunnels to ``host:port`` through a SOCKS proxy on the reactor's asyncio loop.
+
+    The SOCKS handshake runs on asyncio streams and TLS, if ``sslContext``
+    is given, is asyncio's own, instead of Twisted's memory BIO one. Only
+    the relayed protocol is Twisted's, on an AsyncioTransport. Needs the
+    asyncio reactor.
+    """
+
+    def __init__(self, reactor, proxy_config, host, port, sslContext=None, connectTimeout=None,
+                 handshakeTimeout=None, tlsTimeout=None, timestamps=None, stats=None, resolver=None,
+                 admission=None, transferStats=None, replyCache=None):
+        self._reactor = reactor
+        self._loop = reactor._asyncioEventloop
+        self._proxy_config = proxy_config
+        self._host = host
+        self._port = port
+        self._sslContext = sslContext
+        self._connectTimeout = connectTimeout
+        self._handshakeTimeout = handshakeTimeout
+        self._tlsTimeout = tlsTimeout
+        self._timer = IReactorTime(reactor)
+        self._timestamps = timestamps if timestamps is not None else ({} if stats is not None else None)
+        self._stats = stats
+        self._resolver = resolver
+        self._admission = admission
+        self._transferStats = transferStats
+        self._replyCache = replyCache
+
+    def noteTime(self, event):
+        if self._timestamps is not None:
+            self._timestamps[event] = self._timer.seconds()
+
+    def connect(self, protocolFactory):
+        return defer.Deferred.fromFuture(asyncio.ensure_future(self._connect(protocolFactory), loop=self._loop))
+
+    async def _connect(self, protocolFactory):
+        if self._replyCache is not None:
+            cached = self._replyCache.check(self._proxy_config, self._host, self._port)
+            if cached is not None:
+                raise cached
+        proxy_addresses = [self._proxy_config.host]
+        relay_host = self._host
+        if self._resolver is not None:
+            if _is_hostname(self._proxy_config.host):
+                try:
+                    proxy_addresses = await self._resolver.resolve(self._proxy_config.host).asFuture(self._loop)
+                except error.DNSLookupError as e:
+                    raise SOCKSProxyLookupError('Could not resolve proxy %s: %s' % (self._proxy_config.host, e))
+            if self._proxy_config.resolves_locally and _is_hostname(self._host):
+                addresses = await self._resolver.resolve(self._host).asFuture(self._loop)
+                if self._proxy_config.version == '4':
+                    addresses = [a for a in addresses if ':' not in a]
+                    if not addresses:
+                        raise error.DNSLookupError('%s: no IPv4 address for SOCKS4' % self._host)
+                relay_host = addresses[0]
+
+        if self._admission is not None:
+            await self._admission.acquire(self._proxy_config).asFuture(self._loop)
+        try:
+            result = await self._tunnel(protocolFactory, proxy_addresses, relay_host)
+        except SOCKSReplyError as e:
+            if self._replyCache is not None:
+                self._replyCache.put(self._proxy_config, self._host, self._port, e.reply)
+            if self._admission is not None:
+                self._admission.handshakeFinished(self._proxy_config)
+                self._admission.tunnelClosed(self._proxy_config)
+            raise
+        except BaseException:
+            if self._admission is not None:
+                self._admission.handshakeFinished(self._proxy_config)
+                self._admission.tunnelClosed(self._proxy_config)
+            raise
+        if self._admission is not None:
+            self._admission.handshakeFinished(self._proxy_config)
+        return result
+
+    async def _tunnel(self, protocolFactory, proxy_addresses, relay_host):
+        if self._timestamps is not None:
+            self._timestamps.clear()
+        self.noteTime('START')
+        writer = None
+        try:
+            reader, writer = await self._open(proxy_addresses)
+            self.noteTime('CONNECTED')
+            try:
+                leftover = await asyncio.wait_for(self._handshake(reader, writer, relay_host),
+                                                  self._handshakeTimeout or None)
+            except asyncio.TimeoutError:
+                raise SOCKSTimeoutError('SOCKS %s: Handshake not finished after %ss' % (
+                    self._proxy_config.version, self._handshakeTimeout))
+            self.noteTime('RESPONSE')
+            if self._stats is not None:
+                self._stats.record(self._proxy_config, self._timestamps)
+
+            closed = meter = None
+            if self._admission is not None:
+                closed = lambda reason: self._admission.tunnelClosed(self._proxy_config)
+            if self._transferStats is not None:
+                meter = self._transferStats.transfer_meter(self._proxy_config, self._timer.seconds)
+            if self._sslContext is not None:
+                bridge = AsyncioTLSTransport(writer, closed, meter)
+                transport = await self._loop.start_tls(writer.transport, bridge, self._sslContext,
+                                                       server_hostname=self._host,
+                                                       ssl_handshake_timeout=self._tlsTimeout or None)
+                bridge.connection_made(transport)
+            else:
+                bridge = AsyncioTransport(writer, closed, meter)
+                writer.transport.set_protocol(bridge)
+                bridge.connection_made(writer.transport)
+        except BaseException as e:
+            if writer is not None:
+                writer.transport.abort()
+            if self._stats is not None and not isinstance(e, asyncio.CancelledError):
+                self._stats.record_failure(self._proxy_config, Failure(e))
+            raise
+
+        protocol = protocolFactory.buildProtocol(bridge.getPeer())
+        bridge.makeConnection(protocol)
+        if leftover:
+            # Anything the proxy sent after its reply belongs to the relayed protocol
+            protocol.dataReceived(leftover)
+        return protocol
+
+    async def _open(self, addresses):
+        # Same fallback as SOCKSWrapper: only failing to reach an address moves on to the next
+        for i, address in enumerate(addresses):
+            try:
+                return await asyncio.wait_for(asyncio.open_connection(address, self._proxy_config.port),
+                                              self._connectTimeout or None)
+            except asyncio.TimeoutError:
+                failure = SOCKSTimeoutError('Connecting to proxy %s:%s timed out after %ss' % (
+                    self._proxy_config.host, self._proxy_config.port, self._connectTimeout))
+            except ConnectionRefusedError as e:
+                failure = error.ConnectionRefusedError(str(e))
+            except OSError as e:
+                failure = error.ConnectError(string=str(e))
+            if i == len(addresses) - 1:
+                raise failure
+
+    async def _handshake(self, reader, writer, relay_host):
+        """Run the SOCKS negotiation and return whatever was received after the proxy's reply."""
+        config = self._proxy_config
+        buf = ReceiveBuffer()
+
+        async def receive(read):
+            while True:
+                message = read(buf)
+                if message is not None:
+                    return message
+                data = await reader.read(65536)
+                if not data:
+                    raise self._error('Connection lost during handshake')
+                buf.feed(data)
+
+        address = encode_host(relay_host)
+        if config.version in ('4', '4a'):
+            allowed = (ATYP_IPV4, ATYP_DOMAINNAME) if config.version == '4a' else (ATYP_IPV4,)
+            if address is None or address.type not in allowed:
+                raise self._error('Not a valid IPv4 address%s.' % (' or hostname' if config.version == '4a' else ''))
+            writer.write(socks4_connect_request(address, self._port, config.userid))
+            self.noteTime('RELAY_REQUEST_SENT')
+            version, status, _, _ = await receive(read_socks4_reply)
+            if version != 0x0:
+                raise self._error('Expected 0 bytes')
+            if status != 0x5a:
+                raise self._error('Relay request failed. Reason=%s.' % SOCKSv4ClientProtocol.SOCKS4_ERRORS.get(
+                    status, 'Unknown error'), exception=SOCKSReplyError, reply=status)
+            return buf.drain()
+
+        if address is None:
+            raise self._error('Invalid host')
+        writer.write(config.greeting)
+        version, method = await receive(read_socks5_method_reply)
+        if version != 0x5:
+            raise self._error('expected 0x5 in authentication handshake.')
+        if method == 0x2 and config.auth_request:
+            writer.write(config.auth_request)
+            version, status = await receive(read_socks5_auth_reply)
+            if version != 0x1:
+                raise self._error('expected 0x01 in authentication check.')
+            if status != 0x0:
+                raise self._error('Authentication with %r failed in authentication check.' % config.username)
+        elif method != 0x0 or config.auth_required:
+            raise self._error('Invalid chosen auth method %d in authentication handshake.' % method)
+        self.noteTime('AUTHENTICATED')
+
+        writer.write(socks5_connect_request(address, self._port))
+        self.noteTime('RELAY_REQUEST_SENT')
+        version, reply, address_type, bound_address, _ = await receive(read_socks5_reply)
+        if version != 0x5:
+            raise self._error('Invalid version')
+        if reply == 0x5:
+            raise self._error('Connection refused', exception=error.ConnectionRefusedError, reply=reply)
+        if reply != 0x0:
+            raise self._error('Server reply indicates failure. Reason: %s' % SOCKSv5ClientProtocol.SOCKS5_ERRORS.get(
+                reply, 'Unknown error'), exception=SOCKSReplyError, reply=reply)
+        if bound_address is None:
+            raise self._error('Unknown address type %d in reply' % address_type)
+        return buf.drain()
+
+    def _error(self, errmsg, exception=SOCKSError, reply=None):
+        # Same messages and reply codes as the Twisted protocols
+        e = exception('SOCKS %s: %s' % (self._proxy_config.version, errmsg))
+        e.reply = reply
+        return e
+
+
+def _is_hostname(host):
+    address = encode_host(host)
+    return address is not None and address.type == ATYP_DOMAINNAME
+
+
+class AsyncioProxyAgent(ProxyAgent):
+    """A ProxyAgent whose tunnels are made by AsyncioSOCKSEndpoint.
+
+    Racing and pipelined handshakes are not supported on this path; the
+    primary proxy is always used.
+    """
+
+    def __init__(self, reactor, proxy_config, sslContext=None, **kwargs):
+        ProxyAgent.__init__(self, reactor, proxy_config, **kwargs)
+        self._sslContext = sslContext if sslContext is not None else ssl_context_from_settings({})
+
+    def endpointForURI(self, uri):
+        if uri.scheme not in (b'http', b'https'):
+            raise SchemeNotSupported('unsupported scheme', uri.scheme)
+        return AsyncioSOCKSEndpoint(self.reactor, self.proxy_config, uri.host.decode(), uri.port,
+                                    sslContext=self._sslContext if uri.scheme == b'https' else None,
+                                    connectTimeout=self._connectTimeout,
+                                    handshakeTimeout=self._handshakeTimeout,
+                                    tlsTimeout=self._tlsTimeout,
+                                    timestamps=self._timestamps,
+                                    stats=self._stats,
+                                    resolver=self._resolver,
+                                    admission=self._admission,
+                                    transferStats=self._transferStats,
+                                    replyCache=self._replyCache)
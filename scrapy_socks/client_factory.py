@@ -12,16 +12,34 @@ from zope.interface import implementer
 import struct
 import socket
 import re
+from scrapy_socks.protocol import SOCKSv4ClientProtocol, SOCKSv4aClientProtocol, SOCKSv5ClientProtocol
 
 class SOCKSClientFactory(ClientFactory):
+    protocols = {
+        '4': SOCKSv4ClientProtocol,
+        '4a': SOCKSv4aClientProtocol,
+        '5': SOCKSv5ClientProtocol,
+        '5h': SOCKSv5ClientProtocol,
+    }
+
+    # The connector keeps its factory for as long as the tunnel is open
+    __slots__ = ('proxy_config', 'protocol', 'numPorts', 'postHandshakeEndpoint', 'postHandshakeFactory',
+                 'handshakeDone', 'handshakeProtocol', 'handshakeTimeout', 'pipeline', 'tunnelClosed',
+                 'transferMeter', 'relayHost', '_timestamps', '_timer', '_reactor')
+
     def __init__(self, proxy_config):
         self.proxy_config = proxy_config
-        if self.proxy_config['version'] == '4':
-            self.protocol = SOCKSv4ClientProtocol
-        elif self.proxy_config['version'] == '4a':
-            self.protocol = SOCKSv4aClientProtocol
-        elif self.proxy_config['version'] == '5' or self.proxy_config['version'] == '5h':
-            self.protocol = SOCKSv5ClientProtocol
+        self.protocol = self.protocols[proxy_config.version]
+        self.numPorts = 0
+        self.postHandshakeEndpoint = self.postHandshakeFactory = None
+        self.handshakeDone = None
+        self.handshakeProtocol = None
+        self.handshakeTimeout = None
+        self.pipeline = False
+        self.tunnelClosed = None
+        self.transferMeter = None
+        self.relayHost = None
+        self._timestamps = self._timer = self._reactor = None
 
     def buildProtocol(self, addr):
         r = ClientFactory.buildProtocol(self, addr)
@@ -31,4 +49,19 @@ class SOCKSClientFactory(ClientFactory):
         r.handshakeDone = self.handshakeDone
         r._timestamps = self._timestamps
         r._timer = self._timer
+        r.pipeline = self.pipeline
+        r.handshakeTimeout = self.handshakeTimeout
+        r._reactor = self._reactor
+        r.tunnelClosed = self.tunnelClosed
+        r.relayHost = self.relayHost
+        r.transferMeter = self.transferMeter
+        self.handshakeProtocol = r
         return r
+
+    def releaseHandshake(self):
+        """Drop the references only the handshake needed, once the tunnel is established."""
+        self.handshakeProtocol = None
+        self.postHandshakeEndpoint = self.postHandshakeFactory = None
+        self.handshakeDone = None
+        self.tunnelClosed = self.transferMeter = None
+        self._timestamps = None
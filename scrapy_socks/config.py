@@ -0,0 +1,114 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from collections import namedtuple
+from functools import lru_cache
+from six.moves.urllib.parse import unquote
+from twisted.web.client import SchemeNotSupported
+import dsnparse3
+import struct
+
+
+SOCKS_VERSIONS = {
+    'socks4': '4',
+    'socks4a': '4a',
+    'socks5': '5',
+    'socks5h': '5h',
+}
+
+DEFAULT_PORT = 1080
+
+# Versions for which destination hostnames are resolved by the client. SOCKS4
+# can only carry IPv4 addresses; socks5h (and socks4a) leave it to the proxy.
+LOCAL_DNS_VERSIONS = ('4', '5')
+
+# Method selection message offering username/password authentication only
+AUTH_ONLY_GREETING = b'\x05\x01\x02'
+
+
+class ProxyConfig(namedtuple('ProxyConfig', ['scheme', 'version', 'host', 'port', 'username', 'password',
+                                             'greeting', 'auth_request', 'userid',
+                                             'pipelined_greeting'])):
+    """Immutable description of a SOCKS proxy.
+
+    Besides the parsed URL parts it carries the handshake messages that only
+    depend on the proxy, so protocols never have to rebuild them:
+
+    * ``greeting`` -- SOCKS5 method selection message
+    * ``pipelined_greeting`` -- method selection message offering only the
+      method a pipelined handshake uses, followed by the auth request if any
+    * ``auth_request`` -- SOCKS5 username/password sub-negotiation (or None)
+    * ``userid`` -- NUL terminated SOCKS4 user id
+
+    Configs made by ``isolated_config`` only offer username/password
+    authentication (``auth_required``).
+    """
+    __slots__ = ()
+
+    @property
+    def address(self):
+        return self.host, self.port
+
+    @property
+    def resolves_locally(self):
+        return self.version in LOCAL_DNS_VERSIONS
+
+    @property
+    def has_auth(self):
+        return bool(self.username and self.password)
+
+    @property
+    def auth_required(self):
+        return self.greeting == AUTH_ONLY_GREETING
+
+
+def build_proxy_config(scheme, host, port=None, username=None, password=None, auth_only=False):
+    scheme = scheme.lower()
+    if scheme not in SOCKS_VERSIONS:
+        raise SchemeNotSupported('unsupported scheme', scheme)
+    port = port or DEFAULT_PORT
+
+    if username and password:
+        # 0x05 is the socks version number, 0x02 is the number of auth methods
+        # 0x00 is auth method "No authentication" and 0x02 is auth method "Username/Password"
+        greeting = AUTH_ONLY_GREETING if auth_only else b'\x05\x02\x00\x02'
+        username_bytes, password_bytes = username.encode(), password.encode()
+        auth_request = struct.pack('BB%ssB%ss' % (len(username_bytes), len(password_bytes)),
+                                   1, len(username_bytes), username_bytes, len(password_bytes), password_bytes)
+        pipelined_greeting = AUTH_ONLY_GREETING + auth_request
+    else:
+        # when the user doesn't specify any user/pass creds, try auth method "no authentication"
+        greeting = b'\x05\x01\x00'
+        auth_request = None
+        pipelined_greeting = greeting
+    userid = (username.encode() if username else b'') + b'\x00'
+
+    return ProxyConfig(scheme, SOCKS_VERSIONS[scheme], host, port, username, password,
+                       greeting, auth_request, userid, pipelined_greeting)
+
+
+@lru_cache(maxsize=1024)
+def parse_proxy(proxy):
+    """Return the ProxyConfig for a ``socks*://`` proxy URL.
+
+    Results are cached, so calling this for every request only parses each
+    distinct proxy URL once.
+    """
+    parsed = dsnparse3.parse(proxy)
+    return build_proxy_config(parsed.scheme,
+                              parsed.hostname,
+                              parsed.port,
+                              unquote(parsed.username) if parsed.username else None,
+                              unquote(parsed.password) if parsed.password else None)
+
+
+@lru_cache(maxsize=4096)
+def isolated_config(proxy_config, token):
+    """Return a copy of a SOCKS5 ``proxy_config`` whose credentials carry the isolation ``token``.
+
+    The token is the username, or is appended to the configured one, and
+    also the password unless one is configured. Tor never puts streams
+    with different credentials on the same circuit (IsolateSOCKSAuth).
+    """
+    username = '%s-%s' % (proxy_config.username, token) if proxy_config.username else token
+    return build_proxy_config(proxy_config.scheme, proxy_config.host, proxy_config.port, username,
+                              proxy_config.password or token, auth_only=True)
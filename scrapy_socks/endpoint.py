@@ -13,21 +13,91 @@ from zope.interface import implementer
 import struct
 import socket
 import re
+from scrapy_socks.client_factory import SOCKSClientFactory
+from scrapy_socks.exceptions import SOCKSPipelineRejected, SOCKSTimeoutError, SOCKSProxyLookupError, \
+    SOCKSReplyError
+from scrapy_socks.handshake import encode_host, ATYP_DOMAINNAME
+from twisted.internet.error import TimeoutError, DNSLookupError, ConnectError
+from itertools import count
+from twisted.python.failure import Failure
+from collections import OrderedDict
+
+
+def _discard(result):
+    return None
+
+
+class PipelineRejections(object):
+    """Proxies that refused a pipelined SOCKS5 handshake.
+
+    A proxy is remembered by address for ``ttl`` seconds, during which it
+    only gets lock-step handshakes. At most ``maxsize`` proxies are kept,
+    the least recently rejected are forgotten first.
+    """
+
+    def __init__(self, reactor, maxsize=1000, ttl=3600):
+        self._reactor = reactor
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # (proxy host, proxy port) -> expires at
+        self._entries = OrderedDict()
+
+    def __contains__(self, proxy_config):
+        expires = self._entries.get(proxy_config.address)
+        if expires is None:
+            return False
+        if expires <= self._reactor.seconds():
+            del self._entries[proxy_config.address]
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, proxy_config):
+        self._entries[proxy_config.address] = self._reactor.seconds() + self.ttl
+        self._entries.move_to_end(proxy_config.address)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
 
 
 @implementer(IStreamClientEndpoint)
 class SOCKSWrapper(object):
     factory = SOCKSClientFactory
+    # Spreads connections over the addresses of proxy hostnames
+    _turns = count()
 
-    def __init__(self, reactor, endpoint, proxy_config, timestamps=None):
-        self._host = proxy_config['host']
-        self._port = proxy_config['port']
+    def __init__(self, reactor, endpoint, proxy_config, timestamps=None, pipeline=False, stats=None,
+                 connectTimeout=3, handshakeTimeout=None, admission=None, resolver=None, transferStats=None,
+                 replyCache=None, pipelineRejections=None):
+        self._host = proxy_config.host
+        self._port = proxy_config.port
         self._proxy_config = proxy_config
+        self._pipeline = pipeline and proxy_config.version in ('5', '5h')
 
         self._reactor = reactor
         self._endpoint = endpoint
+        self._connectTimeout = connectTimeout
+        self._handshakeTimeout = handshakeTimeout
+        self._admission = admission
+        self._resolver = resolver
+        # Counts the traffic through established tunnels, see HandshakeStats.record_transfer
+        self._transferStats = transferStats
+        # Failure replies remembered per destination, see ReplyFailureCache
+        self._replyCache = replyCache
+        # Proxies that only get lock-step handshakes, see PipelineRejections
+        self._pipelineRejections = pipelineRejections
+        # Address sent to the proxy instead of the destination hostname
+        self._relayHost = None
+        # Addresses of the proxy, in the order they are tried
+        self._proxyAddresses = [self._host]
+        self._untried = []
+        self._connector = None
         self._timestamps = None
         self._timer = None
+        self._stats = stats
+        if timestamps is None and stats is not None:
+            timestamps = {}
         if timestamps is not None:
             self._timestamps = timestamps
             self._timer = IReactorTime(reactor)
@@ -40,7 +110,91 @@ class SOCKSWrapper(object):
         """
         Return a deferred firing when the SOCKS connection is established.
         """
+        if self._replyCache is not None:
+            error = self._replyCache.check(self._proxy_config, self._endpoint._host, self._endpoint._port)
+            if error is not None:
+                return defer.fail(error)
+        resolveProxy = self._resolver is not None and self._isHostname(self._host)
+        resolveDestination = (self._resolver is not None and self._proxy_config.resolves_locally and
+                              self._isHostname(self._endpoint._host))
+        if not (resolveProxy or resolveDestination):
+            return self._connectTunnel(protocolFactory)
+        # Both lookups are nearly always answered from the cache, right away
+        d = defer.succeed(None)
+        if resolveProxy:
+            d.addCallback(lambda _: self._resolver.resolve(self._host))
+            d.addCallbacks(self._proxyResolved, self._proxyLookupFailed)
+        if resolveDestination:
+            d.addCallback(lambda _: self._resolver.resolve(self._endpoint._host))
+            d.addCallback(self._destinationResolved)
+        d.addCallback(lambda _: self._connectTunnel(protocolFactory))
+        return d
+
+    @staticmethod
+    def _isHostname(host):
+        address = encode_host(host)
+        return address is not None and address.type == ATYP_DOMAINNAME
+
+    def _proxyResolved(self, addresses):
+        # IPv4 first, each family rotated so tunnels spread over all records
+        turn = next(self._turns)
+        ordered = []
+        for family in ([a for a in addresses if ':' not in a], [a for a in addresses if ':' in a]):
+            if family:
+                i = turn % len(family)
+                ordered.extend(family[i:] + family[:i])
+        self._proxyAddresses = ordered
 
+    def _proxyLookupFailed(self, failure):
+        failure.trap(DNSLookupError)
+        raise SOCKSProxyLookupError('Could not resolve proxy %s: %s' % (self._host, failure.getErrorMessage()))
+
+    def _destinationResolved(self, addresses):
+        if self._proxy_config.version == '4':
+            addresses = [a for a in addresses if ':' not in a]
+            if not addresses:
+                raise DNSLookupError('%s: no IPv4 address for SOCKS4' % self._endpoint._host)
+        self._relayHost = addresses[0]
+
+    def _connectTunnel(self, protocolFactory):
+        if self._pipeline and (self._pipelineRejections is None or
+                               self._proxy_config not in self._pipelineRejections):
+            d = self._connect(protocolFactory, pipeline=True)
+            d.addErrback(self._pipelineFallback, protocolFactory)
+            return d
+        return self._connect(protocolFactory)
+
+    def _pipelineFallback(self, failure, protocolFactory):
+        failure.trap(SOCKSPipelineRejected)
+        if self._pipelineRejections is not None:
+            self._pipelineRejections.add(self._proxy_config)
+        return self._connect(protocolFactory)
+
+    def _connect(self, protocolFactory, pipeline=False):
+        if self._admission is None:
+            return self._dial(protocolFactory, pipeline)
+        # Wait for a tunnel and a handshake slot on the proxy first
+        d = self._admission.acquire(self._proxy_config)
+        d.addCallback(self._admitted, protocolFactory, pipeline)
+        return d
+
+    def _admitted(self, _, protocolFactory, pipeline):
+        proxy_config = self._proxy_config
+        admission = self._admission
+
+        def finished(result):
+            admission.handshakeFinished(proxy_config)
+            if isinstance(result, Failure):
+                # No tunnel to wait for
+                admission.tunnelClosed(proxy_config)
+            return result
+
+        return self._dial(protocolFactory, pipeline,
+                          lambda reason: admission.tunnelClosed(proxy_config)).addBoth(finished)
+
+    def _dial(self, protocolFactory, pipeline=False, tunnelClosed=None):
+        if self._timestamps is not None:
+            self._timestamps.clear()
         self.noteTime('START')
         try:
             # Connect with an intermediate SOCKS factory/protocol,
@@ -49,13 +203,179 @@ class SOCKSWrapper(object):
             f = self.factory(self._proxy_config)
             f.postHandshakeEndpoint = self._endpoint
             f.postHandshakeFactory = protocolFactory
-            f.handshakeDone = defer.Deferred()
+            f.handshakeDone = d = defer.Deferred(lambda _: self._cancel(f))
             f._timestamps = self._timestamps
             f._timer = self._timer
-            wf = _WrappingFactory(f)
-            self._reactor.connectTCP(self._host, self._port, wf, timeout=3)
-            self.noteTime('SOCKET')
-            wf._onConnection.addErrback(f.handshakeDone.errback)
-            return f.handshakeDone
+            f._reactor = self._reactor
+            f.pipeline = pipeline
+            f.handshakeTimeout = self._handshakeTimeout
+            f.tunnelClosed = tunnelClosed
+            f.relayHost = self._relayHost
+            if self._transferStats is not None:
+                f.transferMeter = self._transferStats.transfer_meter(self._proxy_config, self._reactor.seconds)
+            if self._stats is not None:
+                d.addCallbacks(self._recordHandshake, self._recordFailure)
+            if self._replyCache is not None:
+                d.addErrback(self._rememberReply)
+            self._untried = list(self._proxyAddresses)
+            self._dialAddress(f)
+            return d
         except:
-            return defer.fail()
\ No newline at end of file
+            return defer.fail()
+
+    def _dialAddress(self, factory):
+        wf = _WrappingFactory(factory)
+        self._connector = self._reactor.connectTCP(self._untried.pop(0), self._port, wf,
+                                                   timeout=self._connectTimeout or None)
+        self.noteTime('SOCKET')
+        # Don't let the fired deferred (kept by the connector for the life of
+        # the tunnel, through the factory) hold on to the handshake protocol.
+        wf._onConnection.addCallbacks(_discard, self._addressFailed, errbackArgs=(factory,))
+
+    def _addressFailed(self, failure, factory):
+        # Only failing to reach the proxy moves on to its next address
+        if factory.handshakeDone is None:
+            return
+        if self._untried and not factory.handshakeDone.called and failure.check(ConnectError):
+            self._dialAddress(factory)
+        else:
+            self._connectFailed(failure, factory.handshakeDone)
+
+    def _connectFailed(self, failure, handshakeDone):
+        # Already errbacked if the attempt was cancelled
+        if handshakeDone.called:
+            return
+        if failure.check(TimeoutError):
+            failure = SOCKSTimeoutError('Connecting to proxy %s:%s timed out after %ss' % (
+                self._host, self._port, self._connectTimeout))
+        handshakeDone.errback(failure)
+
+    def _cancel(self, factory):
+        protocol = factory.handshakeProtocol
+        if protocol is not None and protocol.transport is not None:
+            # Mid-handshake, drop the partial tunnel right away
+            protocol.transport.abortConnection()
+        else:
+            del self._untried[:]
+            self._connector.stopConnecting()
+
+    def _rememberReply(self, failure):
+        if failure.check(SOCKSReplyError):
+            self._replyCache.put(self._proxy_config, self._endpoint._host, self._endpoint._port,
+                                 failure.value.reply)
+        return failure
+
+    def _recordHandshake(self, protocol):
+        self._stats.record(self._proxy_config, self._timestamps)
+        return protocol
+
+    def _recordFailure(self, failure):
+        self._stats.record_failure(self._proxy_config, failure)
+        return failure
+
+@implementer(IStreamClientEndpoint)
+class RacingSOCKSWrapper(object):
+    """Races SOCKS handshakes through several proxies to one destination.
+
+    The first endpoint is dialled right away, and every ``stagger`` seconds
+    (or as soon as an attempt fails) the next one joins, with at most
+    ``fanout`` attempts in flight. The first tunnel to complete wins and
+    the remaining attempts are cancelled.
+
+    :param endpoints: SOCKSWrapper instances for the same destination, in
+        order of preference.
+    :param timestamps: If given, receives the winning attempt's handshake
+        timings, and its proxy config under ``'WINNER'``.
+    """
+
+    def __init__(self, reactor, endpoints, stagger=0.25, fanout=2, timestamps=None):
+        self._reactor = reactor
+        self._endpoints = list(endpoints)
+        self._stagger = stagger
+        self._fanout = max(fanout, 1)
+        self._timestamps = timestamps
+
+    def connect(self, protocolFactory):
+        return _SOCKSRace(self, protocolFactory).start()
+
+    @property
+    def _host(self):
+        return self._endpoints[0]._host
+
+    @property
+    def _port(self):
+        return self._endpoints[0]._port
+
+
+class _SOCKSRace(object):
+    def __init__(self, wrapper, protocolFactory):
+        self.wrapper = wrapper
+        self.protocolFactory = protocolFactory
+        self.pending = list(wrapper._endpoints)
+        self.attempts = {}
+        self.timer = None
+        self.lastFailure = None
+        self.done = False
+        self.result = defer.Deferred(self.cancel)
+
+    def start(self):
+        self.launch()
+        return self.result
+
+    def launch(self):
+        self.stopTimer()
+        if self.done:
+            return
+        if self.pending and len(self.attempts) < self.wrapper._fanout:
+            endpoint = self.pending.pop(0)
+            d = endpoint.connect(self.protocolFactory)
+            self.attempts[d] = endpoint
+            d.addCallbacks(self.won, self.lost, callbackArgs=(d,), errbackArgs=(d,))
+        if self.done:
+            return
+        # An attempt failing right away has launched the next one, and may have armed the timer already
+        self.stopTimer()
+        if self.pending and len(self.attempts) < self.wrapper._fanout:
+            self.timer = self.wrapper._reactor.callLater(self.wrapper._stagger, self.launch)
+        elif not self.attempts and not self.pending:
+            self.done = True
+            self.result.errback(self.lastFailure)
+
+    def won(self, protocol, d):
+        endpoint = self.attempts.pop(d, None)
+        if self.done:
+            # Lost the race by a hair, the tunnel is not needed anymore
+            protocol.transport.loseConnection()
+            return None
+        self.done = True
+        self.stopTimer()
+        self.cancelAttempts()
+        if self.wrapper._timestamps is not None:
+            self.wrapper._timestamps.update(endpoint._timestamps or ())
+            self.wrapper._timestamps['WINNER'] = endpoint._proxy_config
+        self.result.callback(protocol)
+        return None
+
+    def lost(self, failure, d):
+        self.attempts.pop(d, None)
+        if not self.done:
+            self.lastFailure = failure
+            self.launch()
+        return None
+
+    def cancel(self, result):
+        self.done = True
+        self.stopTimer()
+        self.pending = []
+        self.cancelAttempts()
+
+    def cancelAttempts(self):
+        attempts, self.attempts = list(self.attempts), {}
+        for d in attempts:
+            d.cancel()
+
+    def stopTimer(self):
+        if self.timer is not None:
+            if self.timer.active():
+                self.timer.cancel()
+            self.timer = None
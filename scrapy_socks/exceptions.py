@@ -1,5 +1,6 @@
 __author__ = 'Constantine Slednev <c.slednev@gmail.com>'
 
+from twisted.internet.error import TimeoutError, DNSLookupError
 
 class BaseException(Exception):
     def __init__(self, val):
@@ -13,4 +14,36 @@ class SOCKSError(BaseException):
     pass
 
 class ProxyError(BaseException):
-    pass
\ No newline at end of file
+    pass
+
+class SOCKSPipelineRejected(SOCKSError):
+    pass
+
+class SOCKSTimeoutError(SOCKSError, TimeoutError):
+    '''A proxy connect or SOCKS handshake deadline expired.
+
+    Also a twisted TimeoutError, so Scrapy's retry middleware retries it.
+    '''
+    pass
+
+
+class SOCKSProxyLookupError(SOCKSError, DNSLookupError):
+    '''The proxy's own hostname did not resolve.
+
+    A SOCKSError, so it counts against the proxy rather than the
+    destination, and a twisted DNSLookupError for Scrapy's retry middleware.
+    '''
+    pass
+
+
+class SOCKSReplyError(SOCKSError):
+    '''The proxy answered the CONNECT request with the failure code in ``reply``.'''
+    pass
+
+
+class SOCKSCachedReplyError(SOCKSReplyError):
+    '''Failed without connecting, as the proxy recently answered ``reply`` for the same destination.
+
+    See ReplyFailureCache.
+    '''
+    pass
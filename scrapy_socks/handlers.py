@@ -6,14 +6,19 @@ from io import BytesIO
 from time import time
 from six.moves.urllib.parse import urldefrag
 import hashlib
+from collections import OrderedDict
 from twisted.internet import defer, reactor, protocol
 from twisted.web.http_headers import Headers as TxHeaders
 from twisted.web.http import PotentialDataLoss
-from twisted.web.client import ResponseDone
-from twisted.protocols.ftp import FTPFileListProtocol
+from twisted.web.client import ResponseDone, HTTPConnectionPool, URI, ResponseNeverReceived
+from twisted.internet.error import TimeoutError
+from twisted.protocols.ftp import FTPFileListProtocol, FTPClient
+from twisted.internet.endpoints import TCP4ClientEndpoint, connectProtocol
 from scrapy.http import Headers
 from scrapy.responsetypes import responsetypes
 from scrapy.utils.python import to_bytes
+from scrapy.utils.httpobj import urlparse_cached
+from six.moves.urllib.parse import unquote
 from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler, \
     ScrapyAgent as ScrapyAgentBase, _RequestBodyProducer
 from scrapy.core.downloader.handlers.ftp import FTPDownloadHandler as BaseFTPDownloadHandler, ReceivedDataProtocol
@@ -23,45 +28,465 @@ from datetime import datetime
 from math import log2
 from twisted.internet import _sslverify
 from scrapy_socks.agent import ProxyAgent
-import dsnparse3
-from scrapy_socks.exceptions import ProxyError
+from scrapy_socks.config import parse_proxy, SOCKS_VERSIONS
+from scrapy_socks.endpoint import SOCKSWrapper, PipelineRejections
+from scrapy_socks.stats import HandshakeStats
+from scrapy_socks.warmer import TunnelWarmer
+from scrapy_socks.tls import TLSSessionCache
+from scrapy_socks.admission import AdmissionControl, AdmissionConnectionPool
+from scrapy_socks.resolver import HostResolver
+from scrapy_socks.replycache import ReplyFailureCache, DESTINATION_REPLIES
+from scrapy_socks.exceptions import ProxyError, SOCKSReplyError
+from scrapy_socks.isolation import StreamIsolation
+from scrapy.utils.reactor import is_asyncio_reactor_installed
+from functools import partial
 from twisted.web.client import Agent as BaseAgent, SchemeNotSupported, BrowserLikePolicyForHTTPS
 
 
+logger = logging.getLogger(__name__)
+
+
 class HTTPDownloadHandler(HTTP11DownloadHandler):
+    def __init__(self, settings, *args, **kwargs):
+        super(HTTPDownloadHandler, self).__init__(settings, *args, **kwargs)
+        # One HTTPConnectionPool per SOCKS proxy config. Twisted keys pooled
+        # connections on the destination only, so tunnels through different
+        # proxies (or with different credentials) must never share a pool.
+        # Rotating proxies or credentials would add pools without end, so past
+        # SOCKS_POOL_MAX_PROXIES pools the least recently used one is closed.
+        self._proxy_pools = OrderedDict()
+        self._proxy_pools_maxsize = settings.getint('SOCKS_POOL_MAX_PROXIES', 1000)
+        self._proxy_pool_maxsize = settings.getint('SOCKS_POOL_MAXSIZE',
+                                                   settings.getint('CONCURRENT_REQUESTS_PER_DOMAIN'))
+        self._proxy_pool_timeout = settings.getfloat('SOCKS_POOL_IDLE_TIMEOUT', 240)
+        # Deadlines in seconds for connecting to the proxy, the SOCKS
+        # negotiation and the TLS handshake through the tunnel (0 disables).
+        # The socks_connect_timeout, socks_handshake_timeout and socks_tls_timeout
+        # meta keys override them per request.
+        self.connect_timeout = settings.getfloat('SOCKS_CONNECT_TIMEOUT', 3)
+        self.handshake_timeout = settings.getfloat('SOCKS_HANDSHAKE_TIMEOUT', 10)
+        self.tls_timeout = settings.getfloat('SOCKS_TLS_TIMEOUT', 10)
+        # Requests listing alternative proxies in meta['socks_race_proxies'] race
+        # their handshakes, starting one every SOCKS_RACE_STAGGER seconds and
+        # with at most SOCKS_RACE_FANOUT in flight.
+        self.race_stagger = settings.getfloat('SOCKS_RACE_STAGGER', 0.25)
+        self.race_fanout = settings.getint('SOCKS_RACE_FANOUT', 2)
+        # Opt-in: send the whole SOCKS5 handshake in one write. Proxies refusing
+        # it get lock-step handshakes for SOCKS_PIPELINE_REJECT_TTL seconds.
+        self.pipeline_handshake = settings.getbool('SOCKS_PIPELINE_HANDSHAKE')
+        self.pipeline_rejections = None
+        if self.pipeline_handshake:
+            self.pipeline_rejections = PipelineRejections(
+                reactor,
+                maxsize=settings.getint('SOCKS_PIPELINE_REJECT_SIZE', 1000),
+                ttl=settings.getfloat('SOCKS_PIPELINE_REJECT_TTL', 3600))
+        self.handshake_stats = None
+        if self._crawler is not None and settings.getbool('SOCKS_STATS_ENABLED', True):
+            self.handshake_stats = HandshakeStats(
+                self._crawler.stats, throughput_min_bytes=settings.getint('SOCKS_THROUGHPUT_MIN_BYTES', 65536))
+        # Bytes, time to first byte and download rate of the traffic through the tunnels
+        self.transfer_stats = None
+        if self.handshake_stats is not None and settings.getbool('SOCKS_TRANSFER_STATS_ENABLED', True):
+            self.transfer_stats = self.handshake_stats
+        # TLS sessions shared by all tunnels to the same origin, whatever the proxy
+        self.tls_session_cache = None
+        if settings.getbool('SOCKS_TLS_SESSION_CACHE_ENABLED', True):
+            self.tls_session_cache = TLSSessionCache(settings.getint('SOCKS_TLS_SESSION_CACHE_SIZE', 1024),
+                                                     stats=self._crawler.stats if self._crawler is not None else None)
+        # Destination lookups for socks4:// and socks5:// proxies, which get
+        # addresses rather than hostnames (socks4a:// and socks5h:// don't).
+        self.resolver = HostResolver(reactor,
+                                     maxsize=settings.getint('SOCKS_DNS_CACHE_SIZE',
+                                                             settings.getint('DNSCACHE_SIZE', 10000)),
+                                     minTTL=settings.getfloat('SOCKS_DNS_MIN_TTL', 0),
+                                     maxTTL=settings.getfloat('SOCKS_DNS_MAX_TTL', 3600),
+                                     negativeTTL=settings.getfloat('SOCKS_DNS_NEGATIVE_TTL', 30),
+                                     timeout=settings.getfloat('DNS_TIMEOUT', 60),
+                                     stats=self._crawler.stats if self._crawler is not None else None)
+        # SOCKS5 failure replies that only depend on the destination (by default
+        # not allowed by ruleset, network or host unreachable and address type
+        # not supported) fail later connects through the same proxy to the
+        # same destination at once, for SOCKS_REPLY_CACHE_TTL seconds.
+        self.reply_cache = None
+        if settings.getbool('SOCKS_REPLY_CACHE_ENABLED', True):
+            self.reply_cache = ReplyFailureCache(
+                reactor,
+                maxsize=settings.getint('SOCKS_REPLY_CACHE_SIZE', 10000),
+                ttl=settings.getfloat('SOCKS_REPLY_CACHE_TTL', 300),
+                replies=[int(r, 0) if isinstance(r, str) else r
+                         for r in settings.getlist('SOCKS_REPLY_CACHE_REPLIES', DESTINATION_REPLIES)],
+                stats=self._crawler.stats if self._crawler is not None else None)
+        # Per-proxy caps on open tunnels and on handshakes in progress (0 is
+        # unlimited); connects over the caps wait in a FIFO queue.
+        self.admission = None
+        max_tunnels = settings.getint('SOCKS_MAX_TUNNELS_PER_PROXY')
+        max_handshakes = settings.getint('SOCKS_MAX_HANDSHAKES_PER_PROXY')
+        if max_tunnels or max_handshakes:
+            self.admission = AdmissionControl(reactor, max_tunnels, max_handshakes,
+                                              stats=self.handshake_stats, evictIdle=self._evict_idle)
+        # 'asyncio' makes the tunnels, SOCKS handshake and TLS included, with
+        # asyncio streams on the reactor's event loop instead of Twisted
+        # endpoints. It needs TWISTED_REACTOR set to the asyncio reactor.
+        self.proxy_agent = ProxyAgent
+        connector = settings.get('SOCKS_CONNECTOR', 'twisted')
+        if connector == 'asyncio':
+            if not is_asyncio_reactor_installed():
+                raise ValueError('SOCKS_CONNECTOR = "asyncio" requires TWISTED_REACTOR = '
+                                 '"twisted.internet.asyncioreactor.AsyncioSelectorReactor"')
+            from scrapy_socks.aio import AsyncioProxyAgent, ssl_context_from_settings
+            self.proxy_agent = partial(AsyncioProxyAgent, sslContext=ssl_context_from_settings(settings))
+        elif connector != 'twisted':
+            raise ValueError('Unknown SOCKS_CONNECTOR %r, expected "twisted" or "asyncio"' % connector)
+        # Tor stream isolation: SOCKS5 requests get the credentials of one of
+        # SOCKS_ISOLATION_BUCKETS buckets, picked by SOCKS_ISOLATION ('domain',
+        # 'slot' or 'round-robin'), so they spread over as many circuits.
+        # Slow or timing out buckets get new credentials, see StreamIsolation.
+        self.isolation = None
+        if settings.get('SOCKS_ISOLATION'):
+            self.isolation = StreamIsolation(settings['SOCKS_ISOLATION'],
+                                             buckets=settings.getint('SOCKS_ISOLATION_BUCKETS', 8),
+                                             prefix=settings.get('SOCKS_ISOLATION_PREFIX', 'scrapy'),
+                                             slow_factor=settings.getfloat('SOCKS_ISOLATION_SLOW_FACTOR', 3),
+                                             max_latency=settings.getfloat('SOCKS_ISOLATION_MAX_LATENCY', 0),
+                                             max_failures=settings.getint('SOCKS_ISOLATION_MAX_FAILURES', 3),
+                                             min_samples=settings.getint('SOCKS_ISOLATION_MIN_SAMPLES', 5),
+                                             stats=self._crawler.stats if self._crawler is not None else None,
+                                             retire=self._retire_pools)
+        # Optional reserve of idle tunnels to each proxy's most requested destinations
+        self.warmer = None
+        if settings.getbool('SOCKS_WARM_ENABLED'):
+            self.warmer = TunnelWarmer(reactor, self.get_proxy_pool, self._warm_endpoint,
+                                       reserve=settings.getint('SOCKS_WARM_RESERVE', 2),
+                                       hosts=settings.getint('SOCKS_WARM_HOSTS', 5),
+                                       interval=settings.getfloat('SOCKS_WARM_INTERVAL', 5),
+                                       ttl=settings.getfloat('SOCKS_WARM_TTL') or None,
+                                       tls=settings.getbool('SOCKS_WARM_TLS', True),
+                                       stats=self._crawler.stats if self._crawler is not None else None)
+
     def download_request(self, request, spider):
         """Return a deferred for the HTTP download"""
-        agent = ScrapyAgent(spider, contextFactory=self._contextFactory, pool=self._pool,
+        agent = ScrapyAgent(spider, self, contextFactory=self._contextFactory, pool=self._pool,
                             maxsize=getattr(spider, 'download_maxsize', self._default_maxsize),
                             warnsize=getattr(spider, 'download_warnsize', self._default_warnsize),
-                            fail_on_dataloss=self._fail_on_dataloss)
+                            fail_on_dataloss=self._fail_on_dataloss,
+                            crawler=self._crawler)
         return agent.download_request(request)
 
+    def get_proxy_pool(self, key):
+        """Return the persistent connection pool for the proxy identified by ``key``."""
+        pool = self._proxy_pools.get(key)
+        if pool is not None:
+            self._proxy_pools.move_to_end(key)
+        else:
+            # A size of 0 disables keep-alive, Twisted's pool can't hold 0 connections
+            persistent = self._proxy_pool_maxsize > 0
+            if self.admission is not None:
+                pool = AdmissionConnectionPool(reactor, self.admission, key, persistent=persistent)
+            else:
+                pool = HTTPConnectionPool(reactor, persistent=persistent)
+            pool.maxPersistentPerHost = self._proxy_pool_maxsize
+            pool.cachedConnectionTimeout = self._proxy_pool_timeout
+            pool._factory.noisy = False
+            self._proxy_pools[key] = pool
+            if self._proxy_pools_maxsize and len(self._proxy_pools) > self._proxy_pools_maxsize:
+                # Tunnels in use still go back to the evicted pool once released, and time out there
+                _, evicted = self._proxy_pools.popitem(last=False)
+                evicted.closeCachedConnections()
+        return pool
+
+    def _warm_endpoint(self, proxy_config, destination):
+        agent = self.proxy_agent(reactor=reactor,
+                                 proxy_config=proxy_config,
+                                 contextFactory=self._contextFactory,
+                                 connectTimeout=self.connect_timeout,
+                                 handshakeTimeout=self.handshake_timeout,
+                                 tlsTimeout=self.tls_timeout,
+                                 pipeline=self.pipeline_handshake,
+                                 stats=self.handshake_stats,
+                                 sessionCache=self.tls_session_cache,
+                                 admission=self.admission,
+                                 resolver=self.resolver,
+                                 transferStats=self.transfer_stats,
+                                 replyCache=self.reply_cache,
+                                 pipelineRejections=self.pipeline_rejections)
+        return agent.endpointForURI(destination)
+
+    def _retire_pools(self, proxy_configs):
+        # Credentials of a rotated isolation bucket, their circuit is not to be used again
+        if self.warmer is not None:
+            self.warmer.forget(proxy_configs)
+        for proxy_config in proxy_configs:
+            pool = self._proxy_pools.pop(proxy_config, None)
+            if pool is not None:
+                pool.closeCachedConnections()
+
+    def _evict_idle(self, proxy_config):
+        # Close the idle tunnel through this proxy, whatever its credentials,
+        # that is closest to its pool timeout
+        idle = [(pool._timeouts[connection].getTime(), pool, connection)
+                for key, pool in self._proxy_pools.items() if key.address == proxy_config.address
+                for connection in pool._timeouts]
+        if not idle:
+            return
+        _, pool, connection = min(idle, key=lambda entry: entry[0])
+        for key, connections in pool._connections.items():
+            if connection in connections:
+                pool._timeouts[connection].cancel()
+                pool._removeConnection(key, connection)
+                return
+
+    def close(self):
+        if self.warmer is not None:
+            self.warmer.stop()
+        pools, self._proxy_pools = list(self._proxy_pools.values()), OrderedDict()
+        d = super(HTTPDownloadHandler, self).close()
+        if not pools:
+            return d
+        # Same caveat as the base class: closeCachedConnections may never fire
+        # on network issues, so give up after the disconnect timeout.
+        dl = defer.DeferredList([d] + [pool.closeCachedConnections() for pool in pools])
+        delayed_call = reactor.callLater(self._disconnect_timeout, dl.callback, [])
+
+        def cancel_delayed_call(result):
+            if delayed_call.active():
+                delayed_call.cancel()
+            return result
+
+        dl.addBoth(cancel_delayed_call)
+        return dl
+
 
 class ScrapyAgent(ScrapyAgentBase):
-    def __init__(self, spider, *a, **kw):
+    # Failures that tell a slow or broken Tor circuit, 0x01 and 0x06 (TTL
+    # expired) being the replies Tor gives when the circuit times out.
+    CIRCUIT_FAILURES = (TimeoutError, ResponseNeverReceived)
+    CIRCUIT_REPLIES = (0x01, 0x06)
+
+    def __init__(self, spider, handler, *a, **kw):
         self.spider = spider
+        self.handler = handler
         super(ScrapyAgent, self).__init__(*a, **kw)
 
+    def download_request(self, request):
+        d = super(ScrapyAgent, self).download_request(request)
+        isolation = self.handler.isolation
+        if isolation is not None and 'socks_isolation_token' in request.meta:
+            # Set by _get_agent, which has already run
+            bucket = request.meta['socks_isolation_bucket']
+            token = request.meta.pop('socks_isolation_token')
+
+            def observe(response):
+                if 'download_latency' in request.meta:
+                    isolation.observe(bucket, token, request.meta['download_latency'])
+                return response
+
+            def failed(failure):
+                if failure.check(*self.CIRCUIT_FAILURES) or (
+                        failure.check(SOCKSReplyError) and failure.value.reply in self.CIRCUIT_REPLIES):
+                    isolation.failed(bucket, token)
+                return failure
+
+            d.addCallbacks(observe, failed)
+        return d
+
     def _get_agent(self, request, timeout):
         bindAddress = request.meta.get('bindaddress') or self._bindAddress
-        proxy = request.meta.get('proxy', '').lower()
+        proxy = request.meta.get('proxy')
+        connect_timeout = request.meta.get('socks_connect_timeout',
+                                           request.meta.get('proxy_timeout', self.handler.connect_timeout))
         timeout = request.meta.pop('proxy_timeout', timeout)
 
         if proxy:
-            parsed_proxy = dsnparse3.parse(proxy)
-            if parsed_proxy.scheme in ('http', 'https'):
+            if proxy.partition(':')[0].lower() in ('http', 'https'):
                 return super(ScrapyAgent, self)._get_agent(request, timeout)
-            if parsed_proxy.scheme not in ('socks4', 'socks4a', 'socks5', 'socks5h'):
-                raise SchemeNotSupported('unsupported scheme', parsed_proxy.scheme)
-
-            return ProxyAgent(reactor=reactor,
-                              proxy_scheme=parsed_proxy.scheme,
-                              proxy_host=parsed_proxy.host,
-                              proxy_port=parsed_proxy.port,
-                              proxy_username=parsed_proxy.username,
-                              proxy_password=parsed_proxy.password,
-                              contextFactory=self._contextFactory,
-                              bindAddress=bindAddress)
+            proxy_config = parse_proxy(proxy)
+            if self.handler.isolation is not None:
+                proxy_config = self.handler.isolation.isolate(proxy_config, request)
+            if self.handler.warmer is not None:
+                uri = URI.fromBytes(to_bytes(request.url, encoding='ascii'))
+                self.handler.warmer.note(proxy_config, uri.scheme, uri.host, uri.port)
+            # Filled with the handshake phase timings if this request opens a new tunnel
+            request.meta['socks_timestamps'] = timestamps = {}
+
+            return self.handler.proxy_agent(
+                reactor=reactor,
+                proxy_config=proxy_config,
+                contextFactory=self._contextFactory,
+                connectTimeout=connect_timeout,
+                handshakeTimeout=request.meta.get('socks_handshake_timeout', self.handler.handshake_timeout),
+                tlsTimeout=request.meta.get('socks_tls_timeout', self.handler.tls_timeout),
+                bindAddress=bindAddress,
+                pool=self.handler.get_proxy_pool(proxy_config),
+                pipeline=self.handler.pipeline_handshake,
+                stats=self.handler.handshake_stats,
+                timestamps=timestamps,
+                raceConfigs=tuple(parse_proxy(p) for p in request.meta.get('socks_race_proxies', ())),
+                raceStagger=self.handler.race_stagger,
+                raceFanout=request.meta.get('socks_race_fanout', self.handler.race_fanout),
+                sessionCache=self.handler.tls_session_cache,
+                admission=self.handler.admission,
+                resolver=self.handler.resolver,
+                transferStats=self.handler.transfer_stats,
+                replyCache=self.handler.reply_cache,
+                pipelineRejections=self.handler.pipeline_rejections)
 
         return super(ScrapyAgent, self)._get_agent(request, timeout)
+
+
+class FTPDownloadHandler(BaseFTPDownloadHandler):
+    """FTP downloads through the SOCKS proxy in the ``proxy`` meta key.
+
+    The control connection and the passive data connections are tunnelled
+    through the proxy (active mode needs the proxy to accept connections,
+    so proxied downloads are always passive). Data connections go to the
+    host of the FTP URL rather than the address in the PASV reply, which is
+    often private, unless ``SOCKS_FTP_SKIP_PASV_IP`` is off.
+
+    With ``ftp_local_filename`` the data is streamed to that file as it
+    arrives, by way of ``<filename>.part`` which is only renamed once the
+    transfer completed. Downloads kept in memory are cancelled past the
+    download max size, like HTTP ones.
+
+    Requests without a SOCKS proxy are downloaded directly, as by Scrapy.
+    """
+
+    def __init__(self, settings, crawler=None):
+        super(FTPDownloadHandler, self).__init__(settings)
+        self._crawler = crawler
+        self.connect_timeout = settings.getfloat('SOCKS_CONNECT_TIMEOUT', 3)
+        self.handshake_timeout = settings.getfloat('SOCKS_HANDSHAKE_TIMEOUT', 10)
+        self.skip_pasv_ip = settings.getbool('SOCKS_FTP_SKIP_PASV_IP', True)
+        self._default_maxsize = settings.getint('DOWNLOAD_MAXSIZE')
+        self.handshake_stats = None
+        if crawler is not None and settings.getbool('SOCKS_STATS_ENABLED', True):
+            self.handshake_stats = HandshakeStats(crawler.stats)
+        self.resolver = HostResolver(reactor, timeout=settings.getfloat('DNS_TIMEOUT', 60),
+                                     stats=crawler.stats if crawler is not None else None)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.settings, crawler)
+
+    def download_request(self, request, spider):
+        proxy = request.meta.get('proxy')
+        if not proxy or proxy.partition(':')[0].lower() not in SOCKS_VERSIONS:
+            return super(FTPDownloadHandler, self).download_request(request, spider)
+        proxy_config = parse_proxy(proxy)
+        parsed_url = urlparse_cached(request)
+        host, port = parsed_url.hostname, parsed_url.port or 21
+        client = SOCKSFTPClient(partial(self._connect_data, proxy_config, host),
+                                request.meta.get('ftp_user', self.default_user),
+                                request.meta.get('ftp_password', self.default_password), passive=1)
+        d = connectProtocol(self._endpoint(proxy_config, host, port), client)
+        return d.addCallback(self.gotClient, request, unquote(parsed_url.path))
+
+    def gotClient(self, client, request, filepath):
+        filename = request.meta.get('ftp_local_filename')
+        maxsize = None if filename else request.meta.get('download_maxsize', self._default_maxsize)
+        protocol = StreamingDataProtocol(filename, maxsize)
+        d = client.retrieveFile(filepath, protocol)
+
+        def finished(result):
+            if protocol.exceeded:
+                logger.error('Cancelling download of %(url)s: size larger than download max size (%(maxsize)s).',
+                             {'url': request.url, 'maxsize': maxsize})
+                raise defer.CancelledError()
+            return result
+
+        d.addBoth(finished)
+        d.addCallbacks(self._build_response, self._discard, callbackArgs=(request, protocol),
+                       errbackArgs=(request, protocol))
+
+        def quit(result):
+            # Scrapy leaves the control connection open, not here: it holds a tunnel
+            client.quit().addErrback(lambda _: None)
+            client.transport.loseConnection()
+            return result
+
+        return d.addBoth(quit)
+
+    def _discard(self, failure, request, protocol):
+        protocol.discard()
+        return self._failed(failure, request)
+
+    def _endpoint(self, proxy_config, host, port):
+        return SOCKSWrapper(reactor, TCP4ClientEndpoint(reactor, host, port), proxy_config,
+                            stats=self.handshake_stats, connectTimeout=self.connect_timeout,
+                            handshakeTimeout=self.handshake_timeout, resolver=self.resolver)
+
+    def _connect_data(self, proxy_config, control_host, host, port, factory):
+        if self.skip_pasv_ip:
+            host = control_host
+        return DataConnection(self._endpoint(proxy_config, host, port), factory)
+
+
+class SOCKSFTPClient(FTPClient):
+    """FTPClient opening its passive data connections with ``connectData(host, port, factory)``."""
+
+    def __init__(self, connectData, *args, **kwargs):
+        FTPClient.__init__(self, *args, **kwargs)
+        self.connectData = connectData
+
+    def connectFactory(self, host, port, factory):
+        return self.connectData(host, port, factory)
+
+
+class DataConnection(object):
+    """Connects a passive data connection factory through an endpoint, quacking like the connector FTPClient expects."""
+
+    def __init__(self, endpoint, factory):
+        self.factory = factory
+        self.protocol = None
+        self._d = endpoint.connect(factory)
+        self._d.addCallbacks(self._connected, self._failed)
+
+    def _connected(self, protocol):
+        self.protocol = protocol
+
+    def _failed(self, failure):
+        # Endpoints don't call clientConnectionFailed, the transfer is failed here
+        if not self.factory.protoInstance.deferred.called:
+            self.factory.clientConnectionFailed(None, failure)
+
+    def disconnect(self):
+        if not self._d.called:
+            self._d.cancel()
+        elif self.protocol is not None:
+            # FTPClient passes a ProtocolWrapper, which leaves the transport to the protocol it wraps
+            transport = getattr(self.protocol, 'original', self.protocol).transport
+            if transport is not None:
+                transport.loseConnection()
+
+
+class StreamingDataProtocol(ReceivedDataProtocol):
+    """ReceivedDataProtocol writing to ``<filename>.part`` until ``close``, or refusing more than ``maxsize`` bytes."""
+
+    def __init__(self, filename=None, maxsize=None):
+        super(StreamingDataProtocol, self).__init__(filename + '.part' if filename else None)
+        self.target = filename
+        self.maxsize = maxsize
+        self.exceeded = False
+
+    @property
+    def filename(self):
+        return self.target
+
+    def dataReceived(self, data):
+        if self.exceeded:
+            return
+        if self.maxsize and self.size + len(data) > self.maxsize:
+            self.exceeded = True
+            self.transport.abortConnection()
+            return
+        super(StreamingDataProtocol, self).dataReceived(data)
+
+    def close(self):
+        super(StreamingDataProtocol, self).close()
+        if self.target:
+            os.replace(self.target + '.part', self.target)
+
+    def discard(self):
+        if self.target:
+            self.body.close()
+            if os.path.exists(self.target + '.part'):
+                os.remove(self.target + '.part')
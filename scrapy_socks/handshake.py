@@ -0,0 +1,179 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from collections import namedtuple
+from functools import lru_cache
+import re
+import socket
+import struct
+
+
+ATYP_IPV4 = 0x01
+ATYP_DOMAINNAME = 0x03
+ATYP_IPV6 = 0x04
+
+DNS_LABEL_REGEX = re.compile(r'^(?![0-9]+$)(?!-)[a-zA-Z0-9-]{,63}(?<!-)$')
+
+# Classification and wire encoding of a destination host, see encode_host().
+# ``packed`` is the 4 or 16 byte address, or the encoded name for
+# ATYP_DOMAINNAME; ``socks5`` is the complete SOCKS5 address field.
+HostAddress = namedtuple('HostAddress', ['type', 'packed', 'socks5'])
+
+
+def is_hostname(string):
+    return all(DNS_LABEL_REGEX.match(label) for label in string.split('.'))
+
+
+@lru_cache(maxsize=4096)
+def encode_host(host):
+    """Return the HostAddress for ``host``, or None if it is neither an IP address nor a hostname."""
+    if is_hostname(host):
+        name = host.encode('ascii')
+        if len(name) > 255:
+            return None
+        return HostAddress(ATYP_DOMAINNAME, name, b'\x03' + bytes((len(name),)) + name)
+    try:
+        packed = socket.inet_aton(host)
+        return HostAddress(ATYP_IPV4, packed, b'\x01' + packed)
+    except socket.error:
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, host)
+        return HostAddress(ATYP_IPV6, packed, b'\x04' + packed)
+    except socket.error:
+        return None
+
+
+def socks5_connect_request(address, port):
+    # version 5, command 0x01 (establish a TCP/IP stream connection), reserved byte
+    return b''.join((b'\x05\x01\x00', address.socks5, struct.pack('!H', port)))
+
+
+def socks4_connect_request(address, port, userid):
+    """Return a SOCKS4 CONNECT request, or a SOCKS4a one when ``address`` is a hostname."""
+    if address.type == ATYP_DOMAINNAME:
+        # 0.0.0.x with x != 0 tells the server to resolve the name that follows the user id
+        return b''.join((struct.pack('!BBH', 0x4, 0x1, port), b'\x00\x00\x00\x01', userid, address.packed, b'\x00'))
+    return b''.join((struct.pack('!BBH', 0x4, 0x1, port), address.packed, userid))
+
+
+# Incremental parsers for the replies a SOCKS client receives during the
+# handshake. They never touch a transport: each ``read_*`` function either
+# consumes one complete message from a ReceiveBuffer and returns it, or
+# returns None and leaves the buffer untouched when more data is needed.
+# That makes them indifferent to how the server's bytes are split into or
+# coalesced across TCP segments.
+
+
+class ReceiveBuffer(object):
+    """A single growable receive buffer with a read offset.
+
+    Consumed bytes are only discarded when new data arrives, and reads are
+    done in place with ``struct.unpack_from`` or memoryview slices.
+    """
+    __slots__ = ('_data', '_pos')
+
+    def __init__(self):
+        self._data = bytearray()
+        self._pos = 0
+
+    def __len__(self):
+        return len(self._data) - self._pos
+
+    def feed(self, data):
+        if self._pos:
+            del self._data[:self._pos]
+            self._pos = 0
+        self._data += data
+
+    def unpack(self, fmt, offset=0):
+        return struct.unpack_from(fmt, self._data, self._pos + offset)
+
+    def view(self, start, end):
+        return memoryview(self._data)[self._pos + start:self._pos + end]
+
+    def consume(self, n):
+        self._pos += n
+        if self._pos == len(self._data):
+            del self._data[:]
+            self._pos = 0
+
+    def drain(self):
+        """Return and discard everything not consumed yet."""
+        rest = bytes(self.view(0, len(self)))
+        del self._data[:]
+        self._pos = 0
+        return rest
+
+
+def read_socks5_method_reply(buf):
+    """Return ``(version, method)`` from a SOCKS5 method selection reply."""
+    if len(buf) < 2:
+        return None
+    reply = buf.unpack('!BB')
+    buf.consume(2)
+    return reply
+
+
+def read_socks5_auth_reply(buf):
+    """Return ``(version, status)`` from a username/password auth reply."""
+    if len(buf) < 2:
+        return None
+    reply = buf.unpack('!BB')
+    buf.consume(2)
+    return reply
+
+
+def read_socks5_reply(buf):
+    """Return ``(version, reply, address_type, bound_address, bound_port)``.
+
+    Failure replies (and replies with an unknown address type) are returned
+    as soon as their header is complete, with the bound address and port set
+    to None, since servers commonly close the connection without sending a
+    full reply in that case.
+    """
+    if len(buf) < 4:
+        return None
+    version, reply, _, address_type = buf.unpack('!BBBB')
+    if version != 0x5 or reply != 0x0 or address_type not in (0x1, 0x3, 0x4):
+        buf.consume(len(buf))
+        return version, reply, address_type, None, None
+
+    if address_type == 0x1:  # IPv4 address
+        start, end = 4, 8
+    elif address_type == 0x4:  # IPv6 address
+        start, end = 4, 20
+    else:  # domain name, prefixed with its length
+        if len(buf) < 5:
+            return None
+        start = 5
+        end = start + buf.unpack('!B', 4)[0]
+    if len(buf) < end + 2:
+        return None
+
+    address = buf.view(start, end)
+    if address_type == 0x1:
+        bound_address = socket.inet_ntop(socket.AF_INET, address)
+    elif address_type == 0x4:
+        bound_address = socket.inet_ntop(socket.AF_INET6, address)
+    else:
+        try:
+            bound_address = bytes(address).decode('idna')
+        except UnicodeError:
+            # Only informational, a garbled name must not break the handshake
+            bound_address = bytes(address).decode('ascii', 'replace')
+    address.release()
+    bound_port = buf.unpack('!H', end)[0]
+    buf.consume(end + 2)
+    return version, reply, address_type, bound_address, bound_port
+
+
+def read_socks4_reply(buf):
+    """Return ``(version, status, bound_address, bound_port)`` from a SOCKS4 reply."""
+    if len(buf) < 8:
+        return None
+    version, status, bound_port = buf.unpack('!BBH')
+    address = buf.view(4, 8)
+    bound_address = socket.inet_ntop(socket.AF_INET, address)
+    address.release()
+    buf.consume(8)
+    return version, status, bound_address, bound_port
@@ -0,0 +1,325 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from bisect import bisect
+from hashlib import blake2b
+from heapq import heappush, heappop, heapify
+from itertools import count
+from math import ceil
+from time import time
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class ProxyState(object):
+    """Health of a single proxy as seen by a ProxyHealthPool."""
+    __slots__ = ('proxy', 'latency', 'success', 'inflight', 'external', 'failures', 'circuit',
+                 'open_until', 'backoff', 'version')
+
+    def __init__(self, proxy, latency):
+        self.proxy = proxy
+        # EWMAs of the handshake latency in seconds and of the success rate (0..1)
+        self.latency = latency
+        self.success = 1.0
+        self.inflight = 0
+        # Requests in flight to it from other processes, see ProxyHealthPool.merge
+        self.external = 0
+        # Consecutive failures, reset by any success
+        self.failures = 0
+        self.circuit = CLOSED
+        self.open_until = 0
+        self.backoff = 0
+        # Bumped on every change, heap entries with an older version are stale
+        self.version = 0
+
+    def score(self):
+        # Lower is better: expected latency, inflated by the load already
+        # sent to this proxy and by its failure rate.
+        return self.latency * (1 + self.inflight + self.external) / max(self.success, 0.05)
+
+
+class HashRing(object):
+    """Consistent hash ring of proxies, with ``replicas`` points per proxy.
+
+    ``walk(key)`` yields every proxy once, in ring order from the point of
+    ``key``, so adding or removing a proxy only moves the keys that land
+    next to its points.
+    """
+
+    def __init__(self, replicas=100):
+        self.replicas = replicas
+        self._points = []
+        self._owners = []
+        self._proxies = set()
+
+    def __len__(self):
+        return len(self._proxies)
+
+    @staticmethod
+    def hash(key):
+        # Stable across processes, unlike hash()
+        return int.from_bytes(blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def add(self, proxy):
+        if proxy not in self._proxies:
+            self._proxies.add(proxy)
+            self._rebuild()
+
+    def remove(self, proxy):
+        if proxy in self._proxies:
+            self._proxies.discard(proxy)
+            self._rebuild()
+
+    def walk(self, key):
+        n = len(self._points)
+        if not n:
+            return
+        start = bisect(self._points, self.hash(key))
+        seen = set()
+        for i in range(n):
+            proxy = self._owners[(start + i) % n]
+            if proxy not in seen:
+                seen.add(proxy)
+                yield proxy
+                if len(seen) == len(self._proxies):
+                    return
+
+    def _rebuild(self):
+        points = sorted((self.hash('%s#%d' % (proxy, i)), proxy)
+                        for proxy in self._proxies for i in range(self.replicas))
+        self._points = [point for point, _ in points]
+        self._owners = [proxy for _, proxy in points]
+
+
+class ProxyHealthPool(object):
+    """Picks the healthiest proxy in O(log n) and circuit-breaks failing ones.
+
+    Selectable proxies live in a heap ordered by ``ProxyState.score()``.
+    Entries are never updated in place: a change pushes a new entry and the
+    old one is skipped when it surfaces. Proxies whose circuit is open wait
+    in a second heap ordered by the time they may be probed again; the first
+    pick after that time sends exactly one probe request to it (half-open).
+
+    Picks with a key (destination affinity) follow a HashRing instead,
+    with bounded loads: the first proxy in ring order for the key that is
+    not circuit-broken and has fewer than ``load_factor`` times the average
+    number of requests in flight (rounded up) gets it.
+    """
+
+    def __init__(self, proxies=(), alpha=0.3, initial_latency=0.5,
+                 failure_threshold=5, backoff=30, max_backoff=600, clock=time,
+                 load_factor=1.25, replicas=100):
+        self.alpha = alpha
+        self.initial_latency = initial_latency
+        self.failure_threshold = failure_threshold
+        self.base_backoff = backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.load_factor = load_factor
+        self.ring = HashRing(replicas)
+        self._inflight = 0
+        self._states = {}
+        self._heap = []
+        self._open = []
+        self._seq = count()
+        for proxy in proxies:
+            self.add(proxy)
+
+    def __len__(self):
+        return len(self._states)
+
+    def __iter__(self):
+        return iter(list(self._states))
+
+    def __contains__(self, proxy):
+        return proxy in self._states
+
+    def get(self, proxy):
+        return self._states.get(proxy)
+
+    def add(self, proxy, latency=None):
+        """Add a proxy, or with a ``latency`` (e.g. a measured one) also reset the latency of a known one."""
+        state = self._states.get(proxy)
+        if state is None:
+            state = self._states[proxy] = ProxyState(proxy, self.initial_latency if latency is None else latency)
+            self.ring.add(proxy)
+            self._push(state)
+        elif latency is not None:
+            state.latency = latency
+            self._push(state)
+
+    def remove(self, proxy):
+        state = self._states.pop(proxy, None)
+        if state is not None:
+            self._inflight -= state.inflight
+            self.ring.remove(proxy)
+            state.version += 1
+
+    def pick(self, key=None, exclude=()):
+        """Return the best proxy and count a request in flight to it, or None if there are none.
+
+        With a ``key``, the proxy the key is mapped to on the ring, see the
+        class docstring. Proxies in ``exclude`` are never returned.
+        """
+        self._reopen()
+        if key is not None:
+            state = self._pickAffine(key, exclude)
+            if state is not None:
+                self._acquire(state)
+                return state.proxy
+        skipped = []
+        try:
+            while self._heap:
+                score, _, version, state = self._heap[0]
+                if version != state.version or self._states.get(state.proxy) is not state:
+                    heappop(self._heap)
+                    continue
+                if state.circuit == HALF_OPEN and state.inflight:
+                    # Its probe is still running
+                    heappop(self._heap)
+                    continue
+                if state.proxy in exclude:
+                    skipped.append(heappop(self._heap))
+                    continue
+                self._acquire(state)
+                return state.proxy
+        finally:
+            for entry in skipped:
+                heappush(self._heap, entry)
+        # Every circuit is open: rather than stalling the crawl, probe the
+        # proxy that would have been retried first.
+        skipped = []
+        try:
+            while self._open:
+                entry = heappop(self._open)
+                _, _, version, state = entry
+                if version == state.version and self._states.get(state.proxy) is state:
+                    if state.proxy in exclude:
+                        skipped.append(entry)
+                        continue
+                    state.circuit = HALF_OPEN
+                    self._acquire(state)
+                    return state.proxy
+        finally:
+            for entry in skipped:
+                heappush(self._open, entry)
+        return None
+
+    def success(self, proxy, latency=None):
+        state = self._release(proxy)
+        if state is None:
+            return
+        state.success += self.alpha * (1.0 - state.success)
+        if latency is not None:
+            state.latency += self.alpha * (latency - state.latency)
+        state.failures = 0
+        if state.circuit != CLOSED:
+            state.circuit = CLOSED
+            state.backoff = 0
+        self._push(state)
+
+    def failure(self, proxy):
+        state = self._release(proxy)
+        if state is None:
+            return
+        state.success -= self.alpha * state.success
+        state.failures += 1
+        if state.circuit == OPEN:
+            # A request sent before the circuit opened, it is already backing off
+            return
+        if state.circuit == HALF_OPEN or state.failures >= self.failure_threshold:
+            self._trip(state)
+        else:
+            self._push(state)
+
+    def release(self, proxy):
+        """Forget a request in flight without judging the proxy for it."""
+        state = self._release(proxy)
+        if state is not None:
+            if state.circuit == HALF_OPEN:
+                # The probe was inconclusive, let the next pick probe again
+                state.open_until = self.clock()
+                self._pushOpen(state)
+            elif state.circuit == CLOSED:
+                self._push(state)
+
+    def merge(self, proxy, latency, success, external, open_until=0):
+        """Blend in what other processes know about a proxy.
+
+        Latency and success rate move toward theirs like with a new sample,
+        their requests in flight count in the proxy's score and a circuit
+        they opened is open here too, until the same time.
+        """
+        state = self._states.get(proxy)
+        if state is None:
+            return
+        state.latency += self.alpha * (latency - state.latency)
+        state.success += self.alpha * (success - state.success)
+        state.external = external
+        if state.circuit == CLOSED and open_until > self.clock():
+            state.open_until = open_until
+            self._pushOpen(state)
+        else:
+            self._push(state)
+
+    def _pickAffine(self, key, exclude=()):
+        bound = ceil(self.load_factor * (self._inflight + 1) / len(self._states)) if self._states else 0
+        for proxy in self.ring.walk(key):
+            state = self._states[proxy]
+            if state.inflight >= bound or state.circuit == OPEN or proxy in exclude:
+                continue
+            if state.circuit == HALF_OPEN and state.inflight:
+                # Its probe is still running
+                continue
+            return state
+        return None
+
+    def _acquire(self, state):
+        self._inflight += 1
+        state.inflight += 1
+        state.version += 1
+        if state.circuit == CLOSED:
+            self._push(state)
+
+    def _release(self, proxy):
+        state = self._states.get(proxy)
+        if state is not None and state.inflight:
+            state.inflight -= 1
+            self._inflight -= 1
+        return state
+
+    def _trip(self, state):
+        state.backoff = min(state.backoff * 2 or self.base_backoff, self.max_backoff)
+        state.open_until = self.clock() + state.backoff
+        state.circuit = OPEN
+        self._pushOpen(state)
+
+    def _reopen(self):
+        now = self.clock()
+        while self._open and self._open[0][0] <= now:
+            _, _, version, state = heappop(self._open)
+            if version == state.version and self._states.get(state.proxy) is state:
+                state.circuit = HALF_OPEN
+                state.version += 1
+                # Probe it before anything else
+                heappush(self._heap, (0, next(self._seq), state.version, state))
+
+    def _push(self, state):
+        if state.circuit != CLOSED:
+            return
+        state.version += 1
+        heappush(self._heap, (state.score(), next(self._seq), state.version, state))
+        if len(self._heap) > 4 * len(self._states) + 16:
+            self._compact()
+
+    def _pushOpen(self, state):
+        state.version += 1
+        state.circuit = OPEN
+        heappush(self._open, (state.open_until, next(self._seq), state.version, state))
+
+    def _compact(self):
+        self._heap = [entry for entry in self._heap
+                      if entry[2] == entry[3].version and self._states.get(entry[3].proxy) is entry[3]]
+        heapify(self._heap)
@@ -0,0 +1,123 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from collections import Counter
+from itertools import count
+from statistics import median
+from zlib import crc32
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy_socks.config import isolated_config
+
+
+class StreamIsolation(object):
+    """Spreads the requests through SOCKS5 proxies over ``buckets`` Tor circuits.
+
+    Tor puts streams with different SOCKS username/password on different
+    circuits (IsolateSOCKSAuth, on by default), so every request is given
+    the credentials of a bucket: picked by its host (``domain``), by its
+    download slot (``slot``) or in turn (``round-robin``). A
+    ``socks_isolation_key`` meta key overrides the host or slot.
+
+    A bucket is rotated, i.e. gets new credentials and so a new circuit,
+    when its EWMA of the download latency is over ``max_latency`` seconds
+    or ``slow_factor`` times the median of the other buckets, once it has
+    ``min_samples`` responses, or after ``max_failures`` timeouts in a row.
+    A request with a true ``socks_isolation_rotate`` meta key rotates its
+    bucket before it is sent.
+
+    :param retire: callable given the proxy configs of a rotated bucket,
+        e.g. to close their pooled connections.
+    """
+
+    MODES = ('domain', 'slot', 'round-robin')
+
+    def __init__(self, mode='domain', buckets=8, prefix='scrapy', slow_factor=3.0, max_latency=0, max_failures=3,
+                 min_samples=5, alpha=0.3, stats=None, retire=None):
+        if mode not in self.MODES:
+            raise ValueError('Unknown isolation mode %r, expected one of %s' % (mode, ', '.join(self.MODES)))
+        if buckets < 1:
+            raise ValueError('At least one isolation bucket is needed')
+        self.mode = mode
+        self.buckets = buckets
+        self.prefix = prefix
+        self.slow_factor = slow_factor
+        self.max_latency = max_latency
+        self.max_failures = max_failures
+        self.min_samples = min_samples
+        self.alpha = alpha
+        self.stats = stats
+        self.retire = retire
+        self._turns = count()
+        self._generations = Counter()
+        # bucket -> [latency EWMA, samples]
+        self._latency = {}
+        self._failures = Counter()
+        # bucket -> proxy configs handed out with its current token
+        self._configs = {}
+
+    def bucket(self, request):
+        key = request.meta.get('socks_isolation_key')
+        if key is None:
+            if self.mode == 'round-robin':
+                return next(self._turns) % self.buckets
+            if self.mode == 'slot':
+                key = request.meta.get('download_slot')
+            if key is None:
+                key = urlparse_cached(request).hostname or ''
+        return crc32(str(key).encode('utf-8')) % self.buckets
+
+    def token(self, bucket):
+        return '%s-%d-%d' % (self.prefix, bucket, self._generations[bucket])
+
+    def isolate(self, proxy_config, request):
+        """Return the proxy config to send ``request`` with, noting its bucket in the request meta."""
+        if proxy_config.version not in ('5', '5h'):
+            return proxy_config
+        bucket = self.bucket(request)
+        if request.meta.pop('socks_isolation_rotate', False):
+            self.rotate(bucket, 'requested')
+        token = self.token(bucket)
+        request.meta['socks_isolation_bucket'] = bucket
+        request.meta['socks_isolation_token'] = token
+        config = isolated_config(proxy_config, token)
+        self._configs.setdefault(bucket, set()).add(config)
+        return config
+
+    def observe(self, bucket, token, latency):
+        if token != self.token(bucket):
+            # Sent before the bucket was rotated
+            return
+        self._failures.pop(bucket, None)
+        entry = self._latency.get(bucket)
+        if entry is None:
+            entry = self._latency[bucket] = [latency, 0]
+        else:
+            entry[0] += self.alpha * (latency - entry[0])
+        entry[1] += 1
+        if entry[1] >= self.min_samples and self._slow(bucket, entry[0]):
+            self.rotate(bucket, 'slow')
+
+    def failed(self, bucket, token):
+        if token != self.token(bucket):
+            return
+        self._failures[bucket] += 1
+        if self.max_failures and self._failures[bucket] >= self.max_failures:
+            self.rotate(bucket, 'failures')
+
+    def rotate(self, bucket, reason='requested'):
+        self._generations[bucket] += 1
+        self._latency.pop(bucket, None)
+        self._failures.pop(bucket, None)
+        configs = self._configs.pop(bucket, ())
+        if self.stats is not None:
+            self.stats.inc_value('socks/isolation/rotated/%s' % reason)
+        if self.retire is not None and configs:
+            self.retire(configs)
+
+    def _slow(self, bucket, latency):
+        if self.max_latency and latency > self.max_latency:
+            return True
+        if not self.slow_factor:
+            return False
+        others = [entry[0] for other, entry in self._latency.items()
+                  if other != bucket and entry[1] >= self.min_samples]
+        return bool(others) and latency > self.slow_factor * median(others)
@@ -0,0 +1,218 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from twisted.internet.error import ConnectionRefusedError, TCPTimedOutError
+from twisted.internet.task import LoopingCall
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+from scrapy_socks.config import parse_proxy
+from scrapy_socks.exceptions import SOCKSError, SOCKSReplyError
+from scrapy_socks.replycache import DESTINATION_REPLIES
+from scrapy_socks.health import ProxyHealthPool, OPEN
+from scrapy_socks.shared import SharedHealthStore
+from scrapy_socks.stats import proxy_label
+from scrapy_socks.signals import proxies_probed
+
+
+class SOCKSProxyMiddleware(object):
+    """Downloader middleware spreading requests over a pool of SOCKS proxies.
+
+    Each request without an explicit ``proxy`` meta key gets the proxy with
+    the best score in a ProxyHealthPool, which tracks an EWMA of the SOCKS
+    handshake latency and of the success rate of every proxy. Proxies that
+    keep failing are circuit-broken and probed again after a backoff.
+
+    With SOCKSProxyProber enabled, the proxies are replaced by the ones it
+    keeps once it has probed them, seeded with their measured handshake
+    latency.
+
+    Settings:
+
+    * ``SOCKS_PROXIES`` -- list of ``socks*://`` proxy URLs, may be empty
+      when ``SOCKS_PROBE_ENABLED`` is set
+    * ``SOCKS_HEALTH_EWMA_ALPHA`` -- EWMA smoothing factor (default 0.3)
+    * ``SOCKS_CIRCUIT_FAILURES`` -- consecutive failures opening a circuit (default 5)
+    * ``SOCKS_CIRCUIT_BACKOFF`` -- first backoff in seconds, doubled on every
+      failed probe (default 30)
+    * ``SOCKS_CIRCUIT_MAX_BACKOFF`` -- backoff cap in seconds (default 600)
+    * ``SOCKS_RACE_CANDIDATES`` -- number of next best proxies to put in
+      ``socks_race_proxies`` so the handshake is raced against them (default 0)
+    * ``SOCKS_AFFINITY`` -- route each destination host to the same proxy
+      by consistent hashing with bounded loads, so its pooled tunnels and
+      TLS sessions get reused (default False)
+    * ``SOCKS_AFFINITY_LOAD_FACTOR`` -- how far above the average number of
+      requests in flight a proxy may go before its hosts spill over to the
+      next proxy on the ring (default 1.25)
+    * ``SOCKS_AFFINITY_REPLICAS`` -- ring points per proxy (default 100)
+    * ``SOCKS_REPLY_REROUTES`` -- how many other proxies a request is sent
+      through after failure replies that only depend on the destination
+      (``SOCKS_REPLY_CACHE_REPLIES``, e.g. not allowed by ruleset). They
+      don't count against the proxy's health (default 2)
+    * ``SOCKS_SHARED_HEALTH_FILE`` -- share proxy health with the other
+      crawl processes of the host through this memory-mapped file, see
+      SharedHealthStore (default None, not shared)
+    * ``SOCKS_SHARED_HEALTH_INTERVAL`` -- seconds between exchanges with
+      the shared file (default 1)
+    * ``SOCKS_SHARED_HEALTH_SLOTS`` -- records in the shared file, one per
+      proxy and process (default 4096)
+    * ``SOCKS_SHARED_HEALTH_STALE`` -- seconds after which the records of a
+      process that stopped writing are ignored (default 30)
+    """
+
+    # Exceptions that count against the proxy rather than the destination
+    PROXY_FAILURES = (SOCKSError, ConnectionRefusedError, TCPTimedOutError)
+
+    def __init__(self, health, stats=None, race_candidates=0, affinity=False, reroutes=2,
+                 destination_replies=DESTINATION_REPLIES, shared=None, shared_interval=1):
+        self.health = health
+        self.shared = shared
+        self.shared_interval = shared_interval
+        self._sharedKeys = {}
+        self._sharing = None
+        self.stats = stats
+        self.race_candidates = race_candidates
+        self.affinity = affinity
+        self.reroutes = reroutes
+        self.destination_replies = frozenset(destination_replies)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        proxies = settings.getlist('SOCKS_PROXIES')
+        if not proxies and not settings.getbool('SOCKS_PROBE_ENABLED'):
+            raise NotConfigured('SOCKS_PROXIES is empty')
+        health = ProxyHealthPool(proxies,
+                                 alpha=settings.getfloat('SOCKS_HEALTH_EWMA_ALPHA', 0.3),
+                                 failure_threshold=settings.getint('SOCKS_CIRCUIT_FAILURES', 5),
+                                 backoff=settings.getfloat('SOCKS_CIRCUIT_BACKOFF', 30),
+                                 max_backoff=settings.getfloat('SOCKS_CIRCUIT_MAX_BACKOFF', 600),
+                                 load_factor=settings.getfloat('SOCKS_AFFINITY_LOAD_FACTOR', 1.25),
+                                 replicas=settings.getint('SOCKS_AFFINITY_REPLICAS', 100))
+        replies = [int(r, 0) if isinstance(r, str) else r
+                   for r in settings.getlist('SOCKS_REPLY_CACHE_REPLIES', DESTINATION_REPLIES)]
+        shared = None
+        if settings.get('SOCKS_SHARED_HEALTH_FILE'):
+            shared = SharedHealthStore(settings['SOCKS_SHARED_HEALTH_FILE'],
+                                       slots=settings.getint('SOCKS_SHARED_HEALTH_SLOTS', 4096),
+                                       stale=settings.getfloat('SOCKS_SHARED_HEALTH_STALE', 30))
+        middleware = cls(health, crawler.stats, settings.getint('SOCKS_RACE_CANDIDATES', 0),
+                         settings.getbool('SOCKS_AFFINITY'), settings.getint('SOCKS_REPLY_REROUTES', 2), replies,
+                         shared, settings.getfloat('SOCKS_SHARED_HEALTH_INTERVAL', 1))
+        crawler.signals.connect(middleware.proxies_probed, signal=proxies_probed)
+        if shared is not None:
+            crawler.signals.connect(middleware.spider_opened, signal=signals.spider_opened)
+            crawler.signals.connect(middleware.spider_closed, signal=signals.spider_closed)
+        return middleware
+
+    def spider_opened(self, spider):
+        self._sharing = LoopingCall(self.share)
+        self._sharing.start(self.shared_interval)
+
+    def spider_closed(self, spider):
+        if self._sharing is not None and self._sharing.running:
+            self._sharing.stop()
+        self.shared.close()
+
+    def share(self):
+        """Publish this process' view of the proxies and blend in the other processes' one."""
+        others = self.shared.read()
+        for proxy in self.health:
+            key = self._sharedKeys.get(proxy)
+            if key is None:
+                # Keyed on the proxy address, whatever the credentials in the URL
+                key = self._sharedKeys[proxy] = self.shared.key(proxy_label(parse_proxy(proxy)))
+            state = self.health.get(proxy)
+            self.shared.publish(key, state.latency, state.success, state.inflight,
+                                state.open_until if state.circuit == OPEN else 0)
+            health = others.get(key)
+            if health is not None:
+                self.health.merge(proxy, health.latency, health.success, health.inflight, health.open_until)
+            elif state.external:
+                # The others stopped using it
+                self.health.merge(proxy, state.latency, state.success, 0)
+
+    def proxies_probed(self, ranked, results):
+        keep = set(result.proxy for result in ranked)
+        for proxy in self.health:
+            if proxy not in keep:
+                self.health.remove(proxy)
+        for result in ranked:
+            self.health.add(result.proxy, result.handshake)
+
+    def process_request(self, request, spider):
+        if request.meta.get('proxy') and 'socks_proxy' not in request.meta:
+            # Chosen by someone else, leave it alone
+            return None
+        proxy = self.health.pick(urlparse_cached(request).hostname if self.affinity else None,
+                                 exclude=request.meta.get('socks_excluded_proxies', ()))
+        if proxy is None:
+            return None
+        request.meta['proxy'] = request.meta['socks_proxy'] = proxy
+        if self.race_candidates:
+            request.meta['socks_race_proxies'] = self._alternatives(proxy)
+        return None
+
+    def _alternatives(self, proxy):
+        # Health is only tracked for the primary proxy, so the alternatives
+        # are released again right after being picked.
+        alternatives = []
+        for _ in range(self.race_candidates):
+            alternative = self.health.pick(exclude=[proxy] + alternatives)
+            if alternative is None:
+                break
+            alternatives.append(alternative)
+        for alternative in alternatives:
+            self.health.release(alternative)
+        return alternatives
+
+    def process_response(self, request, response, spider):
+        proxy = request.meta.get('socks_proxy')
+        if proxy is None:
+            return response
+        winner = (request.meta.get('socks_timestamps') or {}).get('WINNER')
+        if winner is not None and winner != parse_proxy(proxy):
+            # An alternative won the handshake race, this says nothing about the primary
+            self.health.release(proxy)
+        else:
+            self.health.success(proxy, self._handshakeLatency(request))
+        return response
+
+    def process_exception(self, request, exception, spider):
+        proxy = request.meta.get('socks_proxy')
+        if proxy is None:
+            return None
+        if isinstance(exception, SOCKSReplyError) and exception.reply in self.destination_replies:
+            # The proxy is fine, it just won't reach this destination
+            self.health.release(proxy)
+            return self._reroute(request, proxy)
+        if isinstance(exception, self.PROXY_FAILURES) and not self._destinationRefused(exception):
+            self.health.failure(proxy)
+            if self.stats is not None:
+                self.stats.inc_value('socks/health/failures')
+        else:
+            self.health.release(proxy)
+        return None
+
+    @staticmethod
+    def _destinationRefused(exception):
+        # SOCKS5 reply 0x05: the proxy works, the destination refused the connection
+        return isinstance(exception, ConnectionRefusedError) and getattr(exception, 'reply', None) == 0x05
+
+    def _reroute(self, request, proxy):
+        excluded = list(request.meta.get('socks_excluded_proxies', ())) + [proxy]
+        if len(excluded) > self.reroutes or len(excluded) >= len(self.health):
+            return None
+        if self.stats is not None:
+            self.stats.inc_value('socks/health/rerouted')
+        # Picks another proxy when it goes through process_request again
+        rerouted = request.replace(dont_filter=True)
+        rerouted.meta['socks_excluded_proxies'] = excluded
+        return rerouted
+
+    @staticmethod
+    def _handshakeLatency(request):
+        # Only set when the request opened a new tunnel instead of reusing a pooled one
+        timestamps = request.meta.get('socks_timestamps') or {}
+        if 'START' in timestamps and 'RESPONSE' in timestamps:
+            return timestamps['RESPONSE'] - timestamps['START']
+        return None
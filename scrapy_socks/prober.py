@@ -0,0 +1,270 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from collections import Counter
+import logging
+from urllib.parse import urlsplit
+
+from twisted.internet import defer
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.error import ConnectionDone
+from twisted.internet.protocol import Factory, Protocol
+from twisted.python.failure import Failure
+from scrapy import signals
+from scrapy.core.downloader.contextfactory import load_context_factory_from_settings
+from scrapy.exceptions import NotConfigured
+from scrapy_socks.config import parse_proxy
+from scrapy_socks.endpoint import SOCKSWrapper
+from scrapy_socks.exceptions import SOCKSError
+from scrapy_socks.resolver import HostResolver
+from scrapy_socks.signals import proxies_probed
+from scrapy_socks.tls import TLSWrapClientEndpoint
+
+
+logger = logging.getLogger(__name__)
+
+
+class ProbeError(SOCKSError):
+    """The probe target's answer through the proxy was not an HTTP response."""
+
+
+class ProbeResult(object):
+    """What probing one proxy found, latencies in seconds since the probe started."""
+    __slots__ = ('proxy', 'connect', 'handshake', 'first_byte', 'error')
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        # Connected to the proxy, tunnel established, first byte of the target's response
+        self.connect = self.handshake = self.first_byte = None
+        # Exception class name if the probe failed
+        self.error = None
+
+    @property
+    def alive(self):
+        return self.error is None and self.first_byte is not None
+
+    def __repr__(self):
+        return '<ProbeResult %s connect=%s handshake=%s first_byte=%s error=%s>' % (
+            self.proxy, self.connect, self.handshake, self.first_byte, self.error)
+
+
+class ProbeProtocol(Protocol):
+    """Sends a request through the tunnel and notes when its response starts."""
+
+    def __init__(self, request, clock, done):
+        self.request = request
+        self.clock = clock
+        self.done = done
+        self.firstByte = None
+        self._buffer = b''
+
+    def connectionMade(self):
+        self.transport.write(self.request)
+
+    def dataReceived(self, data):
+        if self.firstByte is None:
+            self.firstByte = self.clock.seconds()
+        if self.done.called:
+            return
+        self._buffer += data
+        if len(self._buffer) >= 5:
+            if self._buffer.startswith(b'HTTP/'):
+                self.done.callback(self.firstByte)
+            else:
+                self.done.errback(ProbeError('Not an HTTP response: %r' % self._buffer[:32]))
+            self.transport.abortConnection()
+
+    def connectionLost(self, reason=None):
+        if not self.done.called:
+            if reason is None or reason.check(ConnectionDone):
+                reason = ProbeError('Connection closed before a response')
+            self.done.errback(reason)
+
+
+class SOCKSProxyProber(object):
+    """Probes a proxy list when the spider opens and keeps the best proxies.
+
+    Every proxy is sent a request for ``SOCKS_PROBE_URL`` through a SOCKS
+    tunnel, at most ``SOCKS_PROBE_CONCURRENCY`` at a time, timing the
+    connection to the proxy, the handshake and the first byte of the
+    response. The spider's first request waits until all of them are done.
+    Proxies that answered are ranked by time to first byte, filtered by
+    ``SOCKS_PROBE_MAX_LATENCY`` and cut to ``SOCKS_PROBE_KEEP``, then sent
+    with the ``scrapy_socks.signals.proxies_probed`` signal, which
+    SOCKSProxyMiddleware uses to replace its proxies. If none is left, the
+    spider is closed with the ``socks_no_live_proxies`` reason rather than
+    crawling without proxies.
+
+    Settings:
+
+    * ``SOCKS_PROBE_ENABLED`` -- enables the extension (default False)
+    * ``SOCKS_PROBE_FILE`` -- file with one proxy URL per line, blank lines
+      and lines starting with ``#`` are skipped. Probed along with
+      ``SOCKS_PROXIES``
+    * ``SOCKS_PROBE_URL`` -- HTTP or HTTPS URL requested through every
+      proxy (default ``http://example.com/``)
+    * ``SOCKS_PROBE_CONCURRENCY`` -- probes in flight (default 100)
+    * ``SOCKS_PROBE_TIMEOUT`` -- seconds a probe may take in all (default 10)
+    * ``SOCKS_PROBE_MAX_LATENCY`` -- drop proxies slower than this many
+      seconds to the first byte (default 0, no limit)
+    * ``SOCKS_PROBE_KEEP`` -- keep only this many of the fastest proxies
+      (default 0, all)
+    * ``SOCKS_PROBE_OUTPUT`` -- write the kept proxies, best first, to this
+      file in the ``SOCKS_PROBE_FILE`` format
+    """
+
+    def __init__(self, crawler, proxies, url, concurrency=100, timeout=10, max_latency=0, keep=0, output=None):
+        from twisted.internet import reactor
+        self.crawler = crawler
+        self.proxies = proxies
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_latency = max_latency
+        self.keep = keep
+        self.output = output
+        self.results = []
+        self.ranked = []
+        self._reactor = reactor
+        self._resolver = HostResolver(reactor, timeout=timeout, stats=crawler.stats)
+        self._contextFactory = load_context_factory_from_settings(crawler.settings, crawler)
+        self._pending = set()
+
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError('SOCKS_PROBE_URL must be an http:// or https:// URL, got %r' % url)
+        self._tls = parts.scheme == 'https'
+        self._host = parts.hostname
+        self._port = parts.port or (443 if self._tls else 80)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        self._request = ('HEAD %s HTTP/1.1\r\nHost: %s\r\nUser-Agent: %s\r\nConnection: close\r\n\r\n' % (
+            path, parts.netloc, crawler.settings.get('USER_AGENT'))).encode('ascii')
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('SOCKS_PROBE_ENABLED'):
+            raise NotConfigured
+        proxies = list(settings.getlist('SOCKS_PROXIES'))
+        if settings.get('SOCKS_PROBE_FILE'):
+            proxies.extend(cls.read_proxies(settings['SOCKS_PROBE_FILE']))
+        if not proxies:
+            raise NotConfigured('No proxies to probe, set SOCKS_PROBE_FILE or SOCKS_PROXIES')
+        prober = cls(crawler, list(dict.fromkeys(proxies)),
+                     settings.get('SOCKS_PROBE_URL', 'http://example.com/'),
+                     concurrency=settings.getint('SOCKS_PROBE_CONCURRENCY', 100),
+                     timeout=settings.getfloat('SOCKS_PROBE_TIMEOUT', 10),
+                     max_latency=settings.getfloat('SOCKS_PROBE_MAX_LATENCY', 0),
+                     keep=settings.getint('SOCKS_PROBE_KEEP', 0),
+                     output=settings.get('SOCKS_PROBE_OUTPUT'))
+        crawler.signals.connect(prober.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(prober.spider_closed, signal=signals.spider_closed)
+        return prober
+
+    @staticmethod
+    def read_proxies(path):
+        with open(path) as f:
+            return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+    def spider_opened(self, spider):
+        # The engine waits for this before scheduling the first request
+        d = self.probe_all()
+        d.addCallback(self._probed, spider)
+        return d
+
+    def spider_closed(self, spider):
+        for d in list(self._pending):
+            d.cancel()
+
+    def probe_all(self):
+        """Probe every proxy, return a deferred firing with the ranked ProbeResults."""
+        start = self._reactor.seconds()
+        semaphore = defer.DeferredSemaphore(self.concurrency)
+        d = defer.gatherResults([semaphore.run(self.probe, proxy) for proxy in self.proxies])
+
+        def rank(results):
+            self.results = results
+            alive = sorted((r for r in results if r.alive), key=lambda r: r.first_byte)
+            ranked = [r for r in alive if not self.max_latency or r.first_byte <= self.max_latency]
+            self.ranked = ranked[:self.keep] if self.keep else ranked
+            stats = self.crawler.stats
+            stats.set_value('socks/probe/proxies', len(results))
+            stats.set_value('socks/probe/alive', len(alive))
+            stats.set_value('socks/probe/kept', len(self.ranked))
+            stats.set_value('socks/probe/duration_s', round(self._reactor.seconds() - start, 3))
+            for error, count in Counter(r.error for r in results if r.error).items():
+                stats.set_value('socks/probe/errors/%s' % error, count)
+            return self.ranked
+
+        return d.addCallback(rank)
+
+    def probe(self, proxy):
+        """Probe a single proxy, return a deferred firing with its ProbeResult (it never fails)."""
+        result = ProbeResult(proxy)
+        try:
+            proxy_config = parse_proxy(proxy)
+        except Exception as e:
+            logger.warning('Invalid proxy %r in the probe list: %s', proxy, e)
+            result.error = type(e).__name__
+            return defer.succeed(result)
+
+        timestamps = {}
+        endpoint = SOCKSWrapper(self._reactor, TCP4ClientEndpoint(self._reactor, self._host, self._port),
+                                proxy_config, timestamps=timestamps, connectTimeout=self.timeout,
+                                handshakeTimeout=self.timeout, resolver=self._resolver)
+        if self._tls:
+            endpoint = TLSWrapClientEndpoint(self._contextFactory.creatorForNetloc(self._host.encode('idna'),
+                                                                                    self._port),
+                                             endpoint, reactor=self._reactor, timeout=self.timeout)
+        responded = defer.Deferred()
+        factory = Factory.forProtocol(lambda: ProbeProtocol(self._request, self._reactor, responded))
+        connected = endpoint.connect(factory)
+        protocols = []
+
+        def failed(failure):
+            if not responded.called:
+                responded.errback(failure)
+
+        def cancel(_):
+            connected.cancel()
+            for protocol in protocols:
+                protocol.transport.abortConnection()
+            if not responded.called:
+                responded.cancel()
+
+        # Covers the tunnel and the response, whichever is pending
+        d = defer.Deferred(cancel)
+        connected.addCallbacks(protocols.append, failed)
+        responded.addBoth(d.callback)
+        d.addTimeout(self.timeout, self._reactor)
+        self._pending.add(d)
+
+        def done(outcome):
+            self._pending.discard(d)
+            start = timestamps.get('START')
+            if start is not None:
+                if 'CONNECTED' in timestamps:
+                    result.connect = timestamps['CONNECTED'] - start
+                if 'RESPONSE' in timestamps:
+                    result.handshake = timestamps['RESPONSE'] - start
+            if isinstance(outcome, Failure):
+                result.error = outcome.type.__name__
+            elif start is not None:
+                result.first_byte = outcome - start
+            return result
+
+        return d.addBoth(done)
+
+    def _probed(self, ranked, spider):
+        results = self.results
+        logger.info('Probed %d SOCKS proxies: %d answered, keeping %d', len(results),
+                    sum(1 for r in results if r.alive), len(ranked), extra={'spider': spider})
+        if self.output:
+            with open(self.output, 'w') as f:
+                f.writelines('%s\n' % r.proxy for r in ranked)
+        self.crawler.signals.send_catch_log(proxies_probed, ranked=ranked, results=results)
+        if not ranked:
+            logger.error('No SOCKS proxy passed the probe, closing the spider', extra={'spider': spider})
+            # Nothing may go out without a proxy, and the engine can't close
+            # a spider it is still opening.
+            self.crawler.engine.pause()
+            self._reactor.callLater(0, self.crawler.engine.close_spider, spider, 'socks_no_live_proxies')
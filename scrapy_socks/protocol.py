@@ -3,54 +3,248 @@ __author__ = 'Constantine Slednev <c.slednev@gmail.com>'
 
 from twisted.internet import defer
 from twisted.internet.error import ConnectionRefusedError
-from twisted.internet.interfaces import IStreamClientEndpoint, IReactorTime
+from twisted.internet.interfaces import IStreamClientEndpoint, IReactorTime, IHandshakeListener
 from twisted.internet.protocol import Protocol, ClientFactory
 from twisted.internet.endpoints import _WrappingFactory, TCP4ClientEndpoint
 from twisted.web.client import Agent as BaseAgent, SchemeNotSupported, BrowserLikePolicyForHTTPS
 from twisted.web.iweb import IAgentEndpointFactory, IAgent, IPolicyForHTTPS
 from twisted.protocols import tls
-from zope.interface import implementer
+from zope.interface import implementer, directlyProvides, providedBy
 import struct
 import socket
 import re
+from scrapy_socks.exceptions import SOCKSError, SOCKSPipelineRejected, SOCKSTimeoutError, SOCKSReplyError
+from scrapy_socks.handshake import ReceiveBuffer, read_socks5_method_reply, read_socks5_auth_reply, \
+    read_socks5_reply, read_socks4_reply, encode_host, is_hostname, socks5_connect_request, \
+    socks4_connect_request, ATYP_IPV4, ATYP_IPV6
+
+
+class RelayedTunnel(Protocol):
+    """Stands between an established tunnel and the relayed protocol to tell when the tunnel closes.
+
+    The relayed protocol still writes to the proxy connection directly.
+    """
+    __slots__ = ('wrappedProtocol', '_closed')
+
+    def __init__(self, wrappedProtocol, closed=None):
+        self.wrappedProtocol = wrappedProtocol
+        self._closed = closed
+
+    def dataReceived(self, data):
+        self.wrappedProtocol.dataReceived(data)
+
+    def connectionLost(self, reason):
+        try:
+            self.wrappedProtocol.connectionLost(reason)
+        finally:
+            if self._closed is not None:
+                self._closed(reason)
+
+
+class MeteredTunnel(RelayedTunnel):
+    """A RelayedTunnel that also feeds a TransferMeter.
+
+    The relayed protocol must be connected to ``relayTransport``, which
+    counts what it writes.
+    """
+    __slots__ = ('meter', 'relayTransport')
+
+    def __init__(self, wrappedProtocol, closed, meter, transport):
+        RelayedTunnel.__init__(self, wrappedProtocol, closed)
+        self.meter = meter
+        self.relayTransport = MeteredTransport(transport, meter)
+
+    def dataReceived(self, data):
+        self.meter.received(len(data))
+        self.wrappedProtocol.dataReceived(data)
+
+    def connectionLost(self, reason):
+        self.meter.flush()
+        RelayedTunnel.connectionLost(self, reason)
+
+
+@implementer(IHandshakeListener)
+class MeteredProtocol(Protocol):
+    """Stands between TLS and the relayed protocol to feed a TransferMeter the plaintext.
+
+    That is what the asyncio connector counts: neither the TLS handshake
+    nor the record overhead, and a request held back by the handshake is
+    timed from when the handshake completed.
+    """
+    __slots__ = ('wrappedProtocol', 'meter')
+
+    def __init__(self, wrappedProtocol, meter):
+        self.wrappedProtocol = wrappedProtocol
+        self.meter = meter
+
+    def connectionMade(self):
+        self.wrappedProtocol.makeConnection(MeteredTransport(self.transport, self.meter))
+
+    def handshakeCompleted(self):
+        self.meter.started()
+        if IHandshakeListener.providedBy(self.wrappedProtocol):
+            self.wrappedProtocol.handshakeCompleted()
+
+    def dataReceived(self, data):
+        self.meter.received(len(data))
+        self.wrappedProtocol.dataReceived(data)
+
+    def connectionLost(self, reason):
+        self.meter.flush()
+        self.wrappedProtocol.connectionLost(reason)
+
+
+class MeteredTransport(object):
+    """Passes everything through to ``transport``, counting the bytes written."""
+    __slots__ = ('_transport', '_meter', '__provides__')
+
+    def __init__(self, transport, meter):
+        self._transport = transport
+        self._meter = meter
+        directlyProvides(self, providedBy(transport))
+
+    def write(self, data):
+        self._meter.sent(len(data))
+        self._transport.write(data)
+
+    def writeSequence(self, data):
+        self._meter.sent(sum(map(len, data)))
+        self._transport.writeSequence(data)
+
+    def __getattr__(self, name):
+        return getattr(self._transport, name)
 
 
 class SOCKSClientProtocol(Protocol):
-    buf = b''
+    # One per connection in progress, so no instance dicts. Everything but
+    # the proxy config is set by SOCKSClientFactory.buildProtocol.
+    __slots__ = ('factory', 'transport', 'connected', 'proxy_config', 'buf', 'protocol_state',
+                 'postHandshakeEndpoint', 'postHandshakeFactory', 'handshakeDone', 'handshakeTimeout',
+                 'pipeline', 'tunnelClosed', 'transferMeter', 'relayHost', 'bound_address', 'bound_port',
+                 '_timestamps', '_timer', '_reactor', '_deadline')
+
+    def __init__(self):
+        self.factory = self.transport = None
+        self.connected = 0
+        self.buf = None
+        self.protocol_state = 'begin'
+        self.handshakeTimeout = None
+        # When set, the greeting, the username/password request and the CONNECT
+        # request are written at once instead of waiting for each reply (SOCKS5 only).
+        self.pipeline = False
+        # Called with the reason once an established tunnel closes, if set
+        self.tunnelClosed = None
+        # Counts the traffic through the established tunnel, if set (a TransferMeter)
+        self.transferMeter = None
+        # Locally resolved address of the destination, sent instead of its hostname
+        self.relayHost = None
+        self.bound_address = self.bound_port = None
+        self._timestamps = self._timer = None
+        self._deadline = None
 
     def noteTime(self, event):
         if self._timer:
             self._timestamps[event] = self._timer.seconds()
 
-    def abort(self, errmsg, exception=SOCKSError):
+    def abort(self, errmsg, exception=SOCKSError, reply=None):
+        self.protocol_state = 'aborted'
+        self.cancelDeadline()
         self.transport.loseConnection()
-        self.handshakeDone.errback(exception('SOCKS %s: %s' % (self.proxy_config['version'], errmsg)))
+        if not self.handshakeDone.called:
+            error = exception('SOCKS %s: %s' % (self.proxy_config.version, errmsg))
+            # The server's reply code, if it sent one, for stats and error handling
+            error.reply = reply
+            self.handshakeDone.errback(error)
 
     def is_hostname(self, string):
-        dns_label_regex = re.compile(r'^(?![0-9]+$)(?!-)[a-zA-Z0-9-]{,63}(?<!-)$')
-        return all([dns_label_regex.match(label) for label in string.split('.')])
+        return is_hostname(string)
+
+    def makeConnection(self, transport):
+        self.buf = ReceiveBuffer()
+        if self.handshakeTimeout:
+            self._deadline = self._reactor.callLater(self.handshakeTimeout, self.handshakeTimedOut)
+        Protocol.makeConnection(self, transport)
+
+    def cancelDeadline(self):
+        if self._deadline is not None:
+            if self._deadline.active():
+                self._deadline.cancel()
+            self._deadline = None
+
+    def handshakeTimedOut(self):
+        self._deadline = None
+        state, self.protocol_state = self.protocol_state, 'aborted'
+        # A stalled proxy won't answer a graceful close either
+        self.transport.abortConnection()
+        if not self.handshakeDone.called:
+            self.handshakeDone.errback(SOCKSTimeoutError('SOCKS %s: Handshake not finished after %ss (state %s)' % (
+                self.proxy_config.version, self.handshakeTimeout, state)))
+
+    def connectionLost(self, reason):
+        self.cancelDeadline()
+        # The relayed protocol takes over the transport after setupRelay, so
+        # this only runs when the proxy goes away mid-handshake.
+        if not self.handshakeDone.called:
+            self.handshakeDone.errback(SOCKSError('SOCKS %s: Connection lost during handshake (%s)' % (
+                self.proxy_config.version, reason.getErrorMessage())))
 
     # Called when verifySocksReply was successful
     def setupRelay(self):
         self.noteTime('RESPONSE')
+        self.cancelDeadline()
+        # Anything the server sent after its reply already belongs to the relayed protocol
+        leftover = self.buf.drain()
         # Build protocol from provided factory and transfer control to it.
-        self.transport.protocol = self.postHandshakeFactory.buildProtocol(self.transport.getPeer())
-        self.transport.protocol.makeConnection(self.transport)
-        self.handshakeDone.callback(self.transport.protocol)
-
-    # Checks if the relayRequest was successful
-    # Probably ugly to specify members host and port as parameters
-    def verifySocksReply(self, host, port):
+        relayed = self.postHandshakeFactory.buildProtocol(self.transport.getPeer())
+        transport = self.transport
+        meter = self.transferMeter
+        if meter is not None and isinstance(relayed, tls.TLSMemoryBIOProtocol):
+            # Meter above TLS, the tunnel below carries handshakes and records
+            relayed.wrappedProtocol = MeteredProtocol(relayed.wrappedProtocol, meter)
+            meter = None
+        if meter is not None:
+            tunnel = MeteredTunnel(relayed, self.tunnelClosed, meter, self.transport)
+            self.transport.protocol, transport = tunnel, tunnel.relayTransport
+        elif self.tunnelClosed is not None:
+            self.transport.protocol = RelayedTunnel(relayed, self.tunnelClosed)
+        else:
+            self.transport.protocol = relayed
+        relayed.makeConnection(transport)
+        self.handshakeDone.callback(relayed)
+        if leftover:
+            relayed.dataReceived(leftover)
+        self.releaseHandshake()
+
+    def releaseHandshake(self):
+        # The tunnel may stay open (and pooled) for minutes after the relayed
+        # protocol took it over; none of the handshake state is needed for that.
+        if self.factory is not None:
+            self.factory.releaseHandshake()
+        self.buf = self.handshakeDone = None
+        self.postHandshakeEndpoint = self.postHandshakeFactory = None
+        self.tunnelClosed = self.transferMeter = None
+        self._timestamps = None
+
+    # Checks if the relayRequest was successful. Returns True once a complete
+    # reply has been consumed from self.buf, False if more data is needed or
+    # the connection was aborted.
+    def verifySocksReply(self):
         pass
 
     # Also called "connection request". This method initiates a SOCKS connection.
     # All SOCKS versions share this (main) functionality
-    def sendRelayRequest(self):
+    def sendRelayRequest(self, host, port):
         pass
 
+    def relayAddress(self):
+        return self.relayHost or self.postHandshakeEndpoint._host, self.postHandshakeEndpoint._port
+
+    def requestRelay(self):
+        self.sendRelayRequest(*self.relayAddress())
+
 
 class SOCKSv5ClientProtocol(SOCKSClientProtocol):
-    protocol_state = 'begin'
+    __slots__ = ()
     # Directly taken from socksipy
     SOCKS5_ERRORS = {
         0x01: "General SOCKS server failure",
@@ -64,134 +258,128 @@ class SOCKSv5ClientProtocol(SOCKSClientProtocol):
     }
 
     def negotiateAuthenticationMethod(self):
-        if self.proxy_config['version_specific']['username'] and self.proxy_config['version_specific']['password']:
-            # 0x05 is the socks version number, 0x02 is the number of auth methods
-            # 0x00 is auth method "No authentication" and 0x02 is auth method "Username/Password"
-            self.transport.write(b"\x05\x02\x00\x02")
+        if self.pipeline:
+            msg = self.buildRelayRequest(*self.relayAddress())
+            if msg is None:
+                return
+            # Only offer the method we are going to use, so the proxy can't
+            # pick one the rest of the pipelined messages don't match.
+            self.transport.write(self.proxy_config.pipelined_greeting + msg)
+            self.noteTime('RELAY_REQUEST_SENT')
         else:
-            # when the user doesn't specify any user/pass creds, try auth method "no authentication"
-            self.transport.write(b'\x05\x01\x00')
+            # The method selection message is precomputed by the proxy config
+            self.transport.write(self.proxy_config.greeting)
 
         self.protocol_state = 'do_auth'
 
-    def authenticate(self, data):
-        where = 'authentication handshake'
-        if len(data) < 2:
-            self.abort('Too few data from server %s.' % where)
+    def authenticated(self):
+        self.noteTime('AUTHENTICATED')
+        if self.pipeline:
+            # The CONNECT request already went out with the greeting
+            self.protocol_state = 'connection_requested'
         else:
-            version, chosen_auth = struct.unpack('!BB', data)
-            if version != 0x5:
-                self.abort('expected 0x5 in %s.' % where)
-                return False
+            self.protocol_state = 'authenticated'
+            self.requestRelay()
+
+    def authenticate(self):
+        where = 'authentication handshake'
+        reply = read_socks5_method_reply(self.buf)
+        if reply is None:
+            return False
+
+        version, chosen_auth = reply
+        if version != 0x5:
+            self.abort('expected 0x5 in %s.' % where)
+            return False
 
+        if self.pipeline:
+            expected_auth = 0x2 if self.proxy_config.auth_request else 0x0
+            if chosen_auth != expected_auth:
+                self.abort('Pipelined handshake rejected, proxy chose auth method %d in %s.' % (chosen_auth, where),
+                           exception=SOCKSPipelineRejected)
+                return False
             if chosen_auth == 0x2:
-                # do user/pass authentication
-                username, password = self.proxy_config['version_specific']['username'], \
-                                     self.proxy_config['version_specific']['password']
-                msg = struct.pack('BB%ssB%ss' % (len(username), len(password)),
-                                  1,
-                                  len(username),
-                                  username.encode(),
-                                  len(password),
-                                  password.encode())
-                self.transport.write(msg)
                 self.noteTime('DO_USER_PASS_AUTH')
                 self.protocol_state = 'check_auth'
-            elif chosen_auth == 0x0:
-                # no authentication required
-                self.noteTime('AUTHENTICATED')
-                self.protocol_state = 'authenticated'
             else:
-                self.abort('Invalid chosen auth method %d in %s.' % (chosen_auth, where))
+                self.authenticated()
+        elif chosen_auth == 0x2 and self.proxy_config.auth_request:
+            # do user/pass authentication
+            self.transport.write(self.proxy_config.auth_request)
+            self.noteTime('DO_USER_PASS_AUTH')
+            self.protocol_state = 'check_auth'
+        elif chosen_auth == 0x0 and not self.proxy_config.auth_required:
+            # no authentication required
+            self.authenticated()
+        else:
+            self.abort('Invalid chosen auth method %d in %s.' % (chosen_auth, where))
+            return False
+        return True
 
-    def checkAuth(self, data):
+    def checkAuth(self):
         where = 'authentication check'
-        if len(data) < 2:
-            self.abort('Too few data from server %s.' % where)
-        else:
-            version, status_code = struct.unpack('!BB', data)
-            if version != 0x1:
-                self.abort('expected 0x01 in %s.' % where)
-                return False
-            if status_code != 0x0:
-                self.abort('Authentication with %s failed in %s.' % (
-                    repr(self.proxy_config['version_specific']['username']), where))
-                return False
-            else:
-                self.noteTime('AUTHENTICATED')
-                self.protocol_state = 'authenticated'
+        reply = read_socks5_auth_reply(self.buf)
+        if reply is None:
+            return False
+
+        version, status_code = reply
+        if version != 0x1:
+            self.abort('expected 0x01 in %s.' % where)
+            return False
+        if status_code != 0x0:
+            self.abort('Authentication with %s failed in %s.' % (
+                repr(self.proxy_config.username), where))
+            return False
+
+        self.authenticated()
+        return True
 
     def sendRelayRequest(self, host, port):
-        # Do the actual connection request
-        # See http://en.wikipedia.org/wiki/SOCKS and the RFC
-        msg = b'\x05'  # message starts with the SOCKS version
-        # There are three types of commands. If no cmd_code is given
-        # in the proxy_config, assume 0x01 (establish a TCP/IP stream connection)
-        msg += b'\x01'
-        # The third byte is reserved and must be 0x00
-        msg += b'\x00'
-        # The fourth bytes specifies the address type
-        # 0x01 for an good old IPv4 address, 0x03 for a domain name, 0x04 for a IPv6 address
-        # First try to parse the given host as a IPv4 address (the most common case), then
-        # assume it's a hostname, if this fails, it must be a IPv6 address, otherwise we have
-        # an error. We can't resolve any hostname at this stage locally (we'd need a blocking call
-        # to gethostbyname()), so we just accept remote dns resolving if host is a DNS name.
-        if self.is_hostname(host):
-            # do remote resolving
-            msg += b'\x03' + chr(len(host)).encode() + host.encode()
-        else:
-            try:
-                addr_bytes = socket.inet_aton(host)
-                msg += b'\x01' + addr_bytes
-            except socket.error:
-                try:
-                    addr_bytes = socket.inet_pton(socket.AF_INET6, host)
-                    msg += b'\x04' + addr_bytes
-                except socket.error:
-                    # Everything failed
-                    self.abort('Invalid host')
-                    return False
-
-        msg += struct.pack(">H", port)
+        msg = self.buildRelayRequest(host, port)
+        if msg is None:
+            return False
         self.transport.write(msg)
         self.noteTime('RELAY_REQUEST_SENT')
         self.protocol_state = 'connection_requested'
 
-    def verifySocksReply(self, data):
-        where = 'SOCKS5 verifySocksReply'
+    def buildRelayRequest(self, host, port):
+        # Do the actual connection request
+        # See http://en.wikipedia.org/wiki/SOCKS and the RFC
+        # The address type is 0x01 for an good old IPv4 address, 0x03 for a domain name and
+        # 0x04 for a IPv6 address. Hostnames are only left here for the proxy to resolve
+        # when no local resolution was asked for (socks5h, or no resolver).
+        address = encode_host(host)
+        if address is None:
+            self.abort('Invalid host')
+            return None
+        return socks5_connect_request(address, port)
+
+    def verifySocksReply(self):
+        reply = read_socks5_reply(self.buf)
+        if reply is None:
+            return False
 
-        if len(data) < 10:  # all hostname are longer than a IPv4 address
-            self.abort('Too few data from server %s.' % where)
-        else:
-            version, reply, rsv, address_type = struct.unpack('!BBBB', data[:4])
+        version, reply, address_type, self.bound_address, self.bound_port = reply
+        if version != 0x5:
+            self.abort('Invalid version')
+            return False
 
-            if version != 0x5:
-                self.abort('Invalid version')
-                return False
+        if reply == 0x5:  # Connection refused
+            self.abort('Connection refused', exception=ConnectionRefusedError, reply=reply)
+            return False
 
-            if reply == 0x5:  # Connection refused
-                self.abort('Connection refused', exception=ConnectionRefusedError)
-                return False
+        if reply != 0x0:
+            self.abort(
+                'Server reply indicates failure. Reason: %s' % self.SOCKS5_ERRORS.get(reply, "Unknown error"),
+                exception=SOCKSReplyError, reply=reply)
+            return False
 
-            if reply != 0x0:
-                self.abort(
-                    'Server reply indicates failure. Reason: %s' % self.SOCKS5_ERRORS.get(reply, "Unknown error"))
-                return False
+        if self.bound_address is None:
+            self.abort('Unknown address type %d in reply' % address_type)
+            return False
 
-            if address_type == 0x1:  # handle IPv4 address
-                self.bound_address, self.bound_port = socket.inet_ntoa(data[4:8]), \
-                                                      struct.unpack('>H', data[8:10])[0]
-            elif address_type == 0x3:  # handle domain name
-                dns_name_len = ord(data[4:5])
-                self.bound_address, self.bound_port = data[5:dns_name_len], \
-                                                      struct.unpack('>H',
-                                                                    data[(5 + dns_name_len):(5 + dns_name_len + 2)])[0]
-            elif address_type == 0x4:  # handle Ipv6 address
-                self.bound_address, self.bound_port = socket.inet_ntop(socket.AF_INET6, data[4:20]), \
-                                                      struct.unpack('>H', data[20:22])[0]
-
-            self.protocol_state = 'connection_verified'
-            return True
+        self.protocol_state = 'connection_verified'
+        return True
 
     def connectionMade(self):
         self.noteTime('CONNECTED')
@@ -199,22 +387,28 @@ class SOCKSv5ClientProtocol(SOCKSClientProtocol):
         self.negotiateAuthenticationMethod()
 
     def dataReceived(self, data):
-        self.buf += data
-
-        if self.protocol_state == 'do_auth':
-            self.authenticate(data)
-        elif self.protocol_state == 'check_auth':
-            self.checkAuth(data)
-        if self.protocol_state == 'authenticated':
-            host = self.postHandshakeEndpoint._host
-            port = self.postHandshakeEndpoint._port
-            self.sendRelayRequest(host, port)
-        elif self.protocol_state == 'connection_requested':
-            if self.verifySocksReply(data):
+        self.buf.feed(data)
+
+        # A single chunk may hold several replies (or only part of one), so keep
+        # stepping through the states for as long as complete messages are buffered.
+        while True:
+            if self.protocol_state == 'do_auth':
+                step = self.authenticate
+            elif self.protocol_state == 'check_auth':
+                step = self.checkAuth
+            elif self.protocol_state == 'connection_requested':
+                step = self.verifySocksReply
+            else:
+                return
+            if not step():
+                return
+            if self.protocol_state == 'connection_verified':
                 self.setupRelay()
+                return
 
 
 class SOCKSv4ClientProtocol(SOCKSClientProtocol):
+    __slots__ = ()
     SOCKS4_ERRORS = {
         0x5B: "Request rejected or failed",
         0x5C: "Request rejected because SOCKS server cannot connect to identd on the client",
@@ -222,59 +416,55 @@ class SOCKSv4ClientProtocol(SOCKSClientProtocol):
     }
 
     def sendRelayRequest(self, host, port):
-        username = self.proxy_config['version_specific']['username']
-        ver, cmd, username = 0x4, 0x1, [b'\x00', username.encode() + b'\x00'][not not username]
-        try:
-            addr = socket.inet_aton(host)
-        except socket.error:
+        address = encode_host(host)
+        if address is None or address.type != ATYP_IPV4:
             self.abort('Not a valid IPv4 address.')
             return False
-        msg = struct.pack('!BBH', ver, cmd, port) + addr + username
-        self.transport.write(msg)
-        self.noteTime('REQUEST')
+        self.transport.write(socks4_connect_request(address, port, self.proxy_config.userid))
+        self.noteTime('RELAY_REQUEST_SENT')
+        self.protocol_state = 'connection_requested'
 
-    def verifySocksReply(self, data):
+    def verifySocksReply(self):
         """
         Return True on success and False on need-more-data or error.
         In the case of an error, the connection is closed and the
         handshakeDone errback is invoked with a SOCKSError exception
         before False is returned.
         """
-        if len(data) < 8:
+        reply = read_socks4_reply(self.buf)
+        if reply is None:
             return False
-        if ord(data[0]) != 0x0:
+        version, status, self.bound_address, self.bound_port = reply
+        if version != 0x0:
             self.abort('Expected 0 bytes')
             return False
-        status = ord(data[1])
         if status != 0x5a:
-            self.abort('Relay request failed. Reason=%s.' % self.SOCKS4_ERRORS.get(data[0], 'Unknown error'))
+            self.abort('Relay request failed. Reason=%s.' % self.SOCKS4_ERRORS.get(status, 'Unknown error'),
+                       exception=SOCKSReplyError, reply=status)
             return False
+        self.protocol_state = 'connection_verified'
         return True
 
     def connectionMade(self):
-        self.noteTime('CONNECT')
+        self.noteTime('CONNECTED')
         self.noteTime('NEGOTIATE')
-        self.sendRelayRequest(self.postHandshakeEndpoint._host, self.postHandshakeEndpoint._port)
+        self.requestRelay()
 
     def dataReceived(self, data):
-        self.buf += data
-        if self.verifySocksReply(data):
+        self.buf.feed(data)
+        if self.protocol_state == 'connection_requested' and self.verifySocksReply():
             self.setupRelay()
 
 
 class SOCKSv4aClientProtocol(SOCKSv4ClientProtocol):
     '''Only extends SOCKS 4 to remotely resolve hostnames.'''
+    __slots__ = ()
 
     def sendRelayRequest(self, host, port):
-        username = self.proxy_config['version_specific']['username']
-        ver, cmd, username = 0x4, 0x1, [b'\x00', username.encode() + b'\x00'][not not username]
-        try:
-            addr = socket.inet_aton(host)
-        except socket.error:
-            addr = '\x00\x00\x00\x01'
-            dnsname = '%s\x00' % host
-            msg = struct.pack('!BBH', ver, cmd, port) + addr + username + dnsname
-        else:
-            msg = struct.pack('!BBH', ver, cmd, port) + addr + username
-        self.transport.write(msg)
-        self.noteTime('REQUEST')
\ No newline at end of file
+        address = encode_host(host)
+        if address is None or address.type == ATYP_IPV6:
+            self.abort('Not a valid IPv4 address or hostname.')
+            return False
+        self.transport.write(socks4_connect_request(address, port, self.proxy_config.userid))
+        self.noteTime('RELAY_REQUEST_SENT')
+        self.protocol_state = 'connection_requested'
@@ -0,0 +1,71 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from collections import OrderedDict
+from scrapy_socks.exceptions import SOCKSCachedReplyError
+
+
+# SOCKS5 replies that depend on the destination rather than on the state of
+# the proxy: not allowed by ruleset, network unreachable, host unreachable
+# and address type not supported. Trying again through the same proxy gets
+# the same answer.
+DESTINATION_REPLIES = (0x02, 0x03, 0x04, 0x08)
+
+SOCKS5_VERSIONS = ('5', '5h')
+
+
+class ReplyFailureCache(object):
+    """Bounded LRU cache of SOCKS failure replies per proxy and destination.
+
+    A connect through a proxy to a destination it answered one of
+    ``replies`` for in the last ``ttl`` seconds fails right away with
+    SOCKSCachedReplyError, without a socket being opened. Only SOCKS5
+    replies are cached; SOCKS4 has a single code for every failure.
+    Entries are kept per proxy address, whatever the credentials used.
+    """
+
+    def __init__(self, reactor, maxsize=10000, ttl=300, replies=DESTINATION_REPLIES, stats=None):
+        self._reactor = reactor
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.replies = frozenset(replies)
+        self.stats = stats
+        # (proxy host, proxy port, host, port) -> (expires at, reply)
+        self._entries = OrderedDict()
+
+    def get(self, proxy_config, host, port):
+        """Return the cached failure reply for the destination through ``proxy_config``, or None."""
+        key = proxy_config.address + (host, port)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, reply = entry
+        if expires <= self._reactor.seconds():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        self._inc('socks/reply_cache/hits')
+        return reply
+
+    def check(self, proxy_config, host, port):
+        """Return the SOCKSCachedReplyError a connect to the destination should fail with, or None."""
+        reply = self.get(proxy_config, host, port)
+        if reply is None:
+            return None
+        error = SOCKSCachedReplyError('SOCKS %s: Server recently answered %#04x for %s:%s, not trying again' % (
+            proxy_config.version, reply, host, port))
+        error.reply = reply
+        return error
+
+    def put(self, proxy_config, host, port, reply):
+        if reply not in self.replies or proxy_config.version not in SOCKS5_VERSIONS:
+            return
+        key = proxy_config.address + (host, port)
+        self._entries[key] = (self._reactor.seconds() + self.ttl, reply)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        self._inc('socks/reply_cache/stored')
+
+    def _inc(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
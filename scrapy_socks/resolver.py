@@ -0,0 +1,121 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from collections import OrderedDict
+from twisted.internet import defer
+from twisted.internet.error import DNSLookupError
+from twisted.names import client, dns
+from twisted.names.error import DNSNameError, DNSQueryTimeoutError, DNSServerError
+from twisted.python.failure import Failure
+import socket
+
+
+class HostResolver(object):
+    """Asynchronous hostname lookups with a shared TTL cache.
+
+    ``resolve`` returns all IPv4 addresses of a host followed by its IPv6
+    ones, from A and AAAA queries sent in parallel. Answers are cached for
+    the smallest TTL of their records (clamped to ``minTTL``..``maxTTL``),
+    and hosts without any address (NXDOMAIN or no A/AAAA records) for
+    ``negativeTTL`` seconds. Timeouts and server failures are not cached,
+    the next lookup asks again. Concurrent
+    lookups of a host that is not cached share a single query.
+
+    :param resolver: An ``IResolver``; by default one built by
+        ``twisted.names.client.createResolver``, which also reads the hosts
+        file.
+    """
+
+    def __init__(self, reactor, resolver=None, maxsize=10000, minTTL=0, maxTTL=3600, negativeTTL=30,
+                 timeout=60, stats=None):
+        self._reactor = reactor
+        self._resolver = resolver if resolver is not None else client.createResolver()
+        self.maxsize = maxsize
+        self.minTTL = minTTL
+        self.maxTTL = maxTTL
+        self.negativeTTL = negativeTTL
+        self.timeout = (timeout,)
+        self.stats = stats
+        # host -> (expires at, addresses or Failure)
+        self._cache = OrderedDict()
+        # host -> [waiting deferreds]
+        self._inflight = {}
+
+    def resolve(self, host):
+        """Return a deferred firing with the addresses of ``host``, or failing with DNSLookupError."""
+        entry = self._cache.get(host)
+        if entry is not None:
+            expires, result = entry
+            if expires > self._reactor.seconds():
+                self._cache.move_to_end(host)
+                self._inc('socks/dns/hits')
+                return defer.fail(result) if isinstance(result, Failure) else defer.succeed(result)
+            del self._cache[host]
+
+        waiters = self._inflight.get(host)
+        query = waiters is None
+        if query:
+            waiters = self._inflight[host] = []
+            self._inc('socks/dns/misses')
+        else:
+            self._inc('socks/dns/shared')
+        # Cancelling only gives up on the answer, the query goes on for the others
+        d = defer.Deferred(lambda d: waiters.remove(d))
+        waiters.append(d)
+        if query:
+            # Last, as the resolver may answer right away
+            self._query(host)
+        return d
+
+    def _query(self, host):
+        queries = [self._resolver.lookupAddress(host, self.timeout),
+                   self._resolver.lookupIPV6Address(host, self.timeout)]
+        dl = defer.DeferredList(queries, consumeErrors=True)
+        dl.addCallback(self._answered, host)
+
+    def _answered(self, results, host):
+        addresses = {dns.A: [], dns.AAAA: []}
+        ttl = None
+        error = None
+        for success, result in results:
+            if not success:
+                if not result.check(DNSNameError):
+                    error = result
+                continue
+            for record in result[0]:
+                if record.type in addresses:
+                    addresses[record.type].append(socket.inet_ntop(
+                        socket.AF_INET if record.type == dns.A else socket.AF_INET6, record.payload.address))
+                    ttl = record.ttl if ttl is None else min(ttl, record.ttl)
+
+        found = addresses[dns.A] + addresses[dns.AAAA]
+        if found:
+            result = found
+            ttl = min(max(ttl, self.minTTL), self.maxTTL)
+        else:
+            self._inc('socks/dns/failures')
+            if error is None:
+                reason = 'no address'
+                ttl = self.negativeTTL
+            else:
+                # Says nothing about the host, only about this attempt
+                reason = ('timed out' if error.check(DNSQueryTimeoutError, defer.TimeoutError) else
+                          'server failure' if error.check(DNSServerError) else
+                          'lookup failed (%s)' % error.getErrorMessage())
+                ttl = 0
+            result = Failure(DNSLookupError('%s: %s' % (host, reason)))
+
+        if ttl:
+            self._cache[host] = (self._reactor.seconds() + ttl, result)
+            self._cache.move_to_end(host)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+
+        for d in self._inflight.pop(host, ()):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def _inc(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
@@ -0,0 +1,162 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from collections import namedtuple
+from hashlib import blake2b
+import mmap
+import os
+import struct
+from time import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# What the other processes know about a proxy, see SharedHealthStore.read
+SharedHealth = namedtuple('SharedHealth', ['latency', 'success', 'inflight', 'open_until', 'processes'])
+
+
+class SharedHealthStore(object):
+    """Proxy health shared by the crawl processes of a host through a memory-mapped file.
+
+    The file holds a header and ``slots`` fixed-size records. Each process
+    owns one record per proxy, found by open addressing on the proxy key,
+    and is its only writer: ``publish`` overwrites it with the process'
+    latency and success rate EWMAs, requests in flight and circuit state.
+    ``read`` sums up the records of the other processes. Writes need no
+    lock, readers skip records caught mid-write by a sequence counter
+    (seqlock). Only claiming a record for a new proxy locks the file
+    header with ``fcntl.lockf``.
+
+    Records not written for ``stale`` seconds belong to processes that are
+    gone: they are ignored and their slots reused.
+    """
+
+    MAGIC = b'SKSH'
+    VERSION = 1
+    HEADER = struct.Struct('<4sII52x')
+    # seq, pid, key, updated, latency, success, open_until, inflight
+    RECORD = struct.Struct('<IIQddddq8x')
+    SEQ = struct.Struct('<I')
+
+    def __init__(self, path, slots=4096, stale=30, clock=time, pid=None):
+        if fcntl is None:
+            raise ValueError('A shared health store needs fcntl, which is not available on this platform')
+        self.path = path
+        self.stale = stale
+        self.clock = clock
+        self.pid = pid or os.getpid()
+        # key -> offset of this process' record
+        self._own = {}
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            with self._locked():
+                self.slots = self._initialize(slots)
+            self._map = mmap.mmap(self._fd, self.HEADER.size + self.slots * self.RECORD.size)
+        except Exception:
+            os.close(self._fd)
+            raise
+
+    def _initialize(self, slots):
+        header = os.pread(self._fd, self.HEADER.size, 0)
+        if not header:
+            os.ftruncate(self._fd, self.HEADER.size + slots * self.RECORD.size)
+            os.pwrite(self._fd, self.HEADER.pack(self.MAGIC, self.VERSION, slots), 0)
+            return slots
+        magic, version, slots = self.HEADER.unpack(header)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError('%s is not a version %d shared health store' % (self.path, self.VERSION))
+        # The first process decides the size
+        return slots
+
+    def _locked(self):
+        return _HeaderLock(self._fd, self.HEADER.size)
+
+    @staticmethod
+    def key(proxy):
+        # Never 0, which marks free records
+        return int.from_bytes(blake2b(proxy.encode('utf-8'), digest_size=8).digest(), 'big') or 1
+
+    def publish(self, key, latency, success, inflight, open_until=0):
+        """Overwrite this process' record for the proxy ``key`` (see ``key()``)."""
+        offset = self._own.get(key)
+        if offset is None or self.RECORD.unpack_from(self._map, offset)[1:3] != (self.pid, key):
+            # New, or taken over by another process after we went quiet for too long
+            offset = self._own[key] = self._claim(key)
+        self._write(offset, self.pid, key, latency, success, open_until, inflight)
+
+    def read(self):
+        """Return a dict of proxy key -> SharedHealth, from the live records of the other processes."""
+        now = self.clock()
+        found = {}
+        for offset in range(self.HEADER.size, len(self._map), self.RECORD.size):
+            record = self._read(offset)
+            if record is None:
+                continue
+            _, pid, key, updated, latency, success, open_until, inflight = record
+            if not key or pid == self.pid or now - updated > self.stale:
+                continue
+            found.setdefault(key, []).append((latency, success, open_until, inflight))
+        return {key: SharedHealth(sum(r[0] for r in records) / len(records),
+                                  sum(r[1] for r in records) / len(records),
+                                  sum(r[3] for r in records),
+                                  max(r[2] for r in records),
+                                  len(records))
+                for key, records in found.items()}
+
+    def close(self):
+        """Free this process' records and unmap the file."""
+        if self._map is None:
+            return
+        for offset in self._own.values():
+            self._write(offset, 0, 0, 0, 0, 0, 0)
+        self._own.clear()
+        self._map.close()
+        self._map = None
+        os.close(self._fd)
+
+    def _write(self, offset, pid, key, latency, success, open_until, inflight):
+        seq = self.SEQ.unpack_from(self._map, offset)[0] | 1
+        # Odd while the record is being written
+        self.SEQ.pack_into(self._map, offset, seq)
+        self.RECORD.pack_into(self._map, offset, seq, pid, key, self.clock(), latency, success, open_until, inflight)
+        self.SEQ.pack_into(self._map, offset, (seq + 1) & 0xffffffff)
+
+    def _read(self, offset):
+        for _ in range(3):
+            record = self.RECORD.unpack_from(self._map, offset)
+            if not record[0] & 1 and self.SEQ.unpack_from(self._map, offset)[0] == record[0]:
+                return record
+        # Still being written, it will be read next time
+        return None
+
+    def _claim(self, key):
+        first = self.HEADER.size + (key % self.slots) * self.RECORD.size
+        end = self.HEADER.size + self.slots * self.RECORD.size
+        with self._locked():
+            now = self.clock()
+            offset = first
+            while True:
+                _, pid, other, updated = self.RECORD.unpack_from(self._map, offset)[:4]
+                if not other or not pid or now - updated > self.stale:
+                    self._write(offset, self.pid, key, 0, 1, 0, 0)
+                    return offset
+                offset += self.RECORD.size
+                if offset >= end:
+                    offset = self.HEADER.size
+                if offset == first:
+                    raise ValueError('%s is full, all its %d records are in use' % (self.path, self.slots))
+
+
+class _HeaderLock(object):
+    def __init__(self, fd, size):
+        self.fd = fd
+        self.size = size
+
+    def __enter__(self):
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, self.size, 0)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.size, 0)
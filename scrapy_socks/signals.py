@@ -0,0 +1,8 @@
+"""Signals sent by scrapy_socks components, in addition to Scrapy's own."""
+
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+# Sent by SOCKSProxyProber once every proxy has been probed, before the
+# first request of the spider, with ``ranked`` (the ProbeResults of the
+# proxies to use, best first) and ``results`` (all of them).
+proxies_probed = object()
@@ -0,0 +1,186 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from bisect import bisect_left
+from functools import partial
+
+
+# Upper bounds of the latency buckets, in milliseconds. The last bucket
+# catches everything slower.
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 35, 50, 75, 100, 150, 200, 300, 400, 500, 750,
+                   1000, 1500, 2000, 3000, 5000, 10000, 30000)
+
+
+class Histogram(object):
+    """Fixed-bucket histogram with interpolated percentiles."""
+    __slots__ = ('bounds', 'counts', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.bounds[i - 1] if i else 0
+                upper = self.bounds[i] if i < len(self.bounds) else self.bounds[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.bounds[-1]
+
+
+def proxy_label(proxy_config):
+    # Never include the credentials in stats keys
+    if ':' in proxy_config.host:
+        return '[%s]:%s' % (proxy_config.host, proxy_config.port)
+    return '%s:%s' % (proxy_config.host, proxy_config.port)
+
+
+class TransferMeter(object):
+    """Counts the bytes and times the exchanges through one relayed tunnel.
+
+    An exchange starts with the first write after the previous reply began
+    (a request) and lasts until the last byte received before the next one
+    (its reply), or until the tunnel closes. Each is reported as
+    ``report(bytes_in, bytes_out, ttfb, duration)`` in seconds, where the
+    time to first byte and the duration are None when there was no reply.
+    """
+    __slots__ = ('_clock', '_report', '_sent', '_first', '_last', '_in', '_out')
+
+    def __init__(self, clock, report):
+        self._clock = clock
+        self._report = report
+        self._reset()
+
+    def sent(self, n):
+        if self._first is not None:
+            self.flush()
+        if self._sent is None:
+            self._sent = self._clock()
+        self._out += n
+
+    def started(self):
+        """The pending request only leaves now, e.g. a TLS handshake held it back."""
+        if self._sent is not None and self._first is None:
+            self._sent = self._clock()
+
+    def received(self, n):
+        # Called for every chunk of a download, keep it short
+        now = self._clock()
+        if self._first is None:
+            self._first = now
+        self._last = now
+        self._in += n
+
+    def flush(self):
+        if self._in or self._out:
+            if self._first is None:
+                ttfb = duration = None
+            else:
+                ttfb = self._first - self._sent if self._sent is not None else None
+                duration = self._last - self._first
+            self._report(self._in, self._out, ttfb, duration)
+        self._reset()
+
+    def _reset(self):
+        self._sent = self._first = self._last = None
+        self._in = self._out = 0
+
+
+class HandshakeStats(object):
+    """Aggregates SOCKS handshake phase timings into a Scrapy stats collector.
+
+    For every proxy and phase it keeps a Histogram and publishes its count
+    and p50/p95/p99 (in milliseconds) as ``socks/<proxy>/<phase>/...``.
+    Failed handshakes are counted per reply code or exception type. The
+    time connects spend queued for admission is published as the ``queue``
+    phase, next to the current and maximum queue depth.
+
+    Traffic through established tunnels (see TransferMeter) adds up in
+    ``socks/<proxy>/bytes_in`` and ``bytes_out``, the time to first byte of
+    every reply is the ``ttfb`` phase, and replies of at least
+    ``throughput_min_bytes`` update a rolling (EWMA) download rate,
+    ``socks/<proxy>/throughput/kib_per_s``.
+    """
+
+    # phase name, start event, end event
+    PHASES = (
+        ('connect', 'START', 'CONNECTED'),
+        ('auth', 'CONNECTED', 'AUTHENTICATED'),
+        ('relay', 'RELAY_REQUEST_SENT', 'RESPONSE'),
+        ('total', 'START', 'RESPONSE'),
+    )
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, stats, prefix='socks', throughput_min_bytes=65536, throughput_alpha=0.2):
+        self.stats = stats
+        self.prefix = prefix
+        self.throughput_min_bytes = throughput_min_bytes
+        self.throughput_alpha = throughput_alpha
+        self._histograms = {}
+        self._throughput = {}
+
+    def record(self, proxy_config, timestamps):
+        label = proxy_label(proxy_config)
+        for phase, start, end in self.PHASES:
+            if start in timestamps and end in timestamps:
+                self._add(label, phase, (timestamps[end] - timestamps[start]) * 1000)
+
+    def record_failure(self, proxy_config, failure):
+        label = proxy_label(proxy_config)
+        reply = getattr(failure.value, 'reply', None)
+        if reply is not None:
+            key = '%s/%s/reply_error/%#04x' % (self.prefix, label, reply)
+        else:
+            key = '%s/%s/error/%s' % (self.prefix, label, failure.type.__name__)
+        self.stats.inc_value(key)
+
+    def record_wait(self, proxy_config, seconds):
+        self._add(proxy_label(proxy_config), 'queue', seconds * 1000)
+
+    def record_queue(self, proxy_config, depth, max_depth):
+        key = '%s/%s/queue' % (self.prefix, proxy_label(proxy_config))
+        self.stats.set_value(key + '/depth', depth)
+        self.stats.set_value(key + '/max_depth', max_depth)
+
+    def record_transfer(self, proxy_config, bytes_in, bytes_out, ttfb, duration):
+        label = proxy_label(proxy_config)
+        key = '%s/%s' % (self.prefix, label)
+        self.stats.inc_value(key + '/bytes_in', bytes_in)
+        self.stats.inc_value(key + '/bytes_out', bytes_out)
+        if ttfb is not None:
+            self._add(label, 'ttfb', ttfb * 1000)
+        if bytes_in >= self.throughput_min_bytes and duration:
+            rate = bytes_in / 1024.0 / duration
+            previous = self._throughput.get(label)
+            if previous is not None:
+                rate = previous + self.throughput_alpha * (rate - previous)
+            self._throughput[label] = rate
+            self.stats.set_value(key + '/throughput/kib_per_s', round(rate, 1))
+            self.stats.inc_value(key + '/throughput/count')
+
+    def transfer_meter(self, proxy_config, clock):
+        """Return a TransferMeter reporting to ``record_transfer`` for ``proxy_config``."""
+        return TransferMeter(clock, partial(self.record_transfer, proxy_config))
+
+    def histogram(self, label, phase):
+        return self._histograms.get((label, phase))
+
+    def _add(self, label, phase, value):
+        histogram = self._histograms.get((label, phase))
+        if histogram is None:
+            histogram = self._histograms[label, phase] = Histogram()
+        histogram.add(value)
+
+        key = '%s/%s/%s' % (self.prefix, label, phase)
+        self.stats.set_value(key + '/count', histogram.count)
+        for p in self.PERCENTILES:
+            self.stats.set_value('%s/p%d_ms' % (key, p), round(histogram.percentile(p), 1))
@@ -9,10 +9,197 @@ from twisted.internet.endpoints import _WrappingFactory, TCP4ClientEndpoint
 from twisted.web.client import Agent as BaseAgent, SchemeNotSupported, BrowserLikePolicyForHTTPS
 from twisted.web.iweb import IAgentEndpointFactory, IAgent, IPolicyForHTTPS
 from twisted.protocols import tls
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
 from zope.interface import implementer
+from twisted.python.failure import Failure
+from OpenSSL import SSL
+import OpenSSL
+from collections import OrderedDict
 import struct
 import socket
 import re
+from scrapy_socks.exceptions import SOCKSTimeoutError
+from scrapy_socks.protocol import MeteredProtocol
+
+# Neither pyOpenSSL nor Twisted has a public API to tell whether a handshake
+# resumed a session, or to reach the context of a connection creator before
+# it makes a connection. The private names used for that are only touched
+# with the pyOpenSSL releases known to have them, and checked by type
+# otherwise; tests/test_tls.py fails if an upgrade makes them unavailable.
+PRIVATE_API_VERSIONS = ((19, 1), (25, 0))
+
+
+def _openssl_function(version, name):
+    """Return the OpenSSL function ``name`` bound by pyOpenSSL ``version``, or None outside PRIVATE_API_VERSIONS."""
+    try:
+        release = tuple(int(part) for part in version.split('.')[:2])
+    except ValueError:
+        return None
+    if not PRIVATE_API_VERSIONS[0] <= release < PRIVATE_API_VERSIONS[1]:
+        return None
+    try:
+        from OpenSSL._util import lib
+        return getattr(lib, name)
+    except (ImportError, AttributeError):
+        return None
+
+
+_SSL_session_reused = _openssl_function(OpenSSL.__version__, 'SSL_session_reused')
+
+
+def session_reused(connection):
+    """Return whether the handshake of an ``SSL.Connection`` resumed a session, or None if that can't be told."""
+    ssl = getattr(connection, '_ssl', None)
+    if _SSL_session_reused is None or ssl is None:
+        return None
+    return bool(_SSL_session_reused(ssl))
+
+
+def creator_context(creator):
+    """Return the ``SSL.Context`` a Twisted ClientTLSOptions makes its connections with, or None."""
+    context = getattr(creator, '_ctx', None)
+    return context if isinstance(context, SSL.Context) else None
+
+
+class TLSSessionCache(object):
+    """Bounded LRU cache of TLS sessions per ``(host, port)``.
+
+    Sessions are keyed on the origin only, so a tunnel through any proxy
+    can resume a session negotiated through another one.
+    """
+
+    def __init__(self, maxsize=1024, stats=None):
+        self.maxsize = maxsize
+        self.stats = stats
+        self._sessions = OrderedDict()
+        self.resumed = 0
+        self.handshakes = 0
+
+    def get(self, netloc):
+        session = self._sessions.get(netloc)
+        if session is not None:
+            self._sessions.move_to_end(netloc)
+        return session
+
+    def put(self, netloc, session):
+        self._sessions[netloc] = session
+        self._sessions.move_to_end(netloc)
+        if len(self._sessions) > self.maxsize:
+            self._sessions.popitem(last=False)
+
+    def discard(self, netloc):
+        self._sessions.pop(netloc, None)
+
+    def noteHandshake(self, resumed):
+        self.handshakes += 1
+        if resumed:
+            self.resumed += 1
+        if self.stats is not None:
+            self.stats.inc_value('socks/tls/resumed' if resumed else 'socks/tls/full_handshakes')
+            self.stats.set_value('socks/tls/resumption_rate', round(float(self.resumed) / self.handshakes, 3))
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _ResumingClientCreator(object):
+    """Wraps a client connection creator to offer the cached session for its origin."""
+
+    # OpenSSL only resumes a session within the session id context it was
+    # created in, and every context Scrapy builds gets a unique one.
+    sessionIdContext = b'scrapy_socks'
+
+    def __init__(self, creator, cache, netloc):
+        self._creator = creator
+        self._cache = cache
+        self._netloc = netloc
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        context = creator_context(self._creator)
+        if context is not None:
+            context.set_session_id(self.sessionIdContext)
+        connection = self._creator.clientConnectionForTLS(tlsProtocol)
+        session = self._cache.get(self._netloc)
+        if session is not None:
+            try:
+                connection.set_session(session)
+            except Exception:
+                self._cache.discard(self._netloc)
+        return connection
+
+
+class _DeadlineTLSProtocol(tls.TLSMemoryBIOProtocol):
+    """Fails the connection with SOCKSTimeoutError if the handshake takes too long."""
+    _deadline = None
+
+    def startDeadline(self, reactor, timeout):
+        if not self._handshakeDone and not self._lostTLSConnection:
+            self._deadline = reactor.callLater(timeout, self._handshakeTimedOut, timeout)
+
+    def cancelDeadline(self):
+        if self._deadline is not None:
+            if self._deadline.active():
+                self._deadline.cancel()
+            self._deadline = None
+
+    def dataReceived(self, data):
+        tls.TLSMemoryBIOProtocol.dataReceived(self, data)
+        if self._handshakeDone:
+            self.cancelDeadline()
+
+    def connectionLost(self, reason):
+        self.cancelDeadline()
+        tls.TLSMemoryBIOProtocol.connectionLost(self, reason)
+
+    def _handshakeTimedOut(self, timeout):
+        self._deadline = None
+        # Aborts the connection, the application protocol gets the reason
+        self.failVerification(Failure(SOCKSTimeoutError('TLS handshake not finished after %ss' % timeout)))
+
+
+class _DeadlineTLSFactory(tls.TLSMemoryBIOFactory):
+    protocol = _DeadlineTLSProtocol
+
+
+class _SessionCachingTLSProtocol(_DeadlineTLSProtocol):
+    # TLS 1.3 servers send their session tickets after the handshake, so the
+    # session is stored again with the first data after it and on close.
+    _sessionSaves = 0
+    # Set once the server answered the ClientHello. A tunnel closed before
+    # that (a race loser, a deadline) says nothing about the session.
+    _handshakeAnswered = False
+
+    def dataReceived(self, data):
+        self._handshakeAnswered = True
+        _DeadlineTLSProtocol.dataReceived(self, data)
+        if self._handshakeDone and self._sessionSaves < 2:
+            if not self._sessionSaves:
+                resumed = session_reused(self._tlsConnection)
+                if resumed is not None:
+                    self.factory.sessionCache.noteHandshake(resumed)
+            self._saveSession()
+
+    def connectionLost(self, reason):
+        if self._handshakeDone:
+            self._saveSession()
+        elif self._handshakeAnswered:
+            # Don't offer a session again that may be why the handshake failed
+            self.factory.sessionCache.discard(self.factory.netloc)
+        _DeadlineTLSProtocol.connectionLost(self, reason)
+
+    def _saveSession(self):
+        self._sessionSaves += 1
+        session = self._tlsConnection.get_session()
+        if session is not None:
+            self.factory.sessionCache.put(self.factory.netloc, session)
+
+
+class SessionCachingTLSFactory(tls.TLSMemoryBIOFactory):
+    protocol = _SessionCachingTLSProtocol
+
+    def __init__(self, contextFactory, isClient, wrappedFactory, sessionCache, netloc):
+        tls.TLSMemoryBIOFactory.__init__(
+            self, _ResumingClientCreator(contextFactory, sessionCache, netloc), isClient, wrappedFactory)
+        self.sessionCache = sessionCache
+        self.netloc = netloc
 
 
 @implementer(IStreamClientEndpoint)
@@ -21,16 +208,26 @@ class TLSWrapClientEndpoint(object):
 
     :param contextFactory: A `ContextFactory`__ instance.
     :param wrappedEndpoint: The endpoint to wrap.
+    :param reactor: The reactor used to enforce ``timeout``.
+    :param timeout: Seconds the TLS handshake may take once the wrapped
+        endpoint connected; after that the connection is aborted and the
+        wrapped protocol loses it with a SOCKSTimeoutError.
+    :param sessionCache: A `TLSSessionCache` to resume sessions from.
+    :param netloc: The ``(host, port)`` sessions are cached under.
 
     __ http://twistedmatrix.com/documents/current/api/twisted.internet.protocol.ClientFactory.html
 
     """
 
-    _wrapper = tls.TLSMemoryBIOFactory
+    _wrapper = _DeadlineTLSFactory
 
-    def __init__(self, contextFactory, wrappedEndpoint):
+    def __init__(self, contextFactory, wrappedEndpoint, reactor=None, timeout=None, sessionCache=None, netloc=None):
         self.contextFactory = contextFactory
         self.wrappedEndpoint = wrappedEndpoint
+        self.reactor = reactor
+        self.timeout = timeout
+        self.sessionCache = sessionCache
+        self.netloc = netloc
 
     def connect(self, fac):
         """Connect to the wrapped endpoint, then start TLS.
@@ -45,11 +242,25 @@ class TLSWrapClientEndpoint(object):
         __ http://twistedmatrix.com/documents/current/api/twisted.protocols.tls.html
 
         """
-        wrapped_fac = self._wrapper(self.contextFactory, True, fac)
-        return self.wrappedEndpoint.connect(wrapped_fac).addCallback(self._unwrapProtocol)
+        if self.sessionCache is not None and self.netloc is not None:
+            wrapped_fac = SessionCachingTLSFactory(self.contextFactory, True, fac, self.sessionCache, self.netloc)
+        else:
+            wrapped_fac = self._wrapper(self.contextFactory, True, fac)
+        d = self.wrappedEndpoint.connect(wrapped_fac)
+        if self.timeout and self.reactor is not None:
+            d.addCallback(self._startDeadline)
+        return d.addCallback(self._unwrapProtocol)
+
+    def _startDeadline(self, proto):
+        proto.startDeadline(self.reactor, self.timeout)
+        return proto
 
     def _unwrapProtocol(self, proto):
-        return proto.wrappedProtocol
+        protocol = proto.wrappedProtocol
+        if isinstance(protocol, MeteredProtocol):
+            # Inserted by SOCKSClientProtocol to meter the plaintext
+            return protocol.wrappedProtocol
+        return protocol
 
     @property
     def _host(self):
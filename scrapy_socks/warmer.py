@@ -0,0 +1,120 @@
+__author__ = 'Constantine Slednev <c.slednev@gmail.com>'
+
+from collections import Counter, namedtuple
+from twisted.internet.task import LoopingCall
+
+
+# Quacks enough like twisted.web.client.URI for ProxyAgent.endpointForURI, and
+# compares equal to the (scheme, host, port) key Agent uses for its pool.
+Destination = namedtuple('Destination', ['scheme', 'host', 'port'])
+
+
+class TunnelWarmer(object):
+    """Keeps a reserve of idle tunnels to each proxy's hottest destinations.
+
+    Every request through a proxy is noted. Every ``interval`` seconds the
+    ``hosts`` most requested destinations of each proxy are topped up to
+    ``reserve`` idle connections (at most the pool's ``maxPersistentPerHost``)
+    in that proxy's HTTPConnectionPool, where Agent picks them up like any
+    other kept-alive connection. HTTPS tunnels are warmed including the TLS handshake, unless ``tls`` is off,
+    in which case HTTPS destinations are not warmed at all.
+
+    Request counts are halved on every round, so destinations that went
+    cold drop out. ``ttl``, if set, replaces the pool's idle timeout for
+    warmed connections, so they can be closed before the proxy drops them.
+
+    :param getPool: callable returning the pool of a proxy config.
+    :param getEndpoint: callable returning the endpoint for a proxy config
+        and a Destination.
+    """
+
+    def __init__(self, reactor, getPool, getEndpoint, reserve=2, hosts=5, interval=5.0, ttl=None, tls=True,
+                 stats=None):
+        self._getPool = getPool
+        self._getEndpoint = getEndpoint
+        self.reserve = reserve
+        self.hosts = hosts
+        self.interval = interval
+        self.ttl = ttl
+        self.tls = tls
+        self.stats = stats
+        self._history = {}
+        self._warming = Counter()
+        # warming connect -> proxy config
+        self._pending = {}
+        self._loop = LoopingCall(self.warm)
+        self._loop.clock = reactor
+
+    def note(self, proxy_config, scheme, host, port):
+        if scheme == b'https' and not self.tls:
+            return
+        history = self._history.get(proxy_config)
+        if history is None:
+            history = self._history[proxy_config] = Counter()
+        history[Destination(scheme, host, port)] += 1
+        if not self._loop.running:
+            self._loop.start(self.interval, now=False)
+
+    def warm(self):
+        for proxy_config, history in list(self._history.items()):
+            pool = self._getPool(proxy_config)
+            # The pool closes whatever it is handed beyond this, warming more only churns
+            reserve = min(self.reserve, pool.maxPersistentPerHost)
+            for destination, _ in history.most_common(self.hosts):
+                key = tuple(destination)
+                idle = len(pool._connections.get(key, ())) + self._warming[proxy_config, key]
+                for _ in range(reserve - idle):
+                    self._open(pool, proxy_config, destination)
+
+            for destination, count in list(history.items()):
+                if count > 1:
+                    history[destination] = count // 2
+                else:
+                    del history[destination]
+            if not history:
+                del self._history[proxy_config]
+
+    def forget(self, proxy_configs):
+        """Stop warming tunnels through ``proxy_configs``, e.g. credentials that were retired."""
+        proxy_configs = set(proxy_configs)
+        for proxy_config in proxy_configs:
+            self._history.pop(proxy_config, None)
+        for d, proxy_config in list(self._pending.items()):
+            if proxy_config in proxy_configs:
+                d.cancel()
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+        self._history.clear()
+        for d in list(self._pending):
+            d.cancel()
+
+    def _open(self, pool, proxy_config, destination):
+        key = tuple(destination)
+        self._warming[proxy_config, key] += 1
+        d = pool._newConnection(key, self._getEndpoint(proxy_config, destination))
+        self._pending[d] = proxy_config
+
+        def connected(protocol):
+            pool._putConnection(key, protocol)
+            if self.ttl and protocol in pool._timeouts:
+                pool._timeouts[protocol].reset(self.ttl)
+            self._inc('socks/warmer/opened')
+
+        def failed(failure):
+            # Proxy health is tracked by the handshake itself, just try again next round
+            self._inc('socks/warmer/failed')
+
+        def done(_):
+            self._pending.pop(d, None)
+            self._warming[proxy_config, key] -= 1
+            if self._warming[proxy_config, key] <= 0:
+                del self._warming[proxy_config, key]
+
+        d.addCallbacks(connected, failed)
+        d.addBoth(done)
+
+    def _inc(self, key):
+        if self.stats is not None:
+            self.stats.inc_value(key)
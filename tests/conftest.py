@@ -0,0 +1,6 @@
+# The asyncio connector needs the asyncio reactor, and a reactor can only be
+# installed before anything imports twisted.internet.reactor. The Twisted
+# connector runs on it as well.
+from scrapy.utils.reactor import install_reactor
+
+install_reactor('twisted.internet.asyncioreactor.AsyncioSelectorReactor')
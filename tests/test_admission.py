@@ -0,0 +1,45 @@
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from scrapy_socks.admission import AdmissionControl
+from scrapy_socks.config import isolated_config, parse_proxy
+
+
+class AdmissionControlTest(unittest.TestCase):
+    def setUp(self):
+        self.proxy = parse_proxy('socks5h://127.0.0.1:9050')
+        self.admission = AdmissionControl(Clock(), maxTunnels=1)
+
+    def test_credentials_share_the_proxy_limits(self):
+        first = self.admission.acquire(isolated_config(self.proxy, 'a'))
+        second = self.admission.acquire(isolated_config(self.proxy, 'b'))
+        self.successResultOf(first)
+        self.assertNoResult(second)
+        self.assertEqual(self.admission.depth(self.proxy), 1)
+        self.admission.handshakeFinished(isolated_config(self.proxy, 'a'))
+        self.admission.tunnelClosed(isolated_config(self.proxy, 'a'))
+        self.successResultOf(second)
+
+    def test_idle_proxies_are_forgotten(self):
+        for token in ('a', 'b', 'c'):
+            config = isolated_config(self.proxy, token)
+            self.successResultOf(self.admission.acquire(config))
+            self.admission.handshakeFinished(config)
+            self.assertEqual(len(self.admission._slots), 1)
+            self.admission.tunnelClosed(config)
+            self.assertEqual(self.admission._slots, {})
+
+    def test_cancelled_connect_is_forgotten(self):
+        other = parse_proxy('socks5h://127.0.0.1:9051')
+        self.admission.maxTunnels = 0
+        self.admission.maxHandshakes = 1
+        self.successResultOf(self.admission.acquire(self.proxy))
+        self.admission.handshakeFinished(self.proxy)
+        self.admission.maxTunnels = 1
+        d = self.admission.acquire(self.proxy)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.successResultOf(self.admission.acquire(other))
+        self.admission.tunnelClosed(self.proxy)
+        self.assertEqual(list(self.admission._slots), [other.address])
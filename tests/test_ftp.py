@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+from functools import partial
+
+from scrapy.http import Request
+from scrapy.settings import Settings
+from twisted.cred.checkers import AllowAnonymousAccess
+from twisted.cred.portal import Portal
+from twisted.internet import defer, reactor
+from twisted.names import hosts
+from twisted.protocols.ftp import FTPFactory, FTPRealm
+from twisted.trial import unittest
+
+from benchmarks.servers import listen_socks
+from scrapy_socks import handlers
+from scrapy_socks.handlers import FTPDownloadHandler
+from scrapy_socks.resolver import HostResolver
+
+
+class FTPDownloadHandlerTest(unittest.TestCase):
+    """Downloads from a local FTP server behind a local SOCKS5 server."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.root = os.path.join(self.directory, 'root')
+        os.mkdir(self.root)
+        with open(os.path.join(self.root, 'file.txt'), 'wb') as f:
+            f.write(b'I have the power!')
+        with open(os.path.join(self.root, 'large.bin'), 'wb') as f:
+            f.write(b'x' * 1024 * 1024)
+        factory = FTPFactory(Portal(FTPRealm(self.root), [AllowAnonymousAccess()]))
+        factory.allowAnonymous = True
+        factory.noisy = False
+        self.ftpPort = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(self.ftpPort.stopListening)
+        self.socks, socksPort = listen_socks(reactor)
+        self.addCleanup(socksPort.stopListening)
+        self.proxy = 'socks5://127.0.0.1:%d' % socksPort.getHost().port
+        # Only addresses here; the DNS client would leave a config reload scheduled
+        self.patch(handlers, 'HostResolver', partial(HostResolver, resolver=hosts.Resolver()))
+        self.handler = FTPDownloadHandler(Settings({'DOWNLOAD_MAXSIZE': 1024}))
+
+    def tearDown(self):
+        return self.settle()
+
+    def settle(self):
+        # Let the server side of the closed connections go away
+        d = defer.Deferred()
+        reactor.callLater(0.05, d.callback, None)
+        return d
+
+    def download(self, path, **meta):
+        meta['proxy'] = self.proxy
+        request = Request('ftp://127.0.0.1:%d/%s' % (self.ftpPort.getHost().port, path), meta=meta)
+        return self.handler.download_request(request, None)
+
+    @defer.inlineCallbacks
+    def test_download_in_memory(self):
+        response = yield self.download('file.txt')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.body, b'I have the power!')
+        # The control connection and the passive data connection
+        self.assertEqual(self.socks.connections, 2)
+
+    @defer.inlineCallbacks
+    def test_streamed_to_part_file_and_renamed(self):
+        filename = os.path.join(self.directory, 'download')
+        response = yield self.download('file.txt', ftp_local_filename=filename)
+        self.assertEqual(response.body, filename.encode())
+        self.assertEqual(response.headers[b'size'], b'17')
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), b'I have the power!')
+        self.assertFalse(os.path.exists(filename + '.part'))
+
+    @defer.inlineCallbacks
+    def test_part_file_removed_on_failure(self):
+        filename = os.path.join(self.directory, 'download')
+        response = yield self.download('missing.txt', ftp_local_filename=filename)
+        self.assertEqual(response.status, 404)
+        self.assertEqual(os.listdir(self.directory), ['root'])
+
+    @defer.inlineCallbacks
+    def test_streamed_download_ignores_max_size(self):
+        filename = os.path.join(self.directory, 'download')
+        yield self.download('large.bin', ftp_local_filename=filename)
+        self.assertEqual(os.path.getsize(filename), 1024 * 1024)
+
+    @defer.inlineCallbacks
+    def assertCancelled(self, d):
+        yield self.assertFailure(d, defer.CancelledError)
+        yield self.settle()
+        # The server complains about the data connection going away mid-file
+        self.assertEqual([str(f.value) for f in self.flushLoggedErrors()], ['Consumer asked us to stop producing'])
+
+    def test_max_size_aborts_the_data_connection(self):
+        return self.assertCancelled(self.download('large.bin', download_maxsize=1000))
+
+    def test_max_size_from_settings(self):
+        return self.assertCancelled(self.download('large.bin'))
@@ -0,0 +1,40 @@
+from functools import partial
+
+from scrapy.settings import Settings
+from twisted.internet import defer
+from twisted.names import hosts
+from twisted.trial import unittest
+
+from scrapy_socks import handlers
+from scrapy_socks.config import parse_proxy
+from scrapy_socks.handlers import HTTPDownloadHandler
+from scrapy_socks.resolver import HostResolver
+
+
+class ProxyPoolsTest(unittest.TestCase):
+    def setUp(self):
+        # The DNS client would leave a config reload scheduled
+        self.patch(handlers, 'HostResolver', partial(HostResolver, resolver=hosts.Resolver()))
+        self.handler = HTTPDownloadHandler(Settings({'SOCKS_POOL_MAX_PROXIES': 2}))
+        self.addCleanup(self.handler.close)
+        self.closed = []
+
+    def pool(self, proxy):
+        pool = self.handler.get_proxy_pool(parse_proxy(proxy))
+        pool.closeCachedConnections = lambda: self.closed.append(proxy) or defer.succeed(None)
+        return pool
+
+    def test_least_recently_used_pool_is_closed(self):
+        first = self.pool('socks5h://127.0.0.1:1080')
+        self.pool('socks5h://127.0.0.1:1081')
+        self.assertIs(self.pool('socks5h://127.0.0.1:1080'), first)
+        self.pool('socks5h://127.0.0.1:1082')
+        self.assertEqual(self.closed, ['socks5h://127.0.0.1:1081'])
+        self.assertEqual([config.port for config in self.handler._proxy_pools], [1080, 1082])
+
+    def test_retired_pools_are_closed(self):
+        self.pool('socks5h://a:b@127.0.0.1:1080')
+        self.pool('socks5h://c:d@127.0.0.1:1080')
+        self.handler._retire_pools([parse_proxy('socks5h://a:b@127.0.0.1:1080')])
+        self.assertEqual(self.closed, ['socks5h://a:b@127.0.0.1:1080'])
+        self.assertEqual(len(self.handler._proxy_pools), 1)
@@ -0,0 +1,123 @@
+from twisted.trial import unittest
+
+from scrapy_socks.handshake import ReceiveBuffer, read_socks5_method_reply, read_socks5_auth_reply, \
+    read_socks5_reply, read_socks4_reply, encode_host, socks5_connect_request, socks4_connect_request, \
+    ATYP_IPV4, ATYP_IPV6, ATYP_DOMAINNAME
+
+
+def feed_bytewise(reader, message):
+    """Feed ``message`` one byte at a time, return the results of ``reader`` after each."""
+    buf = ReceiveBuffer()
+    results = []
+    for i in range(len(message)):
+        buf.feed(message[i:i + 1])
+        results.append(reader(buf))
+    return results, buf
+
+
+class ReceiveBufferTest(unittest.TestCase):
+    def test_consume_and_feed(self):
+        buf = ReceiveBuffer()
+        buf.feed(b'\x05\x00abc')
+        self.assertEqual(buf.unpack('!BB'), (5, 0))
+        buf.consume(2)
+        self.assertEqual(len(buf), 3)
+        self.assertEqual(bytes(buf.view(0, 2)), b'ab')
+        buf.feed(b'de')
+        self.assertEqual(buf.drain(), b'abcde')
+        self.assertEqual(len(buf), 0)
+
+    def test_consume_everything_resets(self):
+        buf = ReceiveBuffer()
+        buf.feed(b'\x05\x00')
+        buf.consume(2)
+        buf.feed(b'\x01')
+        self.assertEqual(buf.unpack('!B'), (1,))
+
+
+class SOCKS5ReplyTest(unittest.TestCase):
+    def test_method_reply_fragmented(self):
+        results, buf = feed_bytewise(read_socks5_method_reply, b'\x05\x02')
+        self.assertEqual(results, [None, (5, 2)])
+        self.assertEqual(len(buf), 0)
+
+    def test_auth_reply_leaves_the_rest(self):
+        buf = ReceiveBuffer()
+        buf.feed(b'\x01\x00\x05\x00')
+        self.assertEqual(read_socks5_auth_reply(buf), (1, 0))
+        self.assertEqual(len(buf), 2)
+
+    def test_ipv4_reply_fragmented(self):
+        message = b'\x05\x00\x00\x01\x0a\x00\x00\x01\x04\x38'
+        results, buf = feed_bytewise(read_socks5_reply, message)
+        self.assertEqual(results[:-1], [None] * (len(message) - 1))
+        self.assertEqual(results[-1], (5, 0, ATYP_IPV4, '10.0.0.1', 1080))
+        self.assertEqual(len(buf), 0)
+
+    def test_ipv6_reply(self):
+        buf = ReceiveBuffer()
+        buf.feed(b'\x05\x00\x00\x04' + b'\x00' * 15 + b'\x01')
+        self.assertIsNone(read_socks5_reply(buf))
+        buf.feed(b'\x00\x50')
+        self.assertEqual(read_socks5_reply(buf), (5, 0, ATYP_IPV6, '::1', 80))
+
+    def test_domain_reply_keeps_relayed_data(self):
+        buf = ReceiveBuffer()
+        buf.feed(b'\x05\x00\x00\x03\x0bexample.com\x00\x50HTTP/1.1')
+        self.assertEqual(read_socks5_reply(buf), (5, 0, ATYP_DOMAINNAME, 'example.com', 80))
+        self.assertEqual(buf.drain(), b'HTTP/1.1')
+
+    def test_domain_reply_waits_for_length(self):
+        results, _ = feed_bytewise(read_socks5_reply, b'\x05\x00\x00\x03\x01a\x00\x50')
+        self.assertEqual(results, [None] * 7 + [(5, 0, ATYP_DOMAINNAME, 'a', 80)])
+
+    def test_failure_replies_need_only_the_header(self):
+        for code in range(0x01, 0x09):
+            buf = ReceiveBuffer()
+            buf.feed(bytes((5, code, 0, 1)))
+            self.assertEqual(read_socks5_reply(buf), (5, code, ATYP_IPV4, None, None))
+            self.assertEqual(len(buf), 0)
+
+    def test_unknown_address_type(self):
+        buf = ReceiveBuffer()
+        buf.feed(b'\x05\x00\x00\x07garbage')
+        self.assertEqual(read_socks5_reply(buf), (5, 0, 7, None, None))
+
+    def test_wrong_version(self):
+        buf = ReceiveBuffer()
+        buf.feed(b'HTTP/1.1 400 Bad Request\r\n')
+        self.assertEqual(read_socks5_reply(buf)[:2], (ord('H'), ord('T')))
+
+    def test_garbled_bound_name(self):
+        buf = ReceiveBuffer()
+        buf.feed(b'\x05\x00\x00\x03\x02\xff\xfe\x00\x50')
+        version, reply, _, bound_address, bound_port = read_socks5_reply(buf)
+        self.assertEqual((version, reply, bound_port), (5, 0, 80))
+        self.assertEqual(len(bound_address), 2)
+
+
+class SOCKS4ReplyTest(unittest.TestCase):
+    def test_granted_fragmented(self):
+        results, buf = feed_bytewise(read_socks4_reply, b'\x00\x5a\x00\x50\x7f\x00\x00\x01')
+        self.assertEqual(results, [None] * 7 + [(0, 0x5a, '127.0.0.1', 80)])
+        self.assertEqual(len(buf), 0)
+
+    def test_status_codes(self):
+        for status in (0x5a, 0x5b, 0x5c, 0x5d):
+            buf = ReceiveBuffer()
+            buf.feed(bytes((0, status)) + b'\x00' * 6)
+            self.assertEqual(read_socks4_reply(buf), (0, status, '0.0.0.0', 0))
+
+
+class RequestTest(unittest.TestCase):
+    def test_encode_host(self):
+        self.assertEqual(encode_host('example.com').socks5, b'\x03\x0bexample.com')
+        self.assertEqual(encode_host('10.0.0.1').socks5, b'\x01\x0a\x00\x00\x01')
+        self.assertEqual(encode_host('::1').type, ATYP_IPV6)
+        self.assertIsNone(encode_host('not a host'))
+
+    def test_connect_requests(self):
+        self.assertEqual(socks5_connect_request(encode_host('10.0.0.1'), 80),
+                         b'\x05\x01\x00\x01\x0a\x00\x00\x01\x00\x50')
+        self.assertEqual(socks4_connect_request(encode_host('example.com'), 80, b'me\x00'),
+                         b'\x04\x01\x00\x50\x00\x00\x00\x01me\x00example.com\x00')
@@ -0,0 +1,107 @@
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from scrapy_socks.health import ProxyHealthPool, HashRing, CLOSED, OPEN, HALF_OPEN
+
+
+class ProxyHealthPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.health = ProxyHealthPool(['a', 'b', 'c'], alpha=0.5, failure_threshold=2, backoff=10,
+                                      max_backoff=40, clock=self.clock.seconds)
+
+    def sample(self, proxy, latency):
+        self.assertEqual(self.health.pick(exclude=[p for p in self.health if p != proxy]), proxy)
+        self.health.success(proxy, latency)
+
+    def test_ewma_ordering(self):
+        self.sample('a', 0.1)
+        self.sample('b', 1.5)
+        self.sample('c', 0.9)
+        self.assertEqual(self.health.get('a').latency, 0.3)
+        self.assertEqual(self.health.pick(), 'a')
+        self.health.release('a')
+        # One slow sample moves c halfway, behind b
+        self.sample('c', 4.0)
+        self.sample('b', 0.1)
+        for proxy, latency in zip('abc', (0.3, 0.55, 2.35)):
+            self.assertAlmostEqual(self.health.get(proxy).latency, latency)
+        self.assertEqual(self.health.pick(), 'a')
+        # a's score doubles with a request in flight (0.6), b is next
+        self.assertEqual(self.health.pick(), 'b')
+
+    def test_failures_lower_the_score(self):
+        self.sample('a', 0.5)
+        self.sample('b', 0.5)
+        self.health.pick(exclude=['b', 'c'])
+        self.health.failure('a')
+        self.assertEqual(self.health.get('a').success, 0.5)
+        self.assertEqual(self.health.pick(exclude=['c']), 'b')
+
+    def test_circuit_opens_and_half_opens(self):
+        for _ in range(2):
+            self.assertEqual(self.health.pick(exclude=['b', 'c']), 'a')
+            self.health.failure('a')
+        state = self.health.get('a')
+        self.assertEqual((state.circuit, state.open_until), (OPEN, 10))
+        self.assertEqual(self.health.pick(exclude=['c']), 'b')
+        self.health.release('b')
+
+        self.clock.advance(10)
+        # Probed before anything else, and only once at a time
+        self.assertEqual(self.health.pick(), 'a')
+        self.assertEqual(state.circuit, HALF_OPEN)
+        self.assertNotEqual(self.health.pick(), 'a')
+        self.health.failure('a')
+        self.assertEqual((state.circuit, state.open_until), (OPEN, 30))
+
+        self.clock.advance(20)
+        self.assertEqual(self.health.pick(), 'a')
+        self.health.success('a', 0.5)
+        self.assertEqual((state.circuit, state.backoff), (CLOSED, 0))
+
+    def test_every_circuit_open(self):
+        for proxy, when in (('a', 0), ('b', 1), ('c', 2)):
+            self.clock.advance(when)
+            for _ in range(2):
+                self.assertEqual(self.health.pick(exclude=[p for p in 'abc' if p != proxy]), proxy)
+                self.health.failure(proxy)
+        # Probe the one that would be retried first rather than stall
+        self.assertEqual(self.health.pick(), 'a')
+        self.assertEqual(self.health.pick(), 'b')
+
+    def test_bounded_load_affinity(self):
+        owner, second, _ = self.health.ring.walk('example.com')
+        picks = [self.health.pick(key='example.com') for _ in range(4)]
+        # A proxy with ceil(1.25 * average) requests in flight is full, the next one on the ring gets the key
+        self.assertEqual(picks, [owner, second, owner, second])
+        for proxy in picks:
+            self.health.release(proxy)
+        self.assertEqual(self.health.pick(key='example.com'), owner)
+
+    def test_affinity_skips_open_circuits(self):
+        owner, second = list(self.health.ring.walk('example.com'))[:2]
+        for _ in range(2):
+            self.health.pick(exclude=[p for p in 'abc' if p != owner])
+            self.health.failure(owner)
+        self.assertEqual(self.health.pick(key='example.com'), second)
+
+
+class HashRingTest(unittest.TestCase):
+    def test_walk_yields_every_proxy_once(self):
+        ring = HashRing(replicas=10)
+        for proxy in 'abcd':
+            ring.add(proxy)
+        self.assertEqual(sorted(ring.walk('key')), ['a', 'b', 'c', 'd'])
+
+    def test_removing_a_proxy_only_moves_its_keys(self):
+        ring = HashRing()
+        for proxy in 'abcd':
+            ring.add(proxy)
+        keys = ['host%d.example.com' % i for i in range(200)]
+        before = {key: next(ring.walk(key)) for key in keys}
+        ring.remove('d')
+        after = {key: next(ring.walk(key)) for key in keys}
+        moved = [key for key in keys if before[key] != after[key]]
+        self.assertTrue(moved)
+        self.assertTrue(all(before[key] == 'd' for key in moved))
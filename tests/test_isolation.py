@@ -0,0 +1,106 @@
+from scrapy.http import Request
+from twisted.trial import unittest
+
+from scrapy_socks.config import parse_proxy
+from scrapy_socks.isolation import StreamIsolation
+
+
+class Stats(dict):
+    def inc_value(self, key):
+        self[key] = self.get(key, 0) + 1
+
+
+class StreamIsolationTest(unittest.TestCase):
+    def setUp(self):
+        self.proxy = parse_proxy('socks5h://127.0.0.1:9050')
+        self.stats = Stats()
+        self.retired = []
+        self.isolation = StreamIsolation(buckets=4, max_failures=2, min_samples=2, alpha=1, stats=self.stats,
+                                         retire=self.retired.append)
+
+    def isolate(self, url, isolation=None, **meta):
+        request = Request(url, meta=meta)
+        config = (isolation or self.isolation).isolate(self.proxy, request)
+        return config, request
+
+    def test_credentials_per_key(self):
+        isolation = StreamIsolation(buckets=64)
+        configs = {}
+        for host in ('a.example', 'b.example', 'c.example'):
+            config, request = self.isolate('http://%s/' % host, isolation)
+            configs[host] = config
+            self.assertEqual(config.username, request.meta['socks_isolation_token'])
+            self.assertEqual(config.password, config.username)
+            self.assertTrue(config.auth_required)
+            self.assertEqual(config.address, self.proxy.address)
+        self.assertEqual(len(set(c.username for c in configs.values())), 3)
+        # Same host, same bucket and circuit
+        self.assertEqual(self.isolate('http://a.example/other', isolation)[0], configs['a.example'])
+
+    def test_isolation_key_overrides_the_host(self):
+        first = self.isolate('http://a.example/', socks_isolation_key='account-1')[0]
+        second = self.isolate('http://b.example/', socks_isolation_key='account-1')[0]
+        self.assertEqual(first, second)
+
+    def test_slot_mode(self):
+        isolation = StreamIsolation('slot', buckets=64)
+        first = self.isolate('http://a.example/', isolation, download_slot='slot')[0]
+        self.assertEqual(self.isolate('http://b.example/', isolation, download_slot='slot')[0], first)
+
+    def test_round_robin(self):
+        isolation = StreamIsolation('round-robin', buckets=3)
+        buckets = [self.isolate('http://a.example/', isolation)[1].meta['socks_isolation_bucket'] for _ in range(4)]
+        self.assertEqual(buckets, [0, 1, 2, 0])
+
+    def test_socks4_is_left_alone(self):
+        proxy = parse_proxy('socks4a://127.0.0.1:9050')
+        request = Request('http://a.example/')
+        self.assertIs(self.isolation.isolate(proxy, request), proxy)
+        self.assertNotIn('socks_isolation_bucket', request.meta)
+
+    def test_failures_rotate_the_credentials(self):
+        config, request = self.isolate('http://a.example/')
+        bucket, token = request.meta['socks_isolation_bucket'], request.meta['socks_isolation_token']
+        self.isolation.failed(bucket, token)
+        self.assertEqual(self.isolate('http://a.example/')[0], config)
+        self.isolation.failed(bucket, token)
+        rotated = self.isolate('http://a.example/')[0]
+        self.assertNotEqual(rotated.username, config.username)
+        self.assertEqual(self.retired, [{config}])
+        self.assertEqual(self.stats, {'socks/isolation/rotated/failures': 1})
+        # A late failure of a request sent with the old credentials changes nothing
+        self.isolation.failed(bucket, token)
+        self.isolation.failed(bucket, token)
+        self.assertEqual(self.isolate('http://a.example/')[0], rotated)
+
+    def test_success_resets_the_failures(self):
+        config, request = self.isolate('http://a.example/')
+        bucket, token = request.meta['socks_isolation_bucket'], request.meta['socks_isolation_token']
+        self.isolation.failed(bucket, token)
+        self.isolation.observe(bucket, token, 0.1)
+        self.isolation.failed(bucket, token)
+        self.assertEqual(self.isolate('http://a.example/')[0], config)
+
+    def test_slow_bucket_is_rotated(self):
+        tokens = {}
+        for key in ('a', 'b', 'd'):
+            request = self.isolate('http://a.example/', socks_isolation_key=key)[1]
+            tokens[key] = request.meta['socks_isolation_bucket'], request.meta['socks_isolation_token']
+        self.assertEqual(len(set(bucket for bucket, _ in tokens.values())), 3)
+        for key in ('a', 'b'):
+            for _ in range(2):
+                self.isolation.observe(*tokens[key], latency=0.5)
+        # Over three times the median of the others, but not enough samples yet
+        self.isolation.observe(*tokens['d'], latency=2)
+        self.assertEqual(self.stats, {})
+        self.isolation.observe(*tokens['d'], latency=2)
+        self.assertEqual(self.stats, {'socks/isolation/rotated/slow': 1})
+        bucket = tokens['d'][0]
+        self.assertEqual(self.isolation.token(bucket), 'scrapy-%d-1' % bucket)
+
+    def test_rotate_requested(self):
+        config = self.isolate('http://a.example/')[0]
+        rotated, request = self.isolate('http://a.example/', socks_isolation_rotate=True)
+        self.assertNotEqual(rotated, config)
+        self.assertNotIn('socks_isolation_rotate', request.meta)
+        self.assertEqual(self.stats, {'socks/isolation/rotated/requested': 1})
@@ -0,0 +1,53 @@
+from twisted.internet.error import ConnectionRefusedError
+from twisted.trial import unittest
+from scrapy.http import Request
+
+from scrapy_socks.health import ProxyHealthPool
+from scrapy_socks.middlewares import SOCKSProxyMiddleware
+
+
+class AlternativesTest(unittest.TestCase):
+    def middleware(self, race_candidates=2):
+        health = ProxyHealthPool(['a', 'b', 'c'], clock=lambda: 0)
+        health.get('a').latency = 0.05
+        health.get('b').latency = health.get('c').latency = 0.5
+        health._push(health.get('a'))
+        return SOCKSProxyMiddleware(health, race_candidates=race_candidates)
+
+    def test_fastest_proxy_still_races(self):
+        mw = self.middleware()
+        request = Request('http://example.com/')
+        mw.process_request(request, None)
+        self.assertEqual(request.meta['socks_proxy'], 'a')
+        self.assertEqual(sorted(request.meta['socks_race_proxies']), ['b', 'c'])
+
+    def test_alternatives_are_released(self):
+        mw = self.middleware()
+        mw.process_request(Request('http://example.com/'), None)
+        self.assertEqual(mw.health.get('a').inflight, 1)
+        self.assertEqual(mw.health.get('b').inflight, 0)
+        self.assertEqual(mw.health.get('c').inflight, 0)
+
+    def test_fewer_proxies_than_candidates(self):
+        mw = self.middleware(race_candidates=5)
+        request = Request('http://example.com/')
+        mw.process_request(request, None)
+        self.assertEqual(len(request.meta['socks_race_proxies']), 2)
+
+
+class FailuresTest(unittest.TestCase):
+    def setUp(self):
+        self.mw = SOCKSProxyMiddleware(ProxyHealthPool(['a'], clock=lambda: 0))
+        self.request = Request('http://example.com/')
+        self.mw.process_request(self.request, None)
+
+    def test_proxy_refused(self):
+        self.mw.process_exception(self.request, ConnectionRefusedError(), None)
+        self.assertEqual(self.mw.health.get('a').failures, 1)
+
+    def test_destination_refused(self):
+        error = ConnectionRefusedError('SOCKS 5: Connection refused')
+        error.reply = 0x05
+        self.mw.process_exception(self.request, error, None)
+        state = self.mw.health.get('a')
+        self.assertEqual((state.failures, state.inflight), (0, 0))
@@ -0,0 +1,143 @@
+from functools import partial
+
+from scrapy.spiders import Spider
+from scrapy.utils.test import get_crawler
+from twisted.internet import defer, reactor
+from twisted.internet.testing import StringTransport
+from twisted.names import hosts
+from twisted.trial import unittest
+
+from benchmarks.servers import FaultPlan, listen_origin, listen_socks
+from scrapy_socks import prober
+from scrapy_socks.prober import ProbeError, ProbeProtocol, SOCKSProxyProber
+from scrapy_socks.resolver import HostResolver
+from scrapy_socks.signals import proxies_probed
+
+
+class Engine(object):
+    def __init__(self):
+        self.paused = False
+        self.closed = []
+
+    def pause(self):
+        self.paused = True
+
+    def close_spider(self, spider, reason):
+        self.closed.append(reason)
+
+
+class SOCKSProxyProberTest(unittest.TestCase):
+    """Probes through local SOCKS servers to a local origin."""
+
+    def setUp(self):
+        # The DNS client would leave a config reload scheduled
+        self.patch(prober, 'HostResolver', partial(HostResolver, resolver=hosts.Resolver()))
+        origin = listen_origin(reactor)
+        self.addCleanup(origin.stopListening)
+        self.url = 'http://127.0.0.1:%d/' % origin.getHost().port
+        self.crawler = get_crawler(Spider)
+        self.crawler.engine = Engine()
+        self.spider = Spider('probed')
+        self.signals = []
+        self.crawler.signals.connect(lambda **kwargs: self.signals.append(kwargs), signal=proxies_probed,
+                                     weak=False)
+
+    def tearDown(self):
+        # Let the server side of the closed connections go away
+        d = defer.Deferred()
+        reactor.callLater(0.05, d.callback, None)
+        return d
+
+    def socks(self, faults=None):
+        factory, port = listen_socks(reactor, faults=faults)
+        self.addCleanup(port.stopListening)
+        return 'socks5h://127.0.0.1:%d' % port.getHost().port
+
+    def probe(self, proxies, **kwargs):
+        self.prober = SOCKSProxyProber(self.crawler, proxies, self.url, timeout=5, **kwargs)
+        return self.prober.spider_opened(self.spider)
+
+    @defer.inlineCallbacks
+    def test_classification(self):
+        live = self.socks()
+        failing = self.socks(FaultPlan(failure_rate=1))
+        dropping = self.socks(FaultPlan(drop_rate=1))
+        closed = listen_socks(reactor)[1]
+        refused = 'socks5h://127.0.0.1:%d' % closed.getHost().port
+        yield closed.stopListening()
+        proxies = [live, failing, dropping, refused, 'http://127.0.0.1:8080']
+        yield self.probe(proxies)
+
+        results = self.prober.results
+        self.assertEqual([r.proxy for r in results], proxies)
+        self.assertEqual([r.error for r in results],
+                         [None, 'SOCKSReplyError', 'SOCKSError', 'ConnectionRefusedError', 'SchemeNotSupported'])
+        self.assertEqual([r.alive for r in results], [True, False, False, False, False])
+        self.assertTrue(0 <= results[0].connect <= results[0].handshake <= results[0].first_byte)
+        self.assertIsNotNone(results[1].connect)
+        self.assertIsNone(results[1].handshake)
+
+        stats = self.crawler.stats
+        self.assertEqual(stats.get_value('socks/probe/proxies'), 5)
+        self.assertEqual(stats.get_value('socks/probe/alive'), 1)
+        self.assertEqual(stats.get_value('socks/probe/kept'), 1)
+        self.assertEqual(stats.get_value('socks/probe/errors/SOCKSReplyError'), 1)
+        self.assertEqual(stats.get_value('socks/probe/errors/ConnectionRefusedError'), 1)
+        self.assertFalse(self.crawler.engine.paused)
+
+    @defer.inlineCallbacks
+    def test_signal_payload(self):
+        slow = self.socks(FaultPlan(latency=0.2))
+        fast = self.socks()
+        dead = self.socks(FaultPlan(failure_rate=1))
+        yield self.probe([slow, fast, dead])
+        self.assertEqual(len(self.signals), 1)
+        signal = self.signals[0]
+        self.assertIs(signal['signal'], proxies_probed)
+        self.assertEqual([r.proxy for r in signal['ranked']], [fast, slow])
+        self.assertEqual([r.proxy for r in signal['results']], [slow, fast, dead])
+        self.assertIs(signal['ranked'][0], self.prober.results[1])
+
+    @defer.inlineCallbacks
+    def test_max_latency_and_keep(self):
+        slow = self.socks(FaultPlan(latency=0.3))
+        fast = [self.socks(), self.socks()]
+        yield self.probe([slow] + fast, max_latency=0.25)
+        self.assertEqual(sorted(r.proxy for r in self.signals[0]['ranked']), sorted(fast))
+        yield self.probe([slow] + fast, keep=1)
+        self.assertEqual(len(self.signals[1]['ranked']), 1)
+        self.assertIn(self.signals[1]['ranked'][0].proxy, fast)
+
+    @defer.inlineCallbacks
+    def test_no_live_proxies_closes_the_spider(self):
+        yield self.probe([self.socks(FaultPlan(drop_rate=1))])
+        self.assertEqual(self.signals[0]['ranked'], [])
+        self.assertTrue(self.crawler.engine.paused)
+        d = defer.Deferred()
+        reactor.callLater(0, d.callback, None)
+        yield d
+        self.assertEqual(self.crawler.engine.closed, ['socks_no_live_proxies'])
+
+
+class ProbeProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.done = defer.Deferred()
+        self.protocol = ProbeProtocol(b'HEAD / HTTP/1.1\r\n\r\n', reactor, self.done)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_http_response(self):
+        self.assertEqual(self.transport.value(), b'HEAD / HTTP/1.1\r\n\r\n')
+        self.protocol.dataReceived(b'HT')
+        self.assertNoResult(self.done)
+        self.protocol.dataReceived(b'TP/1.1 200 OK\r\n')
+        self.assertEqual(self.successResultOf(self.done), self.protocol.firstByte)
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_not_http(self):
+        self.protocol.dataReceived(b'SSH-2.0-OpenSSH\r\n')
+        self.failureResultOf(self.done, ProbeError)
+
+    def test_closed_before_a_response(self):
+        self.protocol.connectionLost(None)
+        self.failureResultOf(self.done, ProbeError)
@@ -0,0 +1,99 @@
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import Clock
+from twisted.internet.testing import MemoryReactorClock, StringTransport
+from twisted.trial import unittest
+
+from scrapy_socks.config import isolated_config, parse_proxy
+from scrapy_socks.endpoint import SOCKSWrapper
+from scrapy_socks.exceptions import SOCKSCachedReplyError, SOCKSReplyError
+from scrapy_socks.replycache import ReplyFailureCache
+
+
+class ReplyFailureCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = ReplyFailureCache(self.clock, maxsize=2, ttl=10)
+        self.proxy = parse_proxy('socks5h://127.0.0.1:9050')
+
+    def test_keyed_by_proxy_address(self):
+        self.cache.put(isolated_config(self.proxy, 'a'), 'example.com', 80, 0x04)
+        self.assertEqual(self.cache.get(isolated_config(self.proxy, 'b'), 'example.com', 80), 0x04)
+        self.assertEqual(len(self.cache._entries), 1)
+
+    def test_ttl(self):
+        self.cache.put(self.proxy, 'example.com', 80, 0x04)
+        self.clock.advance(9.9)
+        error = self.cache.check(self.proxy, 'example.com', 80)
+        self.assertEqual(error.reply, 0x04)
+        self.clock.advance(0.1)
+        self.assertIsNone(self.cache.check(self.proxy, 'example.com', 80))
+        self.assertEqual(self.cache._entries, {})
+
+    def test_put_again_extends_the_ttl(self):
+        self.cache.put(self.proxy, 'example.com', 80, 0x04)
+        self.clock.advance(5)
+        self.cache.put(self.proxy, 'example.com', 80, 0x03)
+        self.clock.advance(9)
+        self.assertEqual(self.cache.get(self.proxy, 'example.com', 80), 0x03)
+
+    def test_least_recently_used_is_evicted(self):
+        for host in ('a.com', 'b.com'):
+            self.cache.put(self.proxy, host, 80, 0x04)
+        self.cache.get(self.proxy, 'a.com', 80)
+        self.cache.put(self.proxy, 'c.com', 80, 0x04)
+        self.assertIsNone(self.cache.get(self.proxy, 'b.com', 80))
+        self.assertEqual(self.cache.get(self.proxy, 'a.com', 80), 0x04)
+
+    def test_only_destination_replies_of_socks5(self):
+        self.cache.put(self.proxy, 'example.com', 80, 0x01)
+        self.cache.put(parse_proxy('socks4a://127.0.0.1:9050'), 'example.com', 443, 0x5b)
+        self.assertEqual(self.cache._entries, {})
+
+
+class Stats(dict):
+    def inc_value(self, key):
+        self[key] = self.get(key, 0) + 1
+
+
+class CachedReplyTest(unittest.TestCase):
+    """Connects through SOCKSWrapper fail fast on a cached reply, without a socket."""
+
+    def setUp(self):
+        self.reactor = MemoryReactorClock()
+        self.stats = Stats()
+        self.cache = ReplyFailureCache(self.reactor, ttl=10, stats=self.stats)
+        self.proxy = parse_proxy('socks5h://127.0.0.1:9050')
+
+    def connect(self, port=80):
+        endpoint = SOCKSWrapper(self.reactor, TCP4ClientEndpoint(self.reactor, 'example.com', port), self.proxy,
+                                replyCache=self.cache)
+        return endpoint.connect(Factory.forProtocol(Protocol))
+
+    def answer(self, reply):
+        protocol = self.reactor.tcpClients[-1][2].buildProtocol(None)
+        protocol.makeConnection(StringTransport())
+        protocol.dataReceived(b'\x05\x00' + b'\x05' + bytes([reply]) + b'\x00\x01')
+
+    def test_destination_reply_fails_later_connects(self):
+        d = self.connect()
+        self.answer(0x04)
+        self.assertEqual(self.failureResultOf(d, SOCKSReplyError).value.reply, 0x04)
+        failure = self.failureResultOf(self.connect(), SOCKSCachedReplyError)
+        self.assertEqual(failure.value.reply, 0x04)
+        self.assertEqual(len(self.reactor.tcpClients), 1)
+        self.assertEqual(self.stats, {'socks/reply_cache/stored': 1, 'socks/reply_cache/hits': 1})
+        # Other destinations, and the same one once the entry expired, are dialled
+        self.assertNoResult(self.connect(port=443))
+        self.reactor.advance(10)
+        self.assertNoResult(self.connect())
+        self.assertEqual(len(self.reactor.tcpClients), 3)
+
+    def test_refused_is_not_cached(self):
+        d = self.connect()
+        self.answer(0x05)
+        self.failureResultOf(d, ConnectionRefusedError)
+        self.assertNoResult(self.connect())
+        self.assertEqual(len(self.reactor.tcpClients), 2)
+        self.assertEqual(self.stats, {})
@@ -0,0 +1,185 @@
+from twisted.internet import defer
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.error import DNSLookupError
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import Clock
+from twisted.internet.testing import MemoryReactorClock, StringTransport
+from twisted.names import dns
+from twisted.names.error import DNSNameError, DNSQueryTimeoutError, DNSServerError
+from twisted.trial import unittest
+
+from scrapy_socks.config import parse_proxy
+from scrapy_socks.endpoint import SOCKSWrapper
+from scrapy_socks.resolver import HostResolver
+
+
+class FakeResolver(object):
+    def __init__(self):
+        self.answers = {}
+        self.queries = 0
+
+    def answer(self, type, result):
+        self.answers[type] = result
+
+    def _lookup(self, type, name):
+        self.queries += 1
+        result = self.answers.get(type, [])
+        if isinstance(result, Exception):
+            return defer.fail(result)
+        return defer.succeed((result, [], []))
+
+    def lookupAddress(self, name, timeout=None):
+        return self._lookup(dns.A, name)
+
+    def lookupIPV6Address(self, name, timeout=None):
+        return self._lookup(dns.AAAA, name)
+
+
+def a_record(address, ttl):
+    return dns.RRHeader(b'example.com', dns.A, ttl=ttl, payload=dns.Record_A(address, ttl))
+
+
+def aaaa_record(address, ttl):
+    return dns.RRHeader(b'example.com', dns.AAAA, ttl=ttl, payload=dns.Record_AAAA(address, ttl))
+
+
+class HostResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.dns = FakeResolver()
+        self.resolver = HostResolver(self.clock, self.dns, negativeTTL=30)
+
+    def test_nxdomain_is_cached(self):
+        self.dns.answer(dns.A, DNSNameError())
+        self.dns.answer(dns.AAAA, DNSNameError())
+        self.failureResultOf(self.resolver.resolve('example.com'), DNSLookupError)
+        self.failureResultOf(self.resolver.resolve('example.com'), DNSLookupError)
+        self.assertEqual(self.dns.queries, 2)
+        self.clock.advance(30)
+        self.failureResultOf(self.resolver.resolve('example.com'), DNSLookupError)
+        self.assertEqual(self.dns.queries, 4)
+
+    def test_timeout_is_not_cached(self):
+        self.dns.answer(dns.A, DNSQueryTimeoutError(None))
+        failure = self.failureResultOf(self.resolver.resolve('example.com'), DNSLookupError)
+        self.assertIn('timed out', str(failure.value))
+        self.dns.answer(dns.A, [a_record('10.0.0.1', 60)])
+        self.assertEqual(self.successResultOf(self.resolver.resolve('example.com')), ['10.0.0.1'])
+        self.assertEqual(self.dns.queries, 4)
+
+    def test_server_failure_is_not_cached(self):
+        self.dns.answer(dns.A, DNSServerError())
+        self.dns.answer(dns.AAAA, DNSServerError())
+        failure = self.failureResultOf(self.resolver.resolve('example.com'), DNSLookupError)
+        self.assertIn('server failure', str(failure.value))
+        self.failureResultOf(self.resolver.resolve('example.com'), DNSLookupError)
+        self.assertEqual(self.dns.queries, 4)
+
+    def test_answer_ttl(self):
+        self.dns.answer(dns.A, [a_record('10.0.0.1', 120), a_record('10.0.0.2', 60)])
+        self.assertEqual(self.successResultOf(self.resolver.resolve('example.com')), ['10.0.0.1', '10.0.0.2'])
+        self.clock.advance(59)
+        self.successResultOf(self.resolver.resolve('example.com'))
+        self.assertEqual(self.dns.queries, 2)
+        self.clock.advance(1)
+        self.successResultOf(self.resolver.resolve('example.com'))
+        self.assertEqual(self.dns.queries, 4)
+
+    def test_ttl_is_clamped(self):
+        resolver = HostResolver(self.clock, self.dns, minTTL=30, maxTTL=300)
+        self.dns.answer(dns.A, [a_record('10.0.0.1', 0)])
+        resolver.resolve('example.com')
+        self.assertEqual(resolver._cache['example.com'][0], 30)
+        self.dns.answer(dns.A, [a_record('10.0.0.1', 86400)])
+        resolver.resolve('example.org')
+        self.assertEqual(resolver._cache['example.org'][0], 300)
+
+    def test_concurrent_lookups_share_a_query(self):
+        pending = defer.Deferred()
+        self.dns.lookupAddress = lambda name, timeout=None: pending
+        first = self.resolver.resolve('example.com')
+        second = self.resolver.resolve('example.com')
+        self.assertEqual(self.dns.queries, 1)
+        pending.callback(([a_record('10.0.0.1', 60)], [], []))
+        self.assertEqual(self.successResultOf(first), self.successResultOf(second))
+
+    def test_ipv4_first(self):
+        self.dns.answer(dns.AAAA, [aaaa_record('::1', 60)])
+        self.dns.answer(dns.A, [a_record('10.0.0.1', 60)])
+        self.assertEqual(self.successResultOf(self.resolver.resolve('example.com')), ['10.0.0.1', '::1'])
+
+    def test_least_recently_used_is_evicted(self):
+        resolver = HostResolver(self.clock, self.dns, maxsize=2)
+        self.dns.answer(dns.A, [a_record('10.0.0.1', 60)])
+        for host in ('a.com', 'b.com', 'a.com', 'c.com'):
+            resolver.resolve(host)
+        self.assertEqual(list(resolver._cache), ['a.com', 'c.com'])
+
+    def test_cancelled_lookup_leaves_the_others_waiting(self):
+        pending = defer.Deferred()
+        self.dns.lookupAddress = lambda name, timeout=None: pending
+        first = self.resolver.resolve('example.com')
+        second = self.resolver.resolve('example.com')
+        first.cancel()
+        self.failureResultOf(first, defer.CancelledError)
+        pending.callback(([a_record('10.0.0.1', 60)], [], []))
+        self.assertEqual(self.successResultOf(second), ['10.0.0.1'])
+
+
+class LocalResolutionTest(unittest.TestCase):
+    """The addresses SOCKSWrapper sends the proxy for socks4:// and socks5:// ones."""
+
+    def setUp(self):
+        self.reactor = MemoryReactorClock()
+        self.dns = FakeResolver()
+        self.dns.answer(dns.A, [a_record('10.0.0.1', 60)])
+        self.dns.answer(dns.AAAA, [aaaa_record('2001:db8::1', 60)])
+        self.resolver = HostResolver(self.reactor, self.dns)
+
+    def request(self, proxy, reply=b''):
+        endpoint = SOCKSWrapper(self.reactor, TCP4ClientEndpoint(self.reactor, 'example.com', 80),
+                                parse_proxy(proxy), resolver=self.resolver)
+        d = endpoint.connect(Factory.forProtocol(Protocol))
+        if not self.reactor.tcpClients:
+            return d
+        protocol = self.reactor.tcpClients.pop()[2].buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(reply)
+        return transport.value()
+
+    def test_socks4_gets_an_ipv4_address(self):
+        self.assertEqual(self.request('socks4://127.0.0.1:1080'), b'\x04\x01\x00\x50\x0a\x00\x00\x01\x00')
+        self.assertEqual(self.dns.queries, 2)
+
+    def test_socks4_without_ipv4_address_fails(self):
+        self.dns.answer(dns.A, [])
+        self.failureResultOf(self.request('socks4://127.0.0.1:1080'), DNSLookupError)
+
+    def test_socks5_gets_the_first_address(self):
+        self.request('socks5://127.0.0.1:1080')
+        self.assertEqual(self.request('socks5://127.0.0.1:1080', reply=b'\x05\x00'),
+                         b'\x05\x01\x00' + b'\x05\x01\x00\x01\x0a\x00\x00\x01\x00\x50')
+        # The second tunnel was answered from the cache
+        self.assertEqual(self.dns.queries, 2)
+
+    def test_socks5_ipv6_only(self):
+        self.dns.answer(dns.A, [])
+        self.assertEqual(self.request('socks5://127.0.0.1:1080', reply=b'\x05\x00')[3:8],
+                         b'\x05\x01\x00\x04\x20')
+
+    def test_remote_resolution_is_left_to_the_proxy(self):
+        self.request('socks4a://127.0.0.1:1080')
+        self.request('socks5h://127.0.0.1:1080')
+        self.assertEqual(self.dns.queries, 0)
+
+    def test_proxy_hostname_is_resolved(self):
+        self.dns.answer(dns.A, [a_record('10.0.0.1', 60), a_record('10.0.0.2', 60)])
+        first = set()
+        for _ in range(2):
+            SOCKSWrapper(self.reactor, TCP4ClientEndpoint(self.reactor, 'example.com', 80),
+                         parse_proxy('socks5h://proxy.example:1080'),
+                         resolver=self.resolver).connect(Factory.forProtocol(Protocol))
+            first.add(self.reactor.tcpClients.pop()[0])
+        # Tunnels take turns on the proxy addresses
+        self.assertEqual(first, {'10.0.0.1', '10.0.0.2'})
@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from scrapy_socks.shared import SharedHealthStore
+
+
+class InterleavedRecord(object):
+    """Lets another process write a record while the first read of it is in progress."""
+
+    def __init__(self, record, write):
+        self._record = record
+        self._write = write
+        self.reads = 0
+
+    def unpack_from(self, buffer, offset=0):
+        record = self._record.unpack_from(buffer, offset)
+        self.reads += 1
+        if self.reads == 1:
+            self._write()
+        return record
+
+    def __getattr__(self, name):
+        return getattr(self._record, name)
+
+
+def publish_forever(path, count):
+    store = SharedHealthStore(path, slots=16, pid=os.getpid())
+    key = store.key('127.0.0.1:1080')
+    for i in range(count):
+        # A torn record would mix the fields of two writes
+        store.publish(key, float(i), float(i) + 0.5, i)
+
+
+class SharedHealthStoreTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'health')
+        self.clock = Clock()
+        self.stores = []
+        self.key = SharedHealthStore.key('127.0.0.1:1080')
+
+    def store(self, pid, slots=16):
+        store = SharedHealthStore(self.path, slots=slots, stale=30, clock=self.clock.seconds, pid=pid)
+        self.stores.append(store)
+        self.addCleanup(store.close)
+        return store
+
+    def test_reads_the_other_processes(self):
+        first, second, reader = self.store(1), self.store(2), self.store(3)
+        first.publish(self.key, 0.2, 1.0, 3)
+        second.publish(self.key, 0.4, 0.5, 2, open_until=60)
+        reader.publish(self.key, 9.0, 0.0, 100)
+        health = reader.read()[self.key]
+        self.assertAlmostEqual(health.latency, 0.3)
+        self.assertEqual((health.success, health.inflight, health.open_until, health.processes),
+                         (0.75, 5, 60, 2))
+
+    def test_stale_and_closed_records_are_ignored(self):
+        writer, reader = self.store(1), self.store(2)
+        writer.publish(self.key, 0.2, 1.0, 1)
+        self.clock.advance(31)
+        self.assertEqual(reader.read(), {})
+        writer.publish(self.key, 0.2, 1.0, 1)
+        self.assertIn(self.key, reader.read())
+        writer.close()
+        self.assertEqual(reader.read(), {})
+
+    def test_record_being_written_is_skipped(self):
+        writer, reader = self.store(1), self.store(2)
+        writer.publish(self.key, 0.2, 1.0, 1)
+        offset = writer._own[self.key]
+        seq = writer.SEQ.unpack_from(writer._map, offset)[0]
+        writer.SEQ.pack_into(writer._map, offset, seq | 1)
+        self.assertEqual(reader.read(), {})
+        writer.SEQ.pack_into(writer._map, offset, seq + 2)
+        self.assertIn(self.key, reader.read())
+
+    def test_torn_read_is_retried(self):
+        writer, reader = self.store(1), self.store(2)
+        writer.publish(self.key, 0.2, 1.0, 1)
+        reader.RECORD = InterleavedRecord(reader.RECORD, lambda: writer.publish(self.key, 0.7, 0.5, 4))
+        health = reader.read()[self.key]
+        self.assertEqual((health.latency, health.success, health.inflight), (0.7, 0.5, 4))
+
+    def test_slot_exhaustion(self):
+        writer = self.store(1, slots=2)
+        # The first process decides the size
+        self.assertEqual(self.store(2, slots=64).slots, 2)
+        writer.publish(writer.key('a:1'), 0.2, 1.0, 1)
+        writer.publish(writer.key('b:1'), 0.2, 1.0, 1)
+        self.assertRaises(ValueError, writer.publish, writer.key('c:1'), 0.2, 1.0, 1)
+        other = self.stores[1]
+        self.assertRaises(ValueError, other.publish, other.key('a:1'), 0.2, 1.0, 1)
+        # Records of a process that went quiet are taken over
+        self.clock.advance(31)
+        other.publish(other.key('c:1'), 0.2, 1.0, 1)
+        self.assertEqual(list(writer.read()), [other.key('c:1')])
+
+    def test_concurrent_writer_process(self):
+        reader = SharedHealthStore(self.path, slots=16, pid=1)
+        self.addCleanup(reader.close)
+        process = multiprocessing.get_context('fork').Process(target=publish_forever, args=(self.path, 20000))
+        process.start()
+        seen = 0
+        while process.is_alive() or not seen:
+            health = reader.read().get(self.key)
+            if health is not None:
+                seen += 1
+                self.assertEqual(health.success - health.latency, 0.5)
+                self.assertEqual(health.inflight, health.latency)
+            if not process.is_alive() and not seen:
+                break
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertTrue(seen)
@@ -0,0 +1,90 @@
+from twisted.internet import ssl
+from twisted.internet.error import ConnectionDone
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import Clock
+from twisted.internet.testing import StringTransport
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from OpenSSL import SSL
+import OpenSSL
+
+from scrapy_socks.exceptions import SOCKSTimeoutError
+from scrapy_socks.tls import _DeadlineTLSFactory, _openssl_function, session_reused, creator_context, \
+    SessionCachingTLSFactory, TLSSessionCache
+
+
+class Recorder(Protocol):
+    reason = None
+
+    def connectionLost(self, reason):
+        self.reason = reason
+
+
+class DeadlineTLSProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.app = Recorder()
+        factory = _DeadlineTLSFactory(ssl.optionsForClientTLS(u'example.com'), True,
+                                      Factory.forProtocol(lambda: self.app))
+        self.protocol = factory.buildProtocol(None)
+        self.transport = StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def test_timeout(self):
+        self.protocol.startDeadline(self.clock, 5)
+        self.clock.advance(5)
+        self.assertTrue(self.transport.disconnecting)
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertTrue(self.app.reason.check(SOCKSTimeoutError))
+
+    def test_cancelled_when_connection_lost(self):
+        self.protocol.startDeadline(self.clock, 5)
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertFalse(self.app.reason.check(SOCKSTimeoutError))
+
+
+class PrivateAPITest(unittest.TestCase):
+    # Fails when an upgrade takes away what session resumption relies on
+
+    def test_session_reused(self):
+        connection = SSL.Connection(SSL.Context(SSL.TLS_METHOD), None)
+        self.assertIs(session_reused(connection), False)
+
+    def test_creator_context(self):
+        self.assertIsInstance(creator_context(ssl.optionsForClientTLS(u'example.com')), SSL.Context)
+        self.assertIsNone(creator_context(object()))
+
+    def test_version_gate(self):
+        self.assertIsNotNone(_openssl_function(OpenSSL.__version__, 'SSL_session_reused'))
+        self.assertIsNone(_openssl_function('99.0.0', 'SSL_session_reused'))
+        self.assertIsNone(_openssl_function('19.0.0', 'SSL_session_reused'))
+
+
+class RecordingSessionCache(TLSSessionCache):
+    def __init__(self):
+        TLSSessionCache.__init__(self)
+        self.discarded = []
+
+    def discard(self, netloc):
+        self.discarded.append(netloc)
+
+
+class SessionCachingTLSProtocolTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = RecordingSessionCache()
+        factory = SessionCachingTLSFactory(ssl.optionsForClientTLS(u'example.com'), True,
+                                           Factory.forProtocol(Recorder), self.cache, (b'example.com', 443))
+        self.protocol = factory.buildProtocol(None)
+        self.protocol.makeConnection(StringTransport())
+
+    def test_session_kept_when_the_server_never_answered(self):
+        self.protocol.abortConnection()
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.cache.discarded, [])
+
+    def test_session_discarded_when_handshake_failed(self):
+        # A fatal handshake_failure alert
+        self.protocol.dataReceived(b'\x15\x03\x03\x00\x02\x02\x28')
+        self.protocol.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(self.cache.discarded, [(b'example.com', 443)])
@@ -0,0 +1,53 @@
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from scrapy_socks.config import isolated_config, parse_proxy
+from scrapy_socks.warmer import TunnelWarmer
+
+
+class FakePool(object):
+    maxPersistentPerHost = 2
+
+    def __init__(self):
+        self._connections = {}
+        self._timeouts = {}
+        self.connects = []
+
+    def _newConnection(self, key, endpoint):
+        d = defer.Deferred()
+        self.connects.append(d)
+        return d
+
+
+class TunnelWarmerTest(unittest.TestCase):
+    def setUp(self):
+        self.pools = {}
+        self.warmer = TunnelWarmer(Clock(), self.pool, lambda proxy_config, destination: None, reserve=2)
+        self.proxy = parse_proxy('socks5h://127.0.0.1:9050')
+
+    def pool(self, proxy_config):
+        return self.pools.setdefault(proxy_config, FakePool())
+
+    def test_forget(self):
+        retired = isolated_config(self.proxy, 'scrapy-0-0')
+        kept = isolated_config(self.proxy, 'scrapy-1-0')
+        for proxy_config in (retired, kept):
+            self.warmer.note(proxy_config, b'http', b'example.com', 80)
+        self.warmer.warm()
+        connects = self.pools.pop(retired).connects
+        self.assertEqual(len(connects), 2)
+        self.warmer.forget([retired])
+        self.assertTrue(all(d.called for d in connects))
+        self.assertEqual(set(self.warmer._pending.values()), {kept})
+        self.warmer.note(kept, b'http', b'example.com', 80)
+        self.warmer.warm()
+        self.assertNotIn(retired, self.pools)
+        self.warmer.stop()
+
+    def test_reserve_is_clamped_to_the_pool(self):
+        self.warmer.reserve = 5
+        self.warmer.note(self.proxy, b'http', b'example.com', 80)
+        self.warmer.warm()
+        self.assertEqual(len(self.pools[self.proxy].connects), 2)
+        self.warmer.stop()